@@ -0,0 +1,120 @@
+from pymongo import UpdateOne
+from property_queries import (
+    ADDRESS_KEY_FIELD, build_projection, decode_cursor, encode_cursor, normalize_address, parse_limit,
+)
+
+# Address search behind GET /properties/search, shared by both servers.
+#   ?q=23 good wi&mode=prefix   Type-ahead: addresses starting with the typed text, in address
+#                               order. A range scan on the address_key index (see property_queries.py).
+#   ?q=maple garden             Default mode=text: the words anywhere in the address or the
+#                               description, best matches first, from a text index.
+# Both return a page of ?limit= results (default 20) and an X-Next-Cursor header for ?after=,
+# like the list endpoints; ?fields=, ?exclude= and ?view= work too.
+
+SEARCH_MODES = ('text', 'prefix')
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LENGTH = 200
+SCORE_FIELD = 'score'  # Relevance of a text search result, higher is better
+BACKFILL_BATCH_SIZE = 1000
+PREFIX_SORT_SPEC = [(ADDRESS_KEY_FIELD, 1), ('_id', 1)]  # Same as the address_key index
+
+# The text index. An address match counts ten times a description match. No language, so
+# words are matched as they are: no stemming, and "will" in "Good will ave" is no stop word.
+TEXT_INDEX_WEIGHTS = {'address': 10, 'description': 1}
+TEXT_INDEX_KEYS = [(field, 'text') for field in TEXT_INDEX_WEIGHTS]
+TEXT_INDEX_OPTIONS = {'name': 'address_description_text', 'weights': TEXT_INDEX_WEIGHTS, 'default_language': 'none'}
+
+# Helper function to build the range of address keys that start with a prefix
+def prefix_range(prefix):
+    return {'$gte': prefix, '$lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)}
+
+# Everything /properties/search needs from ?q=, ?mode=, ?limit=, ?after= and the projection arguments
+class SearchQuery:
+    def __init__(self, args):
+        self.mode = args.get('mode', 'text')
+        if self.mode not in SEARCH_MODES:
+            raise ValueError(f'"mode" must be one of {", ".join(SEARCH_MODES)}')
+        text = args.get('q', '')
+        if len(text) > MAX_SEARCH_LENGTH:
+            raise ValueError(f'"q" may be at most {MAX_SEARCH_LENGTH} characters long')
+        self.text = normalize_address(text) if self.mode == 'prefix' else text.strip()
+        if not self.text:
+            raise ValueError('"q" must contain a letter or a digit')
+        self.limit = parse_limit(args.get('limit')) or DEFAULT_SEARCH_LIMIT
+        self.after = decode_cursor(args['after']) if args.get('after') else None
+        self.sort_field = ADDRESS_KEY_FIELD if self.mode == 'prefix' else SCORE_FIELD
+        self.projection = build_projection(args, 'summary')
+        self.added_fields = []  # Only fetched for the next cursor, dropped before responding
+        if self.projection:
+            # The sort key must come back with each document to build the next cursor
+            if self.projection.get(self.sort_field) == 0:
+                del self.projection[self.sort_field]
+                self.added_fields.append(self.sort_field)
+            elif 1 in self.projection.values() and self.sort_field not in self.projection:
+                self.projection[self.sort_field] = 1
+                self.added_fields.append(self.sort_field)
+            self.projection = self.projection or None
+
+    # Filter of a prefix search page. Both branches are bounded on the (address_key, _id) index,
+    # so a page costs about limit index entries however deep it is.
+    def prefix_query(self):
+        bounds = prefix_range(self.text)
+        if not self.after:
+            return {ADDRESS_KEY_FIELD: bounds}
+        key, last_id = self.after
+        if not isinstance(key, str) or not key.startswith(self.text):
+            raise ValueError('Invalid "after" cursor for this search')
+        return {'$or': [
+            {ADDRESS_KEY_FIELD: key, '_id': {'$gt': last_id}},
+            {ADDRESS_KEY_FIELD: {'$gt': key, '$lt': bounds['$lt']}},
+        ]}
+
+    # Aggregation pipeline of a text search page, best matches first
+    def text_pipeline(self):
+        pipeline = [
+            {'$match': {'$text': {'$search': self.text}}},
+            {'$addFields': {SCORE_FIELD: {'$meta': 'textScore'}}},
+        ]
+        if self.after:
+            score, last_id = self.after
+            pipeline.append({'$match': {'$or': [
+                {SCORE_FIELD: {'$lt': score}},
+                {SCORE_FIELD: score, '_id': {'$gt': last_id}},
+            ]}})
+        pipeline += [{'$sort': {SCORE_FIELD: -1, '_id': 1}}, {'$limit': self.limit + 1}]
+        if self.projection:
+            pipeline.append({'$project': self.projection})
+        return pipeline
+
+    # Trim the limit + 1 documents fetched for a page; returns (page, next cursor)
+    def split_page(self, documents):
+        next_cursor = None
+        if len(documents) > self.limit:
+            documents = documents[:self.limit]
+            next_cursor = encode_cursor(documents[-1].get(self.sort_field), documents[-1]['_id'])
+        for doc in documents:
+            for field in self.added_fields:
+                doc.pop(field, None)
+        return documents, next_cursor
+
+# Documents written before address keys existed, see backfill_address_keys
+BACKFILL_QUERY = {'address': {'$type': 'string'}, ADDRESS_KEY_FIELD: {'$exists': False}}
+
+# Helper function to build the backfill write of one document. The address is part of the filter,
+# so a document whose address changes meanwhile keeps the key of that update.
+def address_key_update(doc):
+    return UpdateOne({'_id': doc['_id'], 'address': doc['address']},
+                     {'$set': {ADDRESS_KEY_FIELD: normalize_address(doc['address'])}})
+
+# Give the documents written before address keys existed their key, in batches
+def backfill_address_keys(collection):
+    updated = 0
+    batch = []
+    for doc in collection.find(BACKFILL_QUERY, {'address': 1}):
+        batch.append(address_key_update(doc))
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            updated += collection.bulk_write(batch, ordered=False).modified_count
+            batch = []
+    if batch:
+        updated += collection.bulk_write(batch, ordered=False).modified_count
+    return updated
@@ -0,0 +1,119 @@
+from guardrails import validate_filter
+
+# Pipeline checks and built-in reports for /properties/aggregate, shared by the Flask
+# server (api_server.py) and the async server (api_server_async.py).
+# Only read-only stages are accepted, and no stage may run JavaScript on the server.
+# $match stages follow the filter rules of guardrails.py.
+
+ALLOWED_STAGES = {'$match', '$group', '$bucket', '$sort', '$limit', '$project'}
+FORBIDDEN_OPERATORS = {'$where', '$function', '$accumulator'}  # Server-side JavaScript
+MAX_STAGES = 20
+
+# Price histogram defaults, override with ?bucket_size= and ?max_price=
+DEFAULT_BUCKET_SIZE = 100000
+DEFAULT_MAX_PRICE = 1000000
+MAX_BUCKETS = 1000
+
+# Helper function to find forbidden operators anywhere inside a stage
+def find_forbidden(value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in FORBIDDEN_OPERATORS:
+                return key
+            found = find_forbidden(item)
+            if found:
+                return found
+    elif isinstance(value, list):
+        for item in value:
+            found = find_forbidden(item)
+            if found:
+                return found
+    return None
+
+# Check a client supplied pipeline, raises ValueError when it is not allowed
+def validate_pipeline(pipeline):
+    if not isinstance(pipeline, list) or not pipeline:
+        raise ValueError('"pipeline" must be a non-empty list of stages')
+    if len(pipeline) > MAX_STAGES:
+        raise ValueError(f'A pipeline may have at most {MAX_STAGES} stages')
+    for index, stage in enumerate(pipeline):
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise ValueError(f'Stage {index} must be an object with exactly one operator')
+        name = next(iter(stage))
+        if name not in ALLOWED_STAGES:
+            raise ValueError(f'Stage {index}: "{name}" is not allowed, use one of {", ".join(sorted(ALLOWED_STAGES))}')
+        forbidden = find_forbidden(stage[name])
+        if forbidden:
+            raise ValueError(f'Stage {index}: "{forbidden}" is not allowed')
+        if name == '$match':
+            try:
+                validate_filter(stage[name])
+            except ValueError as e:
+                raise ValueError(f'Stage {index}: {e}')
+    return pipeline
+
+# Helper function to get the filter of a leading $match stage (for query shapes and logs)
+def leading_match(pipeline):
+    if pipeline and isinstance(pipeline[0], dict) and isinstance(pipeline[0].get('$match'), dict):
+        return pipeline[0]['$match']
+    return {}
+
+# Helper function to read a positive integer URL parameter
+def _positive_int(args, name, default):
+    value = args.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f'"{name}" must be an integer')
+    if number < 1:
+        raise ValueError(f'"{name}" must be positive')
+    return number
+
+# Count and price statistics per value of a field
+def stats_by(field):
+    return [
+        {'$group': {
+            '_id': f'${field}',
+            'count': {'$sum': 1},
+            'avg_price': {'$avg': '$price'},
+            'min_price': {'$min': '$price'},
+            'max_price': {'$max': '$price'},
+        }},
+        {'$sort': {'_id': 1}},
+    ]
+
+# Number of properties per price range, e.g. 0-100000, 100000-200000 ...
+def price_histogram(args):
+    bucket_size = _positive_int(args, 'bucket_size', DEFAULT_BUCKET_SIZE)
+    max_price = _positive_int(args, 'max_price', DEFAULT_MAX_PRICE)
+    if max_price // bucket_size > MAX_BUCKETS:
+        raise ValueError(f'At most {MAX_BUCKETS} buckets, use a larger "bucket_size"')
+    boundaries = list(range(0, max_price, bucket_size)) + [max_price]
+    return [
+        {'$match': {'price': {'$type': 'number'}}},
+        {'$bucket': {
+            'groupBy': '$price',
+            'boundaries': boundaries,
+            'default': 'other',  # Negative prices and prices from max_price up
+            'output': {'count': {'$sum': 1}, 'avg_price': {'$avg': '$price'}},
+        }},
+    ]
+
+# Built-in reports, GET /properties/aggregate/<name>
+REPORTS = {
+    'price-histogram': price_histogram,
+    'by-rooms': lambda args: stats_by('rooms'),
+    'by-condition': lambda args: stats_by('condition'),
+}
+
+# Build the pipeline of a built-in report, an optional filter is applied first
+def build_report(name, args, match=None):
+    if name not in REPORTS:
+        raise LookupError(f'Unknown report "{name}", use one of {", ".join(sorted(REPORTS))}')
+    pipeline = REPORTS[name](args)
+    if match:
+        validate_pipeline([{'$match': match}])
+        pipeline = [{'$match': match}] + pipeline
+    return pipeline
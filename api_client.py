@@ -1,14 +1,17 @@
 import tkinter as tk
 from tkinter import messagebox, scrolledtext
 from tkinter import ttk
-import requests
 import json
-from PIL import Image, ImageTk
-import io
-import base64
+import os
+from urllib.parse import urlencode
+from image_cache import ImagePipeline
+from paged_table import PAGE_SIZE, PagedTable
+from request_executor import RequestExecutor
 
-# API base URL
-API_URL = "http://localhost:5000/properties"
+# API base URL (set API_URL to point the UI at another server, e.g. the async one on port 5001)
+API_URL = os.environ.get("API_URL", "http://localhost:5000/properties")
+SUGGESTION_COUNT = 8  # Addresses offered while typing in the input field
+SUGGESTION_DELAY_MS = 150  # Pause in typing before asking the server for suggestions
 
 # Main window
 root = tk.Tk()
@@ -16,6 +19,10 @@ root.title("MongoDB CRUD UI")
 root.geometry("700x600")
 root.configure(bg="#f0f0f0")
 
+# Runs the HTTP requests in the background so the window never freezes
+executor = RequestExecutor(root)
+images = ImagePipeline(executor, API_URL)  # Decoded thumbnails, cached by property id and image hash
+
 # Frame for content (full window since no image frame)
 main_frame = tk.Frame(root, bg="#f0f0f0")
 main_frame.pack(pady=20, padx=20, fill="both", expand=True)
@@ -25,6 +32,9 @@ tk.Label(main_frame, text="JSON Input:", font=("Arial", 12, "bold"), bg="#f0f0f0
 json_input = tk.Text(main_frame, height=5, width=80, font=("Arial", 10), borderwidth=2, relief="groove")
 json_input.pack(pady=5)
 
+# Address suggestions, shown below the input field while plain text (not JSON) is typed
+suggestion_list = tk.Listbox(main_frame, height=SUGGESTION_COUNT, width=80, font=("Arial", 10), exportselection=False)
+
 # Raw Response Output
 tk.Label(main_frame, text="Raw Response:", font=("Arial", 12, "bold"), bg="#f0f0f0").pack(pady=(10, 5))
 response_output = scrolledtext.ScrolledText(main_frame, height=5, width=80, font=("Arial", 10), borderwidth=2, relief="groove", bg="#ffffff")
@@ -35,9 +45,12 @@ tk.Label(main_frame, text="Postman/cURL Command:", font=("Arial", 12, "bold"), b
 curl_output = scrolledtext.ScrolledText(main_frame, height=3, width=80, font=("Arial", 10), borderwidth=2, relief="groove", bg="#ffffff")
 curl_output.pack(pady=5)
 
-# Store full data for the popup table
+# Store the property ids of the popup table rows, full documents are fetched on click
 row_data = {}
 latest_response = None  # To store the latest response for the popup
+latest_table_source = None  # (url, query, live) of the latest list request, the table pages through it itself
+detail_requests = 0  # Rows opened so far, an image arriving for an earlier one is not shown
+suggestion_timer = None  # Pending after() call of the type-ahead
 
 # Helper function to clear outputs
 def clear_outputs():
@@ -53,7 +66,7 @@ def generate_curl(method, url, data=None):
     return cmd
 
 # Helper function to show image in a popup
-def show_image_popup(image_data, address):
+def show_image_popup(photo, address, error=None):
     popup = tk.Toplevel(root)
     popup.title("Image Display")
     popup.geometry("300x350")
@@ -64,16 +77,12 @@ def show_image_popup(image_data, address):
     image_label = tk.Label(popup, bg="#ffffff", borderwidth=2, relief="groove")
     image_label.pack(pady=5)
     
-    try:
-        img_bytes = base64.b64decode(image_data)
-        img = Image.open(io.BytesIO(img_bytes))
-        img = img.resize((250, 250), Image.Resampling.LANCZOS)
-        photo = ImageTk.PhotoImage(img)
+    if photo is not None:  # Decoded to 250x250 in the background by image_cache.py
         image_label.configure(image=photo)
         image_label.image = photo  # Keep reference
-    except Exception as e:
-        image_label.configure(text=f"Error loading image: {str(e)}")
-        print(f"Image error: {str(e)}")
+    else:
+        image_label.configure(text=error)
+        print(f"Image error: {error}")
 
 def show_gardens_popup(gardens, address):
     popup = tk.Toplevel(root)
@@ -120,9 +129,41 @@ def show_gardens_popup(gardens, address):
         values = [str(garden.get(col, "N/A")) for col in columns]
         table.insert("", "end", values=values)
 
+# Helper function to get the content hash of a property's image from its summary
+def image_hash(summary):
+    image_ref = summary.get("image_ref")
+    return image_ref.get("hash") if isinstance(image_ref, dict) else None
+
+# Helper function to show the image and gardens of one property, fetched in the background
+def show_property_details(property_id, address="", known_image_hash=None):
+    def show_detail(result):
+        if result.error:
+            messagebox.showerror("Error", f"Network error: {result.error}")
+            return
+        if result.status_code != 200:
+            return
+        full_data = result.data
+        print(f"Selected row full data: {full_data}")  # Debug print
+        if "gardens" in full_data and full_data["gardens"]:
+            show_gardens_popup(full_data["gardens"], full_data.get("address", address))
+
+    def show_image(photo, error):
+        if request_number != detail_requests:
+            return  # Another row was opened since
+        # A property without an image_ref simply has no image, any other failure is shown in the popup
+        if photo is None and known_image_hash is None and error.startswith("404 "):
+            return
+        show_image_popup(photo, address, error)
+
+    # Both load at once; the image is usually cached or already loading since the row was selected
+    global detail_requests
+    detail_requests += 1
+    request_number = detail_requests
+    executor.submit("row-detail", "GET", f"{API_URL}/{property_id}", show_detail, params={"exclude": "image"})
+    images.get(property_id, known_image_hash, show_image)
+
 # Helper function to create and populate the response table popup
 def show_response_table():
-    global latest_response
     if latest_response is None:
         messagebox.showinfo("Info", "No response data available. Perform an action first.")
         return
@@ -133,6 +174,19 @@ def show_response_table():
     popup.geometry("800x400")
     popup.configure(bg="#f0f0f0")
 
+    # Lists are paged in from the server as the user scrolls
+    # (search results are ranked by the server, they can't be re-sorted or follow changes)
+    if latest_table_source is not None and isinstance(latest_response.data, list):
+        url, query, live = latest_table_source
+        PagedTable(popup, executor, url, query,
+                   on_row_click=lambda property_id, summary: show_property_details(
+                       property_id, summary.get("address", ""), image_hash(summary)),
+                   on_row_select=lambda property_id, summary: images.prefetch(property_id, image_hash(summary)),
+                   on_error=lambda result: messagebox.showerror("Error", f"Failed: {result.status_code} - {result.error or result.text}"),
+                   changes_url=f"{API_URL}/changes" if live else None,  # Keeps the rows current while the popup is open
+                   sortable=live)
+        return
+
     # Table frame in popup
     table_frame = tk.Frame(popup, bg="#f0f0f0")
     table_frame.pack(pady=10, padx=10, fill="both", expand=True)
@@ -144,41 +198,26 @@ def show_response_table():
 
     # Populate table with latest response
     try:
-        data = latest_response.json()
-        if isinstance(data, list):  # Handle array response
-            if not data:
-                table["columns"] = ("Message",)
-                table.heading("Message", text="Message")
-                table.column("Message", width=200, anchor="center")
-                table.insert("", "end", values=("No properties found",))
-            else:
-                keys = list(data[0].keys())
-                table["columns"] = keys
-                for key in keys:
-                    table.heading(key, text=key.capitalize())
-                    table.column(key, width=100 if key != "image" else 200, anchor="w")
-                for item in data:
-                    values = [str(item.get(key, ""))[:50] if key == "image" else str(item.get(key, "")) for key in keys]
-                    row_id = table.insert("", "end", values=values)
-                    row_data[row_id] = item
-        elif isinstance(data, dict):  # Handle single object response
-            if "error" in data or "message" in data or "id" in data or "deleted_count" in data:
-                table["columns"] = ("Key", "Value")
-                table.heading("Key", text="Key")
-                table.heading("Value", text="Value")
-                table.column("Key", width=100, anchor="w")
-                table.column("Value", width=200, anchor="w")
-                for key, value in data.items():
-                    table.insert("", "end", values=(key.capitalize(), str(value)))
-            else:
-                keys = list(data.keys())
-                table["columns"] = keys
-                for key in keys:
-                    table.heading(key, text=key.capitalize())
-                    table.column(key, width=100 if key != "image" else 200, anchor="w")
-                values = [str(data.get(key, ""))[:50] if key == "image" else str(data.get(key, "")) for key in keys]
-                row_id = table.insert("", "end", values=values)
-                row_data[row_id] = data
+        data = latest_response.data
+        if not isinstance(data, dict):
+            raise ValueError("Response is not a JSON object")
+        if "error" in data or "message" in data or "id" in data or "deleted_count" in data:
+            table["columns"] = ("Key", "Value")
+            table.heading("Key", text="Key")
+            table.heading("Value", text="Value")
+            table.column("Key", width=100, anchor="w")
+            table.column("Value", width=200, anchor="w")
+            for key, value in data.items():
+                table.insert("", "end", values=(key.capitalize(), str(value)))
+        else:  # Handle single object response
+            keys = list(data.keys())
+            table["columns"] = keys
+            for key in keys:
+                table.heading(key, text=key.capitalize())
+                table.column(key, width=100 if key != "image" else 200, anchor="w")
+            values = [str(data.get(key, ""))[:50] if key == "image" else str(data.get(key, "")) for key in keys]
+            row_id = table.insert("", "end", values=values)
+            row_data[row_id] = (data.get("_id"), data.get("address", ""), image_hash(data))
     except:
         table["columns"] = ("Message",)
         table.heading("Message", text="Message")
@@ -188,153 +227,182 @@ def show_response_table():
     # Bind click event to show image popup if image exists
     def handle_row_click(event):
         selected = table.selection()
-        if not selected:
+        if not selected or not row_data.get(selected[0], (None,))[0]:
             return
-        row_id = selected[0]
-        full_data = row_data.get(row_id, {})
-        print(f"Selected row full data: {full_data}")  # Debug print
-        if "image" in full_data and full_data["image"]:
-            show_image_popup(full_data["image"],full_data["address"])
-        if "gardens" in full_data and full_data["gardens"]:
-            show_gardens_popup(full_data["gardens"], full_data["address"])
+        show_property_details(*row_data[selected[0]])
 
     table.bind("<ButtonRelease-1>", handle_row_click)
 
-# CRUD Functions
-def create_item():
-    global latest_response
+# Helper function to read the JSON input field (None after showing an error)
+def read_json_input():
     try:
-        data = json.loads(json_input.get("1.0", tk.END).strip())
-        response = requests.post(API_URL, json=data)
-        latest_response = response
-        clear_outputs()
-        response_output.insert(tk.END, json.dumps(response.json(), indent=2))
-        curl_output.insert(tk.END, generate_curl("POST", API_URL, data))
-        if response.status_code == 201:
-            messagebox.showinfo("Success", "Item created successfully!")
-        else:
-            messagebox.showerror("Error", f"Failed: {response.status_code} - {response.text}")
+        return json.loads(json_input.get("1.0", tk.END).strip())
     except json.JSONDecodeError:
         messagebox.showerror("Error", "Invalid JSON input")
-    except requests.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+        return None
 
-def read_properties():
-    global latest_response
-    try:
-        response = requests.get(API_URL)
-        latest_response = response
+# Helper function to read the input field as plain search text (None when it holds JSON)
+def read_search_text():
+    text = json_input.get("1.0", tk.END).strip()
+    return text if text and text[0] not in "{[" else None
+
+# Type-ahead: once typing pauses, offer the addresses that start with the typed text
+def schedule_suggestions(event):
+    global suggestion_timer
+    if event.keysym in ("Down", "Escape"):
+        return
+    if suggestion_timer is not None:
+        root.after_cancel(suggestion_timer)
+    suggestion_timer = root.after(SUGGESTION_DELAY_MS, request_suggestions)
+
+def request_suggestions():
+    global suggestion_timer
+    suggestion_timer = None
+    text = read_search_text()
+    if text is None:
+        executor.cancel("suggest")
+        hide_suggestions()
+        return
+    params = {"q": text, "mode": "prefix", "limit": SUGGESTION_COUNT, "fields": "address"}
+    executor.submit("suggest", "GET", f"{API_URL}/search", show_suggestions, params=params)  # Supersedes the last one
+
+def show_suggestions(result):
+    addresses = []
+    if result.ok and isinstance(result.data, list):
+        for item in result.data:
+            if item.get("address") and item["address"] not in addresses:
+                addresses.append(item["address"])
+    suggestion_list.delete(0, tk.END)
+    if not addresses or read_search_text() is None:
+        hide_suggestions()
+        return
+    for address in addresses:
+        suggestion_list.insert(tk.END, address)
+    suggestion_list.configure(height=len(addresses))
+    suggestion_list.pack(after=json_input, pady=(0, 5))
+
+def hide_suggestions(event=None):
+    suggestion_list.pack_forget()
+
+# Put the chosen address into the input field as a query for it
+def choose_suggestion(event=None):
+    selected = suggestion_list.curselection()
+    if not selected:
+        return
+    json_input.delete("1.0", tk.END)
+    json_input.insert("1.0", json.dumps({"address": suggestion_list.get(selected[0])}))
+    hide_suggestions()
+    json_input.focus_set()
+
+# Arrow down from the input field moves into the suggestions
+def focus_suggestions(event):
+    if not suggestion_list.winfo_ismapped():
+        return None
+    suggestion_list.focus_set()
+    suggestion_list.selection_clear(0, tk.END)
+    suggestion_list.selection_set(0)
+    suggestion_list.activate(0)
+    return "break"
+
+json_input.bind("<KeyRelease>", schedule_suggestions)
+json_input.bind("<Down>", focus_suggestions)
+json_input.bind("<Escape>", hide_suggestions)
+suggestion_list.bind("<ButtonRelease-1>", choose_suggestion)
+suggestion_list.bind("<Return>", choose_suggestion)
+suggestion_list.bind("<Escape>", lambda event: (hide_suggestions(), json_input.focus_set()))
+
+# Helper function to send a request in the background and show its result in the output fields.
+# A new click supersedes a request that is still running.
+def send_request(method, url, data=None, expected_status=200, success_message=None, send_body=True, table_source=None):
+    def show_result(result):
+        global latest_response, latest_table_source
+        if result.error:
+            messagebox.showerror("Error", f"Network error: {result.error}")
+            return
+        latest_response = result
+        latest_table_source = table_source
         clear_outputs()
-        response_output.insert(tk.END, json.dumps(response.json(), indent=2))
-        curl_output.insert(tk.END, generate_curl("GET", API_URL))
-        if response.status_code != 200:
-            messagebox.showerror("Error", f"Failed: {response.status_code} - {response.text}")
-    except requests.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+        response_output.insert(tk.END, json.dumps(result.data, indent=2) if result.data is not None else result.text)
+        curl_output.insert(tk.END, generate_curl(method, url, data if send_body else None))
+        if result.status_code != expected_status:
+            messagebox.showerror("Error", f"Failed: {result.status_code} - {result.text}")
+        elif success_message:
+            messagebox.showinfo("Success", success_message(result.data))
+
+    response_output.delete(1.0, tk.END)
+    response_output.insert(tk.END, f"{method} {url} ...")
+    executor.submit("main", method, url, show_result, json=data if send_body else None)
+
+# CRUD Functions
+def create_item():
+    data = read_json_input()
+    if data is None:
+        return
+    send_request("POST", API_URL, data, expected_status=201,
+                 success_message=lambda result: "Item created successfully!")
 
+# Only the first page goes to the output field, Show Table pages in the rest as it scrolls
+def read_properties():
+    send_request("GET", f"{API_URL}?limit={PAGE_SIZE}", table_source=(API_URL, None, True))
+
+# Query with a JSON filter, or plain words to search the addresses and descriptions
 def query_properties():
-    global latest_response
-    try:
-        data = json.loads(json_input.get("1.0", tk.END).strip())
-        response = requests.get(f"{API_URL}/query", json=data)
-        latest_response = response
-        clear_outputs()
-        response_output.insert(tk.END, json.dumps(response.json(), indent=2))
-        curl_output.insert(tk.END, generate_curl("GET", f"{API_URL}/query", data))
-        if response.status_code == 200:
-            messagebox.showinfo("Success", f"Found {len(response.json())} properties")
-        else:
-            messagebox.showerror("Error", f"Failed: {response.status_code} - {response.text}")
-    except json.JSONDecodeError:
-        messagebox.showerror("Error", "Invalid JSON input")
-    except requests.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+    hide_suggestions()
+    text = read_search_text()
+    if text is not None:
+        url = f"{API_URL}/search?{urlencode({'q': text})}"
+        send_request("GET", url, table_source=(url, None, False),
+                     success_message=lambda result: f"Showing the {len(result)} best matches")
+        return
+    data = read_json_input()
+    if data is None:
+        return
+    send_request("GET", f"{API_URL}/query?limit={PAGE_SIZE}", data, table_source=(f"{API_URL}/query", data, True),
+                 success_message=lambda result: f"Found {len(result)} properties" if len(result) < PAGE_SIZE
+                 else f"Showing the first {PAGE_SIZE} properties, Show Table pages through the rest")
 
 def update_item():
-    global latest_response
-    try:
-        data = json.loads(json_input.get("1.0", tk.END).strip())
-        if "_id" not in data:
-            messagebox.showerror("Error", "JSON must include '_id' for update")
-            return
-        item_id = data.pop("_id")
-        response = requests.put(f"{API_URL}/{item_id}", json=data)
-        latest_response = response
-        clear_outputs()
-        response_output.insert(tk.END, json.dumps(response.json(), indent=2))
-        curl_output.insert(tk.END, generate_curl("PUT", f"{API_URL}/{item_id}", data))
-        if response.status_code == 200:
-            messagebox.showinfo("Success", "Item updated successfully!")
-        else:
-            messagebox.showerror("Error", f"Failed: {response.status_code} - {response.text}")
-    except json.JSONDecodeError:
-        messagebox.showerror("Error", "Invalid JSON input")
-    except requests.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+    data = read_json_input()
+    if data is None:
+        return
+    if "_id" not in data:
+        messagebox.showerror("Error", "JSON must include '_id' for update")
+        return
+    item_id = data.pop("_id")
+    images.forget(item_id)  # The update may carry a new image
+    send_request("PUT", f"{API_URL}/{item_id}", data,
+                 success_message=lambda result: "Item updated successfully!")
 
 def bulk_update_properties():
-    global latest_response
-    try:
-        data = json.loads(json_input.get("1.0", tk.END).strip())
-        if "query" not in data or "update" not in data:
-            messagebox.showerror("Error", "JSON must include 'query' and 'update' fields")
-            return
-        response = requests.put(f"{API_URL}/bulk-update", json=data)
-        latest_response = response
-        clear_outputs()
-        response_output.insert(tk.END, json.dumps(response.json(), indent=2))
-        curl_output.insert(tk.END, generate_curl("PUT", f"{API_URL}/bulk-update", data))
-        if response.status_code == 200:
-            messagebox.showinfo("Success", f"Bulk update completed: {response.json()['modified_count']} properties modified")
-        else:
-            messagebox.showerror("Error", f"Failed: {response.status_code} - {response.text}")
-    except json.JSONDecodeError:
-        messagebox.showerror("Error", "Invalid JSON input")
-    except requests.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+    data = read_json_input()
+    if data is None:
+        return
+    if "query" not in data or "update" not in data:
+        messagebox.showerror("Error", "JSON must include 'query' and 'update' fields")
+        return
+    send_request("PUT", f"{API_URL}/bulk-update", data,
+                 success_message=lambda result: f"Bulk update completed: {result['modified_count']} properties modified")
 
 def delete_item():
-    global latest_response
-    try:
-        data = json.loads(json_input.get("1.0", tk.END).strip())
-        if "_id" not in data:
-            messagebox.showerror("Error", "JSON must include '_id' for delete")
-            return
-        item_id = data["_id"]
-        response = requests.delete(f"{API_URL}/{item_id}")
-        latest_response = response
-        clear_outputs()
-        response_output.insert(tk.END, json.dumps(response.json(), indent=2))
-        curl_output.insert(tk.END, generate_curl("DELETE", f"{API_URL}/{item_id}"))
-        if response.status_code == 200:
-            messagebox.showinfo("Success", "Item deleted successfully!")
-        else:
-            messagebox.showerror("Error", f"Failed: {response.status_code} - {response.text}")
-    except json.JSONDecodeError:
-        messagebox.showerror("Error", "Invalid JSON input")
-    except requests.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+    data = read_json_input()
+    if data is None:
+        return
+    if "_id" not in data:
+        messagebox.showerror("Error", "JSON must include '_id' for delete")
+        return
+    item_id = data["_id"]
+    send_request("DELETE", f"{API_URL}/{item_id}", send_body=False,
+                 success_message=lambda result: "Item deleted successfully!")
 
 def bulk_delete_properties():
-    global latest_response
-    try:
-        data = json.loads(json_input.get("1.0", tk.END).strip())
-        if "query" not in data:
-            messagebox.showerror("Error", "JSON must include 'query' field")
-            return
-        response = requests.delete(f"{API_URL}/bulk-delete", json=data)
-        latest_response = response
-        clear_outputs()
-        response_output.insert(tk.END, json.dumps(response.json(), indent=2))
-        curl_output.insert(tk.END, generate_curl("DELETE", f"{API_URL}/bulk-delete", data))
-        if response.status_code == 200:
-            messagebox.showinfo("Success", f"Bulk delete completed: {response.json()['deleted_count']} properties deleted")
-        else:
-            messagebox.showerror("Error", f"Failed: {response.status_code} - {response.text}")
-    except json.JSONDecodeError:
-        messagebox.showerror("Error", "Invalid JSON input")
-    except requests.RequestException as e:
-        messagebox.showerror("Error", f"Network error: {str(e)}")
+    data = read_json_input()
+    if data is None:
+        return
+    if "query" not in data:
+        messagebox.showerror("Error", "JSON must include 'query' field")
+        return
+    send_request("DELETE", f"{API_URL}/bulk-delete", data,
+                 success_message=lambda result: f"Bulk delete completed: {result['deleted_count']} properties deleted")
 
 # Buttons Frame with two rows
 button_frame = tk.Frame(main_frame, bg="#f0f0f0")
@@ -359,4 +427,5 @@ tk.Button(button_frame, text="Bulk Update", command=bulk_update_properties, **up
 tk.Button(button_frame, text="Bulk Delete", command=bulk_delete_properties, **delete_style).grid(row=1, column=3, padx=5, pady=5)
 
 # Start the application
-root.mainloop()
\ No newline at end of file
+root.mainloop()
+executor.shutdown()
\ No newline at end of file
@@ -1,134 +1,814 @@
-from flask import Flask, request, jsonify
-from pymongo import MongoClient
+import threading
+import pymongo
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, send_file
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
 from bson import ObjectId
+import image_store
+from address_search import (
+    PREFIX_SORT_SPEC, TEXT_INDEX_KEYS, TEXT_INDEX_OPTIONS, SearchQuery, backfill_address_keys,
+)
+from aggregations import build_report, leading_match, validate_pipeline
+from batch_ops import (
+    BatchEffects, OperationFailed, batch_get_results, batch_ids_filter, check_transaction_result, created_result,
+    deleted_result, error_result, invalid_transaction_error, item_result, parse_batch, parse_batch_ids,
+    unmatched_result, update_selector, updated_result,
+)
+from bulk_ingest import (
+    BulkReport, ChunkBuilder, apply_chunk_result, chunk_models, needs_matching_ids, parse_bulk_delete,
+    parse_bulk_update, parse_chunk_size,
+)
+from change_feed import (
+    SSE_MIMETYPE, ChangeFeed, decode_token, log_entries, logged_change_count, parse_change_filter,
+    parse_feed_source, parse_timeout, wants_event_stream,
+)
+from compression import CompressionMiddleware
+from config import load_config
+from guardrails import AdmissionMiddleware, Limiter, build_limiters, filter_check, parse_allow_scan, validate_filter
+from metrics import (
+    CONTENT_TYPE, CommandMetrics, Metrics, MetricsMiddleware, note_query, note_route, note_waiting,
+)
+from mongo import Mongo
+from property_queries import (
+    PROPERTY_INDEXES, STREAM_BATCH_SIZE, NDJSON_MIMETYPE, ListQuery, build_projection, build_set_update,
+    build_sort_spec, generate_documents, parse_sort, prepare_new_document, summarize_explain, updated_fields,
+    wants_ndjson,
+)
+from query_cache import QueryCache
+from query_shapes import QueryShapeRecorder, index_key_lists
+from serialization import BSONJSONProvider
+from versioning import (
+    CHANGE_COUNTER_FILTER, CHANGE_COUNTER_UPDATE, UPDATED_FIELD, VERSION_PROJECTION, change_count,
+    change_counter_update, if_match_filter, is_not_modified, item_etag, list_etag, pop_version_fields,
+    version_headers, with_version_fields,
+)
 
-# Initialize Flask app
-app = Flask(__name__)
+# Routes, registered on each app built by create_app()
+api = Blueprint('properties', __name__)
 
-# MongoDB connection
-client = MongoClient('mongodb://localhost:27017/')
-db = client['mydb']  # Database name
-collection = db['properties']  # Collection name
+# Everything an app shares between its requests, kept in app.extensions['properties']
+class ServerState:
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.metrics = Metrics(slow_request_ms=config['SLOW_REQUEST_MS'], logger=logger)
+        # Connects on first use, once per process
+        self.mongo = Mongo(config, event_listeners=[CommandMetrics(self.metrics)])
+        # Cache of serialized read responses, invalidated by the write endpoints
+        self.cache = QueryCache(max_entries=config['QUERY_CACHE_MAX_ENTRIES'], ttl=config['QUERY_CACHE_TTL'],
+                                sync_interval=config['QUERY_CACHE_SYNC_MS'] / 1000)
+        # Filter/sort field combinations seen by the query endpoints
+        self.query_shapes = QueryShapeRecorder()
+        self._use_change_log = None
+        self._use_transactions = None
+
+    # Whether the write handlers keep the change log of /properties/changes, decided on first use
+    def use_change_log(self):
+        if self._use_change_log is None:
+            source = parse_feed_source(self.config['CHANGE_FEED_SOURCE'])
+            if source == 'auto':
+                try:
+                    source = 'change_stream' if self.mongo.has_change_streams() else 'log'
+                except Exception as e:  # The log works with any server
+                    self.logger.warning('Could not tell whether the server has change streams: %s', e)
+                    source = 'log'
+            self._use_change_log = source == 'log'
+        return self._use_change_log
+
+    # Whether POST /properties/batch can run in a transaction, decided on first use
+    def use_transactions(self):
+        if self._use_transactions is None:
+            try:
+                self._use_transactions = self.mongo.has_transactions()
+            except Exception as e:
+                self.logger.warning('Could not tell whether the server has transactions: %s', e)
+                self._use_transactions = False
+        return self._use_transactions
+
+    # The change feed of /properties/changes
+    def change_feed(self):
+        log = self.mongo.changes_collection('read') if self.use_change_log() else None
+        return ChangeFeed(self.mongo.collection('read'), self.mongo.meta_collection('read'), log,
+                          self.mongo.max_time_ms('read'))
+
+# Build the Flask app; settings come from config.py, the environment and overrides
+def create_app(overrides=None):
+    app = Flask(__name__)
+    app.json = BSONJSONProvider(app)  # Encodes ObjectId, datetime, Decimal128 ... directly
+    app.config.update(load_config(overrides))
+    app.extensions['properties'] = ServerState(app.config, app.logger)
+    app.register_blueprint(api)
+    # Metrics outside compression, so they count the bytes that travel, and outside admission
+    # control, so they count the requests turned away
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app, app.config['COMPRESSION_MIN_SIZE'],
+                                         app.config['MAX_DECOMPRESSED_BODY_BYTES'])
+    app.wsgi_app = AdmissionMiddleware(app.wsgi_app, build_limiters(app.config, Limiter),
+                                       app.config['ADMISSION_RETRY_AFTER'])
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, app.extensions['properties'].metrics)
+    return app
+
+# Helper function to get the shared state of the current (or given) app
+def get_state(app=None):
+    return (app or current_app).extensions['properties']
+
+# Helper function to get the collection of a route class ("read", "write" or "bulk")
+def get_collection(route_class='read'):
+    return get_state().mongo.collection(route_class)
+
+# Helper function to get the server-side time limit of a route class in milliseconds
+def get_max_time_ms(route_class='read'):
+    return get_state().mongo.max_time_ms(route_class)
+
+# Helper function to get the response cache
+def get_cache():
+    return get_state().cache
+
+# Helper function to serve a stored image file with ETag, Range and caching headers
+def send_image(image_ref, thumbnail, max_age=None):
+    digest = image_ref['hash']
+    if thumbnail:
+        path, mimetype = image_store.thumbnail_path(digest), 'image/jpeg'
+    else:
+        path, mimetype = image_store.image_path(digest), image_ref.get('content_type')
+    response = send_file(path, mimetype=mimetype, etag=digest + ('-thumb' if thumbnail else ''),
+                         conditional=True, max_age=max_age)
+    if max_age:
+        response.cache_control.immutable = True
+    return response
+
+# Helper function to record a write, after it happened: bump the change counter behind the list
+# ETags, and without change streams add the changed documents to the change log.
+# changes is a list of (operation, document id), None when the changed documents are unknown.
+# The write already happened, so a failure here is only logged.
+def note_change(changes, app=None):
+    app = app or current_app
+    state = get_state(app)
+    try:
+        meta = state.mongo.meta_collection('write')
+        if not state.use_change_log():
+            meta.update_one(CHANGE_COUNTER_FILTER, CHANGE_COUNTER_UPDATE, upsert=True)
+            state.cache.note_own_change()
+        elif logged_change_count(changes):
+            count = logged_change_count(changes)
+            counter = meta.find_one_and_update(CHANGE_COUNTER_FILTER, change_counter_update(count), upsert=True,
+                                               return_document=pymongo.ReturnDocument.AFTER)
+            state.cache.note_own_change(count)
+            state.mongo.changes_collection('write').insert_many(log_entries(changes, counter['count'] - count + 1))
+    except PyMongoError as e:
+        app.logger.warning('Could not record the change: %s', e)
+
+# Helper function to read the change counter, before reading the data it versions
+def read_change_count():
+    return change_count(get_state().mongo.meta_collection('read').find_one(
+        CHANGE_COUNTER_FILTER, max_time_ms=get_max_time_ms('read')))
+
+# Helper function to look up a cached response. The change counter is only read once per
+# QUERY_CACHE_SYNC_MS, to notice writes handled by other worker processes.
+def cached_entry(cache, key):
+    if cache.needs_sync():
+        cache.sync(read_change_count())
+    return cache.get(key)
+
+# Helper function to tell the client its copy is still current
+def not_modified(headers):
+    return Response(status=304, headers=headers)
+
+# Helper function to replay a cached response (or 304 if the client already has it)
+def cached_response(entry):
+    if 'ETag' in entry.headers and is_not_modified(request, entry.headers):
+        return not_modified(entry.headers)
+    response = Response(entry.body, mimetype=entry.mimetype, headers=entry.headers)
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+# Helper function to stream chunks to the client and cache the body if it stays small
+def stream_into_cache(cache, key, chunks, seen_ids, mimetype, query, sort_field, generation, headers=None):
+    buffered, size = [], 0
+    for data in chunks:
+        if buffered is not None:
+            size += len(data)
+            if size > cache.max_entry_bytes:
+                buffered = None  # Too big to cache, just keep streaming
+            else:
+                buffered.append(data)
+        yield data
+    if buffered is not None:
+        cache.put(key, b''.join(buffered), mimetype, seen_ids, query=query,
+                  sort_field=sort_field, headers=headers, generation=generation)
+
+# Helper function to find the ids a bulk write is about to touch (only needed while something is
+# cached, or for the change log)
+def matching_ids(collection, cache, query):
+    if not needs_matching_ids(cache, get_state().use_change_log()):
+        return []
+    return [item['_id'] for item in collection.find(query, {'_id': 1}).max_time_ms(get_max_time_ms('bulk'))]
+
+# Helper function to run one operation of /properties/batch, returns its result
+def run_batch_operation(collection, operation, effects, session=None):
+    op, id = operation['op'], operation['id']
+    if op is None:
+        return error_result(id, 400, operation['error'])
+    if op == 'get':
+        projection, added_fields = with_version_fields(operation['projection'])
+        doc = collection.find_one({'_id': operation['_id']}, projection, session=session,
+                                  max_time_ms=get_max_time_ms('read'))
+        return item_result(id, doc, added_fields) if doc else error_result(id, 404, 'Item not found')
+    if op == 'create':
+        collection.insert_one(operation['doc'], session=session)
+        effects.insert(operation['doc'])
+        return created_result(operation)
+    if op == 'update':
+        doc = collection.find_one_and_update(update_selector(operation), operation['update'], VERSION_PROJECTION,
+                                             return_document=pymongo.ReturnDocument.AFTER, session=session)
+        if doc:
+            effects.update(operation)
+            return updated_result(id, doc)
+        exists = 'versions' in operation and collection.find_one({'_id': operation['_id']}, {'_id': 1},
+                                                                 session=session)
+        return unmatched_result(id, bool(exists))
+    result = collection.delete_one({'_id': operation['_id']}, session=session)
+    if result.deleted_count:
+        effects.delete(operation)
+        return deleted_result(id)
+    return unmatched_result(id)
+
+# Helper function to run all operations of /properties/batch in one transaction. The first
+# failing write raises OperationFailed, which rolls back everything before it.
+def run_batch_transaction(collection, operations):
+    def run(session):
+        effects, results = BatchEffects(), []  # Fresh on each attempt, with_transaction retries transient errors
+        for index, operation in enumerate(operations):
+            result = run_batch_operation(collection, operation, effects, session)
+            check_transaction_result(index, operation, result)
+            results.append(result)
+        return effects, results
+
+    with collection.database.client.start_session() as session:
+        return session.with_transaction(run)
+
+# Helper function to send one chunk of /properties/bulk operations to Mongo
+def write_bulk_chunk(collection, cache, chunk, report):
+    if not chunk:
+        return
+    raw = None
+    try:
+        with pymongo.timeout(get_max_time_ms('bulk') / 1000):
+            result = collection.bulk_write(chunk_models(chunk), ordered=False)
+        raw = result.bulk_api_result
+    except BulkWriteError as e:
+        raw = e.details
+    except PyMongoError as e:
+        report.add_chunk_failure(chunk, str(e))
+    note_change(apply_chunk_result(report, cache, chunk, raw))
+
+# Create the configured indexes (create_index is a no-op for indexes that already exist)
+def ensure_indexes(collection):
+    for keys in PROPERTY_INDEXES:
+        collection.create_index(keys)
+    collection.create_index(TEXT_INDEX_KEYS, **TEXT_INDEX_OPTIONS)
+
+# Helper function to list the keys of every index on the collection
+def existing_index_keys(collection):
+    return index_key_lists(collection.index_information())
+
+# Build the indexes suggested by the recorded query shapes
+def build_suggested_indexes(app):
+    state = get_state(app)
+    collection = state.mongo.collection('write')
+    min_count = state.config['INDEX_SUGGESTION_MIN_COUNT']
+    for suggestion in state.query_shapes.suggest(existing_index_keys(collection), min_count):
+        name = collection.create_index(suggestion['keys'])
+        app.logger.info('Built index %s for %d recorded queries', name, suggestion['count'])
+
+# Helper function to count a query shape, log new ones and build indexes if enabled
+def record_query_shape(route, query, sort_field=None):
+    state = get_state()
+    note_query(query)
+    shape = state.query_shapes.observe(route, query, sort_field, current_app.logger)
+    if state.config['AUTO_BUILD_INDEXES'] and shape.count == state.config['INDEX_SUGGESTION_MIN_COUNT']:
+        threading.Thread(target=build_suggested_indexes, args=(current_app._get_current_object(),),
+                         daemon=True).start()
+
+# Helper function to get the most documents an unpaged read returns, None = no limit
+def get_result_limit():
+    return get_state().config['MAX_RESULT_DOCUMENTS'] or None
+
+# Helper function to build the check of bulk write filters against the indexes (see guardrails.py),
+# ?allow_scan=true turns it off
+def bulk_filter_check(collection):
+    allow_scan = parse_allow_scan(request.args.get('allow_scan'))
+    return filter_check([] if allow_scan else existing_index_keys(collection), allow_scan)
+
+# Helper function shared by the list endpoints: stream everything (up to MAX_RESULT_DOCUMENTS), or return one page
+def respond_with_properties(query):
+    collection = get_collection('read')
+    cache = get_cache()
+    list_query = ListQuery(query, request.args)
+    record_query_shape(request.url_rule.rule, query, (list_query.sort_field, list_query.direction))
+
+    ndjson = wants_ndjson(request.accept_mimetypes)
+    mimetype = NDJSON_MIMETYPE if ndjson else 'application/json'
+    key = cache.make_key('properties', query, sorted(request.args.items(multi=True)), ndjson)
+    entry = cached_entry(cache, key)
+    if entry:
+        return cached_response(entry)
+
+    # Nothing changed since the client's copy: answer without running the query
+    headers = version_headers(list_etag(read_change_count(), key))
+    if is_not_modified(request, headers):
+        return not_modified(headers)
+
+    generation = cache.generation
+    seen_ids = []
+    cursor = collection.find(list_query.page_query, list_query.projection) \
+        .sort(list_query.sort_spec).batch_size(STREAM_BATCH_SIZE).max_time_ms(get_max_time_ms('read'))
+    if list_query.limit is None:
+        result_limit = get_result_limit()
+        if result_limit:
+            cursor = cursor.limit(result_limit)
+            headers['X-Result-Limit'] = str(result_limit)
+        chunks = generate_documents(cursor, ndjson, seen_ids)
+        response = Response(stream_into_cache(cache, key, chunks, seen_ids, mimetype, query,
+                                              list_query.sort_field, generation, headers),
+                            mimetype=mimetype, headers=headers)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    # Fetch one extra document to know whether there is a next page
+    page, next_cursor, extra_id = list_query.split_page(list(cursor.limit(list_query.limit + 1)))
+    if next_cursor:
+        seen_ids.append(extra_id)  # Deleting it changes whether there is a next page
+        headers['X-Next-Cursor'] = next_cursor
+    body = b''.join(generate_documents(page, ndjson, seen_ids))
+    cache.put(key, body, mimetype, seen_ids, query=query, sort_field=list_query.sort_field,
+              headers=headers, generation=generation)
+    response = Response(body, mimetype=mimetype, headers=headers)
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+# Label the request metrics with the URL rule, e.g. /properties/<id>
+@api.before_app_request
+def label_request_metrics():
+    if request.url_rule:
+        note_route(request.url_rule.rule)
+
+# Helper function shared by the aggregate endpoints: run a pipeline and stream its results
+def respond_with_aggregate(pipeline):
+    record_query_shape(request.url_rule.rule, leading_match(pipeline))
+    ndjson = wants_ndjson(request.accept_mimetypes)
+    key = QueryCache.make_key('aggregate', pipeline, sorted(request.args.items(multi=True)), ndjson)
+    headers = version_headers(list_etag(read_change_count(), key))
+    if is_not_modified(request, headers):
+        return not_modified(headers)
+    result_limit = get_result_limit()
+    if result_limit:
+        pipeline = pipeline + [{'$limit': result_limit}]
+        headers['X-Result-Limit'] = str(result_limit)
+    cursor = get_collection('read').aggregate(pipeline, allowDiskUse=True, maxTimeMS=get_max_time_ms('read'),
+                                              batchSize=STREAM_BATCH_SIZE)
+    return Response(generate_documents(cursor, ndjson), mimetype=NDJSON_MIMETYPE if ndjson else 'application/json',
+                    headers=headers)
 
 # CREATE - Add new item (updated to support bulk)
-@app.route('/properties', methods=['POST'])
+@api.route('/properties', methods=['POST'])
 def create_item():
     try:
+        collection = get_collection('write')
+        cache = get_cache()
         data = request.get_json()
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
         if isinstance(data, list):  # Handle bulk create
+            for item in data:
+                prepare_new_document(item)
             result = collection.insert_many(data)
+            cache.invalidate_inserted(data)
+            note_change([('insert', id) for id in result.inserted_ids])
             return jsonify({'ids': [str(id) for id in result.inserted_ids]}), 201
         else:  # Single create
+            prepare_new_document(data)
             result = collection.insert_one(data)
+            cache.invalidate_inserted([data])
+            note_change([('insert', result.inserted_id)])
             return jsonify({'id': str(result.inserted_id)}), 201
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# CREATE/UPDATE/DELETE - NDJSON stream of mixed operations, written in unordered chunks
+@api.route('/properties/bulk', methods=['POST'])
+def bulk_write_properties():
+    try:
+        collection = get_collection('bulk')
+        cache = get_cache()
+        chunk_size = parse_chunk_size(request.args.get('chunk_size'))
+        report = BulkReport(with_ids=request.args.get('ids') != 'false')
+        builder = ChunkBuilder(chunk_size, report, bulk_filter_check(collection))
+        for line in request.stream:  # Read line by line, the body is never held in memory
+            write_bulk_chunk(collection, cache, builder.add(line), report)
+        write_bulk_chunk(collection, cache, builder.flush(), report)
+        if not report.received:
+            return jsonify({'error': 'No operations provided'}), 400
+        return jsonify(report.to_dict()), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# READ - Get all properties
-@app.route('/properties', methods=['GET'])
+# CREATE/READ/UPDATE/DELETE - Several single-item operations in one request, in a transaction
+# when {"transaction": true} is sent and the deployment has them (see batch_ops.py)
+@api.route('/properties/batch', methods=['POST'])
+def batch_properties():
+    try:
+        operations, transaction = parse_batch(request.get_json(silent=True))
+        collection = get_collection('write')
+        transaction = transaction and get_state().use_transactions()
+        if transaction:
+            invalid = invalid_transaction_error(operations)
+            if invalid:
+                return jsonify(invalid), 400
+            effects, results = run_batch_transaction(collection, operations)
+        else:
+            effects, results = BatchEffects(), []
+            for operation in operations:
+                try:
+                    results.append(run_batch_operation(collection, operation, effects))
+                except PyMongoError as e:
+                    results.append(error_result(operation['id'], 500, str(e)))
+        effects.invalidate(get_cache())
+        if effects.changes:
+            note_change(effects.changes)
+        return jsonify({'transaction': transaction, 'results': results}), 200
+    except OperationFailed as e:
+        return jsonify(e.to_dict()), 409
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Get all properties (supports ?limit=, ?after= and ?sort= paging)
+@api.route('/properties', methods=['GET'])
 def get_properties():
     try:
-        properties = list(collection.find())
-        for item in properties:
-            item['_id'] = str(item['_id'])  # Convert ObjectId to string
-        return jsonify(properties), 200
+        return respond_with_properties({})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# READ - Get single item
-@app.route('/properties/<id>', methods=['GET'])
+# READ - Get single item (supports ?fields=, ?exclude= and ?view=, If-None-Match and If-Modified-Since)
+@api.route('/properties/<id>', methods=['GET'])
 def get_item(id):
     try:
-        item = collection.find_one({'_id': ObjectId(id)})
+        cache = get_cache()
+        projection = build_projection(request.args, 'full')
+        key = cache.make_key('item', id, projection)
+        entry = cached_entry(cache, key)
+        if entry:
+            return cached_response(entry)
+
+        generation = cache.generation
+        projection, added_fields = with_version_fields(projection)
+        item = get_collection('read').find_one({'_id': ObjectId(id)}, projection,
+                                               max_time_ms=get_max_time_ms('read'))
         if item:
-            item['_id'] = str(item['_id'])
-            return jsonify(item), 200
+            headers = pop_version_fields(item, added_fields)
+            response = jsonify(item)
+            response.headers.update(headers)
+            cache.put(key, response.get_data(), response.mimetype, [item['_id']], headers=headers,
+                      generation=generation)
+            if is_not_modified(request, headers):
+                return not_modified(headers)
+            response.headers['X-Cache'] = 'MISS'
+            return response, 200
         return jsonify({'error': 'Item not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Get several items by id with one query, in request order (supports ?fields=, ?exclude= and ?view=)
+@api.route('/properties/batch-get', methods=['POST'])
+def batch_get_items():
+    try:
+        ids = parse_batch_ids(request.get_json(silent=True))
+        projection, added_fields = with_version_fields(build_projection(request.args, 'full'))
+        cursor = get_collection('read').find(batch_ids_filter(ids), projection).max_time_ms(get_max_time_ms('read'))
+        return jsonify({'results': batch_get_results(ids, cursor, added_fields)}), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# READ - Get properties by query
-@app.route('/properties/query', methods=['GET'])
+# READ - Get the image of a single item as raw bytes (?size=thumbnail for 250x250)
+@api.route('/properties/<id>/image', methods=['GET'])
+def get_item_image(id):
+    try:
+        item = get_collection('read').find_one({'_id': ObjectId(id)}, {'image': 1, 'image_ref': 1},
+                                               max_time_ms=get_max_time_ms('read'))
+        if not item:
+            return jsonify({'error': 'Item not found'}), 404
+        if item.get('image'):  # Old inline base64 image, move it into the image store
+            update = build_set_update({'image': item.pop('image')})
+            get_collection('write').update_one({'_id': item['_id']}, update)
+            get_cache().invalidate_ids([item['_id']], updated_fields(update))
+            note_change([('update', item['_id'])])
+            item['image_ref'] = update['$set']['image_ref']
+        if not item.get('image_ref'):
+            return jsonify({'error': 'Item has no image'}), 404
+        return send_image(item['image_ref'], request.args.get('size') == 'thumbnail')
+    except FileNotFoundError:
+        return jsonify({'error': 'Image not found'}), 404
+    except ValueError as e:  # A legacy inline image that isn't a valid base64 image
+        return jsonify({'error': str(e)}), 422
+    except OSError:  # Stored before images were checked, and not an image
+        return jsonify({'error': 'The stored image can not be read'}), 422
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# UPDATE - Upload raw image bytes for a single item
+@api.route('/properties/<id>/image', methods=['PUT'])
+def upload_item_image(id):
+    try:
+        image_bytes = request.get_data()
+        if not image_bytes:
+            return jsonify({'error': 'No image data provided'}), 400
+        image_ref = image_store.store_image(image_bytes)
+        update = build_set_update({'image_ref': image_ref})
+        result = get_collection('write').update_one({'_id': ObjectId(id)}, update)
+        get_cache().invalidate_ids([id], updated_fields(update))
+        if result.matched_count:
+            note_change([('update', ObjectId(id))])
+            return jsonify({'message': 'Image stored', 'image_ref': image_ref}), 200
+        return jsonify({'error': 'Item not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Get a stored image by content hash, these never change so they are cached for a year
+@api.route('/images/<digest>', methods=['GET'])
+@api.route('/images/<digest>/<size>', methods=['GET'])
+def get_image(digest, size=None):
+    try:
+        if size not in (None, 'thumbnail'):
+            return jsonify({'error': 'Image not found'}), 404
+        return send_image(image_store.stored_image_ref(digest), size == 'thumbnail', max_age=31536000)
+    except (ValueError, FileNotFoundError):
+        return jsonify({'error': 'Image not found'}), 404
+    except OSError:  # Stored before images were checked, and not an image
+        return jsonify({'error': 'The stored image can not be read'}), 422
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Get properties by query (supports ?limit=, ?after= and ?sort= paging)
+@api.route('/properties/query', methods=['GET'])
 def get_properties_by_query():
     try:
-        query = request.get_json() or {}
-        properties = list(collection.find(query))
-        for item in properties:
-            item['_id'] = str(item['_id'])
-        return jsonify(properties), 200
+        query = validate_filter(request.get_json() or {})
+        return respond_with_properties(query)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Explain how a query would run (same body and ?sort= as /properties/query)
+@api.route('/properties/query/explain', methods=['GET'])
+def explain_query():
+    try:
+        query = validate_filter(request.get_json() or {})
+        sort_field, direction = parse_sort(request.args.get('sort'))
+        cursor = get_collection('read').find(query).sort(build_sort_spec(sort_field, direction))
+        plan = cursor.max_time_ms(get_max_time_ms('read')).explain()
+        return jsonify(summarize_explain(plan)), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Search addresses: ?q=...&mode=text (words in the address or description, best matches first)
+# or mode=prefix (type-ahead, in address order). Pages with ?limit= and ?after= like the lists.
+@api.route('/properties/search', methods=['GET'])
+def search_properties():
+    try:
+        search = SearchQuery(request.args)
+        ndjson = wants_ndjson(request.accept_mimetypes)
+        key = QueryCache.make_key('search', sorted(request.args.items(multi=True)), ndjson)
+        headers = version_headers(list_etag(read_change_count(), key))
+        if is_not_modified(request, headers):
+            return not_modified(headers)
+        collection = get_collection('read')
+        if search.mode == 'prefix':
+            cursor = collection.find(search.prefix_query(), search.projection).sort(PREFIX_SORT_SPEC) \
+                .limit(search.limit + 1).max_time_ms(get_max_time_ms('read'))
+        else:
+            cursor = collection.aggregate(search.text_pipeline(), maxTimeMS=get_max_time_ms('read'))
+        page, next_cursor = search.split_page(list(cursor))
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
+        return Response(b''.join(generate_documents(page, ndjson)),
+                        mimetype=NDJSON_MIMETYPE if ndjson else 'application/json', headers=headers)
+    except (ValueError, OperationFailure) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Query shapes seen so far and the indexes that would serve them
+@api.route('/properties/query/shapes', methods=['GET'])
+def get_query_shapes():
+    try:
+        min_count = request.args.get('min_count', 1, type=int)
+        query_shapes = get_state().query_shapes
+        return jsonify({
+            'shapes': query_shapes.shapes(),
+            'suggested_indexes': query_shapes.suggest(existing_index_keys(get_collection('read')), min_count),
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Run an aggregation pipeline over the properties ($match, $group, $bucket, $sort, $limit, $project)
+@api.route('/properties/aggregate', methods=['GET'])
+def aggregate_properties():
+    try:
+        data = request.get_json() or {}
+        return respond_with_aggregate(validate_pipeline(data.get('pipeline')))
+    except (ValueError, OperationFailure) as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-# UPDATE - Update item
-@app.route('/properties/<id>', methods=['PUT'])
+# READ - Built-in reports: price-histogram, by-rooms, by-condition (optional {"match": {...}} body)
+@api.route('/properties/aggregate/<report>', methods=['GET'])
+def get_report(report):
+    try:
+        data = request.get_json(silent=True) or {}
+        return respond_with_aggregate(build_report(report, request.args, data.get('match')))
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except (ValueError, OperationFailure) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# READ - Follow inserts, updates and deletes after a resume token (?after= or Last-Event-ID), as
+# Server-Sent Events (Accept: text/event-stream) or long-poll JSON. Optional filter like /properties/query.
+@api.route('/properties/changes', methods=['GET'])
+def get_changes():
+    try:
+        feed = get_state().change_feed()
+        query = validate_filter(parse_change_filter(request.get_json(silent=True), request.args))
+        projection = build_projection(request.args, 'summary')
+        token = request.args.get('after') or request.headers.get('Last-Event-ID')
+        decode_token(token, feed.use_log)  # Check it before anything is sent
+        note_waiting()
+        if wants_event_stream(request.accept_mimetypes):
+            return Response(feed.event_stream(token, query, projection), mimetype=SSE_MIMETYPE,
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        if not token:  # Where to start: read this first, then the data
+            return jsonify({'changes': [], 'token': feed.current_token()}), 200
+        changes, token = feed.poll(token, query, projection, parse_timeout(request.args.get('timeout')))
+        return jsonify({'changes': changes, 'token': token}), 200
+    except (ValueError, OperationFailure) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# UPDATE - Update item (If-Match: "<etag>" only updates the version the client has seen)
+@api.route('/properties/<id>', methods=['PUT'])
 def update_item(id):
     try:
         data = request.get_json()
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
-        result = collection.update_one(
-            {'_id': ObjectId(id)},
-            {'$set': data}
-        )
+        selector = {'_id': ObjectId(id)}
+        versions = if_match_filter(request.if_match, id)
+        conditional = versions is not None
+        if conditional:
+            selector.update(versions)
         
-        if result.matched_count:
-            return jsonify({'message': 'Item updated'}), 200
+        update = build_set_update(data)
+        collection = get_collection('write')
+        item = collection.find_one_and_update(selector, update, VERSION_PROJECTION,
+                                              return_document=pymongo.ReturnDocument.AFTER)
+        get_cache().invalidate_ids([id], updated_fields(update))
+        
+        if item:
+            note_change([('update', item['_id'])])
+            response = jsonify({'message': 'Item updated'})
+            response.headers.update(version_headers(item_etag(item), item.get(UPDATED_FIELD)))
+            return response, 200
+        if conditional and collection.find_one({'_id': selector['_id']}, {'_id': 1}):
+            return jsonify({'error': 'Item was changed since it was read, fetch it again'}), 412
         return jsonify({'error': 'Item not found'}), 404
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # UPDATE - Update multiple properties by query
-@app.route('/properties/bulk-update', methods=['PUT'])
+@api.route('/properties/bulk-update', methods=['PUT'])
 def bulk_update_properties():
     try:
-        data = request.get_json()
-        if not data or 'query' not in data or 'update' not in data:
-            return jsonify({'error': 'Must provide "query" and "update" fields'}), 400
+        query, update = parse_bulk_update(request.get_json())
+        record_query_shape('/properties/bulk-update', query)
         
-        query = data['query']
-        update_data = data['update']
-        
-        result = collection.update_many(query, {'$set': update_data})
+        collection = get_collection('bulk')
+        bulk_filter_check(collection)(query)
+        cache = get_cache()
+        ids = matching_ids(collection, cache, query)
+        with pymongo.timeout(get_max_time_ms('bulk') / 1000):
+            result = collection.update_many(query, update)
+        cache.invalidate_ids(ids, updated_fields(update))
+        note_change([('update', id) for id in ids])
         
         return jsonify({
             'matched_count': result.matched_count,
             'modified_count': result.modified_count
         }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # DELETE - Delete item
-@app.route('/properties/<id>', methods=['DELETE'])
+@api.route('/properties/<id>', methods=['DELETE'])
 def delete_item(id):
     try:
-        result = collection.delete_one({'_id': ObjectId(id)})
+        result = get_collection('write').delete_one({'_id': ObjectId(id)})
+        get_cache().invalidate_ids([id])
         if result.deleted_count:
+            note_change([('delete', ObjectId(id))])
             return jsonify({'message': 'Item deleted'}), 200
         return jsonify({'error': 'Item not found'}), 404
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 # DELETE - Delete multiple properties by query
-@app.route('/properties/bulk-delete', methods=['DELETE'])
+@api.route('/properties/bulk-delete', methods=['DELETE'])
 def bulk_delete_properties():
     try:
-        data = request.get_json()
-        if not data or 'query' not in data:
-            return jsonify({'error': 'Must provide "query" field'}), 400
-        
-        query = data['query']
+        query = parse_bulk_delete(request.get_json())
+        record_query_shape('/properties/bulk-delete', query)
         
-        result = collection.delete_many(query)
+        collection = get_collection('bulk')
+        bulk_filter_check(collection)(query)
+        cache = get_cache()
+        ids = matching_ids(collection, cache, query)
+        with pymongo.timeout(get_max_time_ms('bulk') / 1000):
+            result = collection.delete_many(query)
+        cache.invalidate_ids(ids)
+        note_change([('delete', id) for id in ids])
         
         return jsonify({
             'deleted_count': result.deleted_count
         }), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# STATS - Query result cache counters
+@api.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(get_cache().stats()), 200
+
+# STATS - Request and MongoDB metrics in the Prometheus text format
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(get_state().metrics.render(), content_type=CONTENT_TYPE)
+
+# Move any inline base64 images left from older versions into the image store
+def migrate_legacy_images(app):
+    state = get_state(app)
+    if image_store.migrate_legacy_images(state.mongo.collection('bulk'), app.logger):
+        state.cache.clear()
+        note_change(None, app)
+
+# Give older documents the address key of /properties/search
+def backfill_search_keys(app):
+    updated = backfill_address_keys(get_state(app).mongo.collection('bulk'))
+    if updated:
+        app.logger.info('Added the search key to %d properties', updated)
+        note_change(None, app)
+
+# One-off startup work on the database, run once before serving (not once per worker)
+def prepare_database(app):
+    state = get_state(app)
+    ensure_indexes(state.mongo.collection('write'))
+    if state.use_change_log():  # Entries expire after CHANGE_LOG_TTL seconds
+        state.mongo.changes_collection('write').create_index('at',
+                                                             expireAfterSeconds=state.config['CHANGE_LOG_TTL'])
+
+# Work that keeps running in the background of one serving process
+def start_background_tasks(app):
+    threading.Thread(target=migrate_legacy_images, args=(app,), daemon=True).start()
+    threading.Thread(target=backfill_search_keys, args=(app,), daemon=True).start()
+
+# Development server, use serve.py to run several worker processes
 if __name__ == '__main__':
-    app.run(host='localhost', port=5000, debug=True)
\ No newline at end of file
+    app = create_app()
+    prepare_database(app)
+    start_background_tasks(app)
+    app.run(host='localhost', port=5000, debug=True)
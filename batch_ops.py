@@ -0,0 +1,193 @@
+from bson import ObjectId
+from werkzeug.http import unquote_etag
+from property_queries import build_projection, build_set_update, prepare_new_document, updated_fields
+from versioning import item_etag, parse_item_etag, version_filter
+
+# Parsing and bookkeeping for the batch endpoints, shared by both servers:
+#   POST /properties/batch-get   {"ids": ["...", ...]}
+#     One $in query, results in request order, {"status": 404} for ids that don't exist.
+#   POST /properties/batch       {"operations": [...], "transaction": true}
+#     {"op": "get", "id": "...", "fields": "address,price"}   (also "exclude" or "view")
+#     {"op": "create", "data": {...}}
+#     {"op": "update", "id": "...", "data": {...}, "if_match": "<etag>"}
+#     {"op": "delete", "id": "..."}
+#     Runs in a transaction when asked for and the deployment has them (replica sets and
+#     sharded clusters): the first failing operation rolls everything back. Otherwise the
+#     operations run one after the other and each one gets its own result.
+# Each result carries a "status" like the single-item endpoint would answer with.
+
+MAX_BATCH_IDS = 1000
+MAX_BATCH_OPERATIONS = 100
+OPERATIONS = ('get', 'create', 'update', 'delete')
+PROJECTION_KEYS = ('fields', 'exclude', 'view')
+
+# An operation that failed inside a transaction, raised to roll the transaction back
+class OperationFailed(Exception):
+    def __init__(self, index, result):
+        super().__init__(result['error'])
+        self.index = index
+        self.result = result
+
+    # The body of the 409 response
+    def to_dict(self):
+        return {'error': f'Operation {self.index} failed, nothing was written: {self}', 'index': self.index,
+                'result': self.result}
+
+# Helper function to turn an id into an ObjectId, None if it is not one
+def parse_object_id(value):
+    return ObjectId(value) if isinstance(value, str) and ObjectId.is_valid(value) else None
+
+# Read the ids of a batch-get body
+def parse_batch_ids(data):
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        raise ValueError('Must provide "ids", a non-empty list')
+    if len(ids) > MAX_BATCH_IDS:
+        raise ValueError(f'At most {MAX_BATCH_IDS} ids per request')
+    return ids
+
+# Helper function to build the $in filter of a batch-get, invalid ids are left out
+def batch_ids_filter(ids):
+    object_ids = {parse_object_id(id) for id in ids} - {None}
+    return {'_id': {'$in': list(object_ids)}}
+
+# Helper function to build the result of one found item
+def item_result(id, doc, added_fields):
+    item = {key: value for key, value in doc.items() if key not in added_fields}
+    return {'id': id, 'status': 200, 'etag': item_etag(doc), 'item': item}
+
+def error_result(id, status, message):
+    return {'id': id, 'status': status, 'error': message}
+
+def created_result(operation):
+    return {'id': str(operation['doc']['_id']), 'status': 201, 'etag': item_etag(operation['doc'])}
+
+def updated_result(id, doc):
+    return {'id': id, 'status': 200, 'etag': item_etag(doc)}
+
+def deleted_result(id):
+    return {'id': id, 'status': 200}
+
+# Helper function to build the result of an update/delete that matched nothing; 412 when the
+# item is still there in another version than "if_match" asked for
+def unmatched_result(id, exists=False):
+    if exists:
+        return error_result(id, 412, 'Item was changed since it was read, fetch it again')
+    return error_result(id, 404, 'Item not found')
+
+# Helper function to build the filter of an update operation, with the versions of "if_match"
+def update_selector(operation):
+    selector = {'_id': operation['_id']}
+    if 'versions' in operation:
+        selector.update(version_filter(operation['versions']))
+    return selector
+
+# Helper function to roll a transaction back when one of its writes failed
+def check_transaction_result(index, operation, result):
+    if result['status'] >= 400 and operation['op'] != 'get':
+        raise OperationFailed(index, result)
+
+# Helper function to find the first operation of a transaction that could not be parsed,
+# returns the body of the 400 response, None when they are all valid
+def invalid_transaction_error(operations):
+    for index, operation in enumerate(operations):
+        if operation['op'] is None:
+            return {'error': f'Operation {index}: {operation["error"]}', 'index': index}
+    return None
+
+# Build the batch-get results in request order from the documents found
+def batch_get_results(ids, docs, added_fields):
+    found = {str(doc['_id']): doc for doc in docs}
+    results = []
+    for id in ids:
+        if parse_object_id(id) is None:
+            results.append(error_result(id, 400, 'Invalid id'))
+        elif str(id) in found:
+            results.append(item_result(id, found[str(id)], added_fields))
+        else:
+            results.append(error_result(id, 404, 'Item not found'))
+    return results
+
+# Helper function to read the versions of an "if_match" value (one ETag, quoted or not, or a list)
+def parse_if_match(value, id):
+    tags = value if isinstance(value, list) else [value]
+    versions = []
+    for tag in tags:
+        if not isinstance(tag, str):
+            raise ValueError('"if_match" must be an ETag or a list of ETags')
+        tag = unquote_etag(tag)[0] if tag.startswith(('"', 'W/')) else tag
+        version = parse_item_etag(tag, id)
+        if version is not None:
+            versions.append(version)
+    return versions
+
+# Check one operation of a batch and prepare what it writes; raises ValueError
+def parse_operation(item):
+    if not isinstance(item, dict):
+        raise ValueError('Each operation must be a JSON object')
+    op = item.get('op')
+    if op not in OPERATIONS:
+        raise ValueError(f'"op" must be one of {", ".join(OPERATIONS)}')
+    operation = {'op': op, 'id': item.get('id')}
+    if op != 'create':
+        operation['_id'] = parse_object_id(item.get('id'))
+        if operation['_id'] is None:
+            raise ValueError(f'"{op}" needs a valid "id"')
+    if op in ('create', 'update'):
+        data = item.get('data')
+        if not isinstance(data, dict) or not data:
+            raise ValueError(f'"{op}" needs a "data" object')
+        if op == 'create':
+            operation['doc'] = prepare_new_document(dict(data))
+        else:
+            operation['update'] = build_set_update(dict(data))
+            if item.get('if_match') is not None:
+                operation['versions'] = parse_if_match(item['if_match'], item['id'])
+    if op == 'get':
+        operation['projection'] = build_projection({key: item[key] for key in PROJECTION_KEYS if key in item}, 'full')
+    return operation
+
+# Read a batch body; returns the operations and whether a transaction was asked for.
+# A bad operation becomes {"op": None, "id": ..., "error": "..."}, so the others can still run.
+def parse_batch(data):
+    items = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('Must provide "operations", a non-empty list')
+    if len(items) > MAX_BATCH_OPERATIONS:
+        raise ValueError(f'At most {MAX_BATCH_OPERATIONS} operations per request')
+    operations = []
+    for item in items:
+        try:
+            operations.append(parse_operation(item))
+        except ValueError as e:
+            operations.append({'op': None, 'id': item.get('id') if isinstance(item, dict) else None, 'error': str(e)})
+    return operations, bool(data.get('transaction'))
+
+# What a batch wrote, applied to the response cache and the change feed once the batch is
+# done (and its transaction committed)
+class BatchEffects:
+    def __init__(self):
+        self.inserted = []
+        self.updated = []  # (id, changed fields)
+        self.deleted = []
+        self.changes = []
+
+    def insert(self, doc):
+        self.inserted.append(doc)
+        self.changes.append(('insert', doc['_id']))
+
+    def update(self, operation):
+        self.updated.append((operation['_id'], updated_fields(operation['update'])))
+        self.changes.append(('update', operation['_id']))
+
+    def delete(self, operation):
+        self.deleted.append(operation['_id'])
+        self.changes.append(('delete', operation['_id']))
+
+    def invalidate(self, cache):
+        if self.inserted:
+            cache.invalidate_inserted(self.inserted)
+        for id, fields in self.updated:
+            cache.invalidate_ids([id], fields)
+        if self.deleted:
+            cache.invalidate_ids(self.deleted)
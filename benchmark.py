@@ -0,0 +1,290 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Load and latency benchmark for the /properties endpoints.
+#   python benchmark.py                                   (in-memory mongomock, no database needed)
+#   python benchmark.py --mongo-uri mongodb://localhost:27017/ --docs 50000 --images --nested
+#   python benchmark.py --output after.json --compare before.json
+# The server from api_server.py runs in this process on a free port, and every route is
+# driven over HTTP with --concurrency threads. Results are written as JSON so runs on two
+# commits can be compared.
+
+ROUTES = ['create_single', 'create_bulk', 'read_all', 'read_page', 'query', 'get_by_id',
+          'update', 'bulk_update', 'delete', 'bulk_delete']
+CONDITIONS = ['good', 'excellent', 'poor', 'renovated']
+DEMO_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'demo_images', 'house01.jpg')
+
+# Helper function to build one synthetic property document
+def make_property(rng, index, image=None, nested=False):
+    doc = {
+        'address': f'{index} {rng.choice(["Maple St", "Oak Ave", "Good will ave", "Pine Rd"])}',
+        'rooms': rng.randint(1, 6),
+        'price': rng.randrange(100000, 900000, 5000),
+        'condition': rng.choice(CONDITIONS),
+    }
+    if image is not None:
+        doc['image'] = image
+    if nested:
+        doc['gardens'] = [{'location': location, 'size': f'{rng.randint(5, 60)}sqft'}
+                          for location in ('front', 'rear')[:rng.randint(1, 2)]]
+        doc['room_data'] = [{'name': f'Room {number}', 'location': 'first floor',
+                             'length': f'{rng.randint(20, 60) / 10}m', 'width': f'{rng.randint(20, 50) / 10}m',
+                             'room number': number} for number in range(1, doc['rooms'] + 1)]
+    return doc
+
+# Helper function to pick a percentile from sorted values (nearest rank)
+def percentile(values, pct):
+    if not values:
+        return None
+    rank = max(int(round(pct / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+# Helper function to summarize the latencies (seconds) of one route
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    in_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'mean': in_ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50': in_ms(percentile(latencies, 50)),
+            'p95': in_ms(percentile(latencies, 95)),
+            'p99': in_ms(percentile(latencies, 99)),
+            'max': in_ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+# Helper function to get the current commit, so results can be matched to the code they measured
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+# Helper function to compare two result files route by route (ratios > 1 mean "more than before")
+def compare(results, baseline):
+    comparison = {}
+    for route, current in results['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if not before:
+            continue
+        entry = {}
+        if current['throughput_rps'] and before['throughput_rps']:
+            entry['throughput_ratio'] = round(current['throughput_rps'] / before['throughput_rps'], 3)
+        for key in ('p50', 'p95', 'p99'):
+            if current['latency_ms'][key] and before['latency_ms'][key]:
+                entry[f'{key}_ratio'] = round(current['latency_ms'][key] / before['latency_ms'][key], 3)
+        comparison[route] = entry
+    return comparison
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.image = None
+        if args.images:
+            with open(DEMO_IMAGE, 'rb') as f:
+                self.image = base64.b64encode(f.read()).decode('ascii')
+        self.ids = []  # Seeded properties, read and updated by the benchmark
+        self.victims = []  # Seeded properties only used by "delete"
+        self._local = threading.local()
+
+    # Start api_server.py in a background thread on a free port
+    def start_server(self):
+        from werkzeug.serving import make_server
+        import api_server
+
+        overrides = {'MONGO_DB': self.args.db}
+        if self.args.mongo_uri:
+            overrides['MONGO_URI'] = self.args.mongo_uri
+        else:
+            import mongomock
+            mock_client = mongomock.MongoClient()
+            overrides['MONGO_CLIENT_FACTORY'] = lambda uri, **kwargs: mock_client
+        if self.args.no_cache:
+            overrides['QUERY_CACHE_MAX_ENTRIES'] = 0
+        self.app = api_server.create_app(overrides)
+        self.state = api_server.get_state(self.app)
+        api_server.prepare_database(self.app)
+
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)  # No access log line per request
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    # Insert the synthetic properties straight into the collection, as the server would store them
+    def seed(self):
+        import image_store
+
+        collection = self.state.mongo.collection('bulk')
+        image_ref = image_store.store_image(base64.b64decode(self.image)) if self.image else None
+        batch = []
+        total = self.args.docs + self.args.requests + self.args.requests * self.args.bulk_size
+        for index in range(total):
+            doc = make_property(self.rng, index, nested=self.args.nested)
+            if image_ref:
+                doc['image_ref'] = image_ref
+            if index >= self.args.docs + self.args.requests:
+                doc['bench_batch'] = (index - self.args.docs - self.args.requests) // self.args.bulk_size
+            batch.append(doc)
+            if len(batch) >= 1000:
+                collection.insert_many(batch)
+                batch = []
+        if batch:
+            collection.insert_many(batch)
+        self.state.cache.clear()
+
+        ids = [str(item['_id']) for item in collection.find({}, {'_id': 1}).sort('_id', 1)]
+        self.ids = ids[:self.args.docs]
+        self.victims = ids[self.args.docs:self.args.docs + self.args.requests]
+
+    def drop(self):
+        self.state.mongo.client.drop_database(self.args.db)
+        self.state.mongo.close()
+        self.server.shutdown()
+
+    # Helper function to give each worker thread its own keep-alive session
+    def session(self):
+        import requests
+
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    # One request of a route; "i" numbers the requests of a run from 0
+    def request(self, route, i):
+        session, url, rng = self.session(), self.url + '/properties', random.Random(self.args.seed + i)
+        if route == 'create_single':
+            return session.post(url, json=make_property(rng, i, self.image, self.args.nested))
+        if route == 'create_bulk':
+            docs = [make_property(rng, i, self.image, self.args.nested) for _ in range(self.args.bulk_size)]
+            return session.post(url, json=docs)
+        if route == 'read_all':
+            return session.get(url)
+        if route == 'read_page':
+            return session.get(url, params={'limit': 100, 'sort': rng.choice(['price', '-price', '_id'])})
+        if route == 'query':
+            query = {'rooms': rng.randint(1, 6), 'price': {'$lt': rng.randrange(200000, 900000, 50000)}}
+            return session.get(url + '/query', json=query, params={'limit': 100, 'sort': 'price'})
+        if route == 'get_by_id':
+            return session.get(f'{url}/{rng.choice(self.ids)}')
+        if route == 'update':
+            return session.put(f'{url}/{rng.choice(self.ids)}', json={'price': rng.randrange(100000, 900000, 5000)})
+        if route == 'bulk_update':
+            return session.put(url + '/bulk-update', json={
+                'query': {'rooms': rng.randint(1, 6), 'condition': rng.choice(CONDITIONS)},
+                'update': {'price': rng.randrange(100000, 900000, 5000)},
+            })
+        if route == 'delete':
+            return session.delete(f'{url}/{self.victims[i]}')
+        if route == 'bulk_delete':
+            # No index on bench_batch: a scan, as in runs from before the guardrails
+            return session.delete(url + '/bulk-delete', json={'query': {'bench_batch': i}}, params={'allow_scan': 'true'})
+        raise ValueError(f'Unknown route "{route}"')
+
+    # Helper function to time one request, returns (seconds, ok)
+    def timed_request(self, route, i):
+        start = time.perf_counter()
+        try:
+            response = self.request(route, i)
+            response.content  # Streamed responses count until the last byte
+            ok = response.status_code < 400
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    # Run one route "--requests" times at "--concurrency"
+    def run_route(self, route):
+        for i in range(min(self.args.warmup, self.args.requests)):
+            if route not in ('delete', 'bulk_delete'):  # Those can only run once per victim
+                self.timed_request(route, i)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            outcomes = list(pool.map(lambda i: self.timed_request(route, i), range(self.args.requests)))
+        elapsed = time.perf_counter() - start
+        return summarize([seconds for seconds, ok in outcomes if ok],
+                         sum(1 for _, ok in outcomes if not ok), elapsed)
+
+    def run(self):
+        self.start_server()
+        try:
+            self.seed()
+            routes = {}
+            for route in self.args.routes:
+                routes[route] = self.run_route(route)
+                print(f'{route:>14}: {routes[route]["throughput_rps"]} req/s, '
+                      f'p50 {routes[route]["latency_ms"]["p50"]} ms, p99 {routes[route]["latency_ms"]["p99"]} ms, '
+                      f'{routes[route]["errors"]} errors', flush=True)
+        finally:
+            self.drop()
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': platform.python_version(),
+                'backend': 'mongod' if self.args.mongo_uri else 'mongomock',
+                'docs': self.args.docs,
+                'images': self.args.images,
+                'nested': self.args.nested,
+                'concurrency': self.args.concurrency,
+                'requests': self.args.requests,
+                'bulk_size': self.args.bulk_size,
+                'cache': not self.args.no_cache,
+                'seed': self.args.seed,
+            },
+            'routes': routes,
+        }
+
+# Helper function to read --routes
+def parse_routes(value):
+    routes = [route.strip() for route in value.split(',') if route.strip()]
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f'Unknown routes: {", ".join(unknown)} (choose from {", ".join(ROUTES)})')
+    return routes
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the properties API')
+    parser.add_argument('--mongo-uri', help='Use a real MongoDB instead of the in-memory mongomock')
+    parser.add_argument('--db', default=f'benchmark_{os.getpid()}', help='Scratch database, dropped afterwards')
+    parser.add_argument('--docs', type=int, default=2000, help='Properties seeded before the run')
+    parser.add_argument('--images', action='store_true', help='Give every property an image')
+    parser.add_argument('--nested', action='store_true', help='Give every property gardens and room_data')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed requests per route before measuring')
+    parser.add_argument('--bulk-size', type=int, default=20, help='Documents per bulk create/delete')
+    parser.add_argument('--routes', type=parse_routes, default=ROUTES, help='Comma separated subset of routes')
+    parser.add_argument('--no-cache', action='store_true', help='Turn the response cache off')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed, same seed = same data and requests')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    if 'IMAGE_STORE_DIR' not in os.environ:
+        os.environ['IMAGE_STORE_DIR'] = tempfile.mkdtemp(prefix='benchmark_images_')  # Keep ./image_store clean
+
+    results = Benchmark(args).run()
+    if args.compare:
+        with open(args.compare) as f:
+            results['comparison'] = compare(results, json.load(f))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
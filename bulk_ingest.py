@@ -0,0 +1,219 @@
+import json
+from bson import ObjectId
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from guardrails import validate_filter
+from property_queries import build_set_update, prepare_new_document, updated_fields
+
+# Parsing and bookkeeping for POST /properties/bulk. The body is NDJSON, one operation per line:
+#   {"op": "insert", "doc": {...}}
+#   {"op": "update", "_id": "...", "update": {...}}      (or "filter": {...} instead of "_id")
+#   {"op": "upsert", "filter": {...}, "update": {...}}
+#   {"op": "delete", "_id": "..."}
+# Lines are sent to bulk_write in unordered chunks, so one bad line never stops the rest.
+# A "filter" line must be served by an index like bulk-update and bulk-delete (see guardrails.py),
+# otherwise it is reported as an error.
+
+DEFAULT_CHUNK_SIZE = 1000
+MAX_CHUNK_SIZE = 10000
+MAX_REPORTED_ERRORS = 1000  # Errors past this are only counted
+
+# Helper function to read ?chunk_size=
+def parse_chunk_size(value):
+    if value is None:
+        return DEFAULT_CHUNK_SIZE
+    try:
+        chunk_size = int(value)
+    except ValueError:
+        raise ValueError('"chunk_size" must be an integer')
+    if chunk_size < 1 or chunk_size > MAX_CHUNK_SIZE:
+        raise ValueError(f'"chunk_size" must be between 1 and {MAX_CHUNK_SIZE}')
+    return chunk_size
+
+# Read the body of bulk-update: {"query": {...}, "update": {...}}; returns the filter and the update
+def parse_bulk_update(data):
+    if not data or 'query' not in data or 'update' not in data:
+        raise ValueError('Must provide "query" and "update" fields')
+    return validate_filter(data['query']), build_set_update(data['update'])
+
+# Read the body of bulk-delete: {"query": {...}}; returns the filter
+def parse_bulk_delete(data):
+    if not data or 'query' not in data:
+        raise ValueError('Must provide "query" field')
+    return validate_filter(data['query'])
+
+# Helper function to tell whether bulk-update/bulk-delete must look up the ids they are about to
+# touch: for the cached responses, or for the change log
+def needs_matching_ids(cache, use_change_log):
+    return bool(len(cache)) or use_change_log
+
+# Helper function to build the filter of an update/upsert/delete line, check_filter raises
+# ValueError for a filter that must not run
+def match_filter(item, check_filter=None):
+    if '_id' in item:
+        _id = item['_id']
+        return {'_id': ObjectId(_id) if ObjectId.is_valid(_id) else _id}
+    if isinstance(item.get('filter'), dict) and item['filter']:
+        query = validate_filter(item['filter'])
+        if check_filter:
+            check_filter(query)
+        return query
+    raise ValueError('Needs "_id" or a non-empty "filter"')
+
+# Turn one NDJSON line into (write model, info about the operation)
+def parse_operation(line, check_filter=None):
+    try:
+        item = json.loads(line)
+    except ValueError:
+        raise ValueError('Invalid JSON')
+    if not isinstance(item, dict):
+        raise ValueError('Each line must be a JSON object')
+
+    op = item.get('op')
+    if op == 'insert':
+        doc = item.get('doc')
+        if not isinstance(doc, dict) or not doc:
+            raise ValueError('"insert" needs a "doc" object')
+        prepare_new_document(doc)
+        return InsertOne(doc), {'op': op, 'doc': doc}
+    if op in ('update', 'upsert', 'delete'):
+        selector = match_filter(item, check_filter)
+        if op == 'delete':
+            return DeleteOne(selector), {'op': op, 'filter': selector}
+        data = item.get('update')
+        if not isinstance(data, dict) or not data:
+            raise ValueError(f'"{op}" needs an "update" object')
+        update = build_set_update(data)
+        return UpdateOne(selector, update, upsert=op == 'upsert'), \
+            {'op': op, 'filter': selector, 'fields': updated_fields(update)}
+    raise ValueError('"op" must be one of insert, update, upsert, delete')
+
+# Collects per-item results across chunks
+class BulkReport:
+    def __init__(self, with_ids=True):
+        self.with_ids = with_ids
+        self.received = 0
+        self.counts = {'inserted': 0, 'matched': 0, 'modified': 0, 'upserted': 0, 'deleted': 0}
+        self.inserted_ids = {}
+        self.upserted_ids = {}
+        self.errors = []
+        self.error_count = 0
+
+    def add_error(self, index, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'index': index, 'message': message})
+
+    # Merge a bulk_write result (BulkWriteResult.bulk_api_result or BulkWriteError.details)
+    def add_result(self, chunk, raw):
+        self.counts['inserted'] += raw.get('nInserted', 0)
+        self.counts['matched'] += raw.get('nMatched', 0)
+        self.counts['modified'] += raw.get('nModified', 0)
+        self.counts['upserted'] += raw.get('nUpserted', 0)
+        self.counts['deleted'] += raw.get('nRemoved', 0)
+        failed = set()
+        for error in raw.get('writeErrors', []):
+            failed.add(error['index'])
+            self.add_error(chunk[error['index']][0], error.get('errmsg', 'Write failed'))
+        if not self.with_ids:
+            return
+        for upserted in raw.get('upserted', []):
+            self.upserted_ids[chunk[upserted['index']][0]] = str(upserted['_id'])
+        for position, (index, _, info) in enumerate(chunk):
+            if info['op'] == 'insert' and position not in failed:
+                self.inserted_ids[index] = str(info['doc']['_id'])
+
+    # A chunk that failed as a whole (e.g. the connection dropped)
+    def add_chunk_failure(self, chunk, message):
+        for index, _, _ in chunk:
+            self.add_error(index, message)
+
+    def to_dict(self):
+        report = {'received': self.received, 'error_count': self.error_count, 'errors': self.errors}
+        report.update({f'{name}_count': count for name, count in self.counts.items()})
+        if self.with_ids:
+            report['inserted_ids'] = self.inserted_ids
+            report['upserted_ids'] = self.upserted_ids
+        return report
+
+# Groups parsed lines into chunks of (line index, write model, info); bad lines go straight to the report
+class ChunkBuilder:
+    def __init__(self, chunk_size, report, check_filter=None):
+        self.chunk_size = chunk_size
+        self.report = report
+        self.check_filter = check_filter
+        self._chunk = []
+
+    # Add one raw line, returns a full chunk when one is ready
+    def add(self, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace')
+        if not line.strip():
+            return None
+        index = self.report.received
+        self.report.received += 1
+        try:
+            model, info = parse_operation(line, self.check_filter)
+        except Exception as e:
+            self.report.add_error(index, str(e))
+            return None
+        self._chunk.append((index, model, info))
+        if len(self._chunk) >= self.chunk_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        chunk, self._chunk = self._chunk, []
+        return chunk or None
+
+# Helper function to get the write models of a chunk, for bulk_write
+def chunk_models(chunk):
+    return [model for _, model, _ in chunk]
+
+# Apply the bulk_write result of a chunk (None when it failed as a whole) to the report and the
+# cache; returns the changes to record for the change feed (see chunk_changes)
+def apply_chunk_result(report, cache, chunk, raw):
+    if raw is not None:
+        report.add_result(chunk, raw)
+    invalidate_cache(cache, chunk)
+    return chunk_changes(chunk, raw)
+
+# Drop the cached responses a written chunk can change
+def invalidate_cache(cache, chunk):
+    inserted, ids, fields = [], [], set()
+    for _, _, info in chunk:
+        if info['op'] == 'insert':
+            inserted.append(info['doc'])
+        elif info['op'] == 'upsert' or '_id' not in info['filter']:
+            cache.clear()  # Affected ids are unknown without another query
+            return
+        else:
+            ids.append(info['filter']['_id'])
+            fields.update(info.get('fields', []))
+    if inserted:
+        cache.invalidate_inserted(inserted)
+    if ids:
+        cache.invalidate_ids(ids, fields or None)
+
+# Helper function to list the (operation, document id) changes of a written chunk for the
+# change feed from its bulk_write result (None when the chunk failed as a whole). Failed lines
+# are left out. Returns None when some changes are unknown without another query: filter updates,
+# upserts, or _id updates/deletes of which not all matched (the result only counts them).
+def chunk_changes(chunk, raw):
+    if raw is None:
+        return None
+    failed = {error['index'] for error in raw.get('writeErrors', [])}
+    changes = []
+    for position, (_, _, info) in enumerate(chunk):
+        if position in failed:
+            continue
+        if info['op'] == 'insert':
+            changes.append(('insert', info['doc'].get('_id')))
+        elif info['op'] == 'upsert' or '_id' not in info['filter']:
+            return None
+        else:
+            changes.append(('delete' if info['op'] == 'delete' else 'update', info['filter']['_id']))
+    deletes = sum(1 for op, _ in changes if op == 'delete')
+    updates = sum(1 for op, _ in changes if op == 'update')
+    if raw.get('nRemoved', 0) != deletes or raw.get('nMatched', 0) != updates:
+        return None
+    return changes
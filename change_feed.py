@@ -0,0 +1,384 @@
+import asyncio
+import datetime
+import json
+import time
+from contextlib import aclosing, closing, nullcontext
+from pymongo.errors import OperationFailure
+from serialization import dumps
+from versioning import CHANGE_COUNTER_FILTER, change_count, utc_now
+
+# Change feed behind GET /properties/changes. Clients read the collection once, then follow
+# its inserts, updates and deletes instead of reading it again.
+# Changes come from a MongoDB change stream when the server has them (replica sets and
+# sharded clusters). A standalone mongod has none, so there the write handlers keep a
+# change log instead: one entry per changed document, numbered by the change counter of
+# versioning.py, and expired after CHANGE_LOG_TTL seconds.
+# Either way a change only carries the document id; the documents are read in one query
+# per batch, which is also where the client's filter is applied.
+
+SSE_MIMETYPE = 'text/event-stream'
+POLL_INTERVAL = 0.5  # Seconds between reads of the change log, and longest wait on a change stream
+MAX_BATCH = 500  # Changes resolved per query
+HEARTBEAT_INTERVAL = 15  # Seconds of silence before an SSE comment keeps the connection open
+RETRY_MS = 3000  # How long an EventSource waits before reconnecting
+DEFAULT_LONG_POLL_TIMEOUT = 25
+MAX_LONG_POLL_TIMEOUT = 60
+GAP_GRACE = datetime.timedelta(seconds=5)  # How long a missing log number may still be written
+
+# Change stream events that end the stream; clients have to read everything again
+RESET_OPERATIONS = ('drop', 'rename', 'dropDatabase', 'invalidate')
+CHANGE_STREAM_PIPELINE = [
+    {'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete', *RESET_OPERATIONS]}}},
+    {'$project': {'operationType': 1, 'documentKey': 1}},
+]
+
+FEED_SOURCES = ('auto', 'change_stream', 'log')
+LOG_ORDER = [('_id', 1)]
+
+# Helper function to tell from a "hello" reply whether the server has change streams
+def supports_change_streams(hello):
+    return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+
+# Helper function to check CHANGE_FEED_SOURCE; "auto" is decided by asking the server
+def parse_feed_source(source):
+    if source not in FEED_SOURCES:
+        raise ValueError(f'Unknown change feed source "{source}"')
+    return source
+
+# Resume tokens are opaque to clients: "cs-..." for change streams, "log-<number>" for the change log
+def encode_stream_token(resume_token):
+    return f'cs-{resume_token["_data"]}'
+
+def encode_log_token(seq):
+    return f'log-{seq}'
+
+# Helper function to turn a resume token back into a change stream token or log number
+def decode_token(token, use_log):
+    if not token:
+        return None
+    prefix = 'log-' if use_log else 'cs-'
+    value = token[len(prefix):]
+    if not token.startswith(prefix) or not value or (use_log and not value.isdigit()):
+        raise ValueError('Invalid resume token, start again without "after"')
+    return int(value) if use_log else {'_data': value}
+
+# Helper function to read ?timeout= of a long-poll, in seconds
+def parse_timeout(value):
+    if value is None:
+        return DEFAULT_LONG_POLL_TIMEOUT
+    try:
+        timeout = float(value)
+    except ValueError:
+        raise ValueError('"timeout" must be a number of seconds')
+    if timeout < 0 or timeout > MAX_LONG_POLL_TIMEOUT:
+        raise ValueError(f'"timeout" must be between 0 and {MAX_LONG_POLL_TIMEOUT}')
+    return timeout
+
+# Helper function to read the optional filter: the JSON body (same syntax as /properties/query),
+# or ?filter= for clients that can't send a body, like a browser EventSource
+def parse_change_filter(body, args):
+    query = body
+    if query is None and args.get('filter'):
+        try:
+            query = json.loads(args['filter'])
+        except ValueError:
+            raise ValueError('"filter" must be JSON')
+    if query is not None and not isinstance(query, dict):
+        raise ValueError('The filter must be a JSON object')
+    return query or {}
+
+# Helper function to tell whether a client asked for Server-Sent Events; "Accept: */*" gets JSON
+def wants_event_stream(accept_mimetypes):
+    return accept_mimetypes.best_match(['application/json', SSE_MIMETYPE]) == SSE_MIMETYPE
+
+# Helper function to build the change log entries of a write; changes is a list of
+# (operation, document id), or None when the changed documents are unknown
+def log_entries(changes, first_seq, now=None):
+    now = now or utc_now()
+    if changes is None:
+        return [{'_id': first_seq, 'op': 'reset', 'at': now}]
+    return [{'_id': first_seq + index, 'op': op, 'doc_id': doc_id, 'at': now}
+            for index, (op, doc_id) in enumerate(changes)]
+
+# Helper function to tell how many change counter numbers recording a write takes in the
+# change log (one per change, one for a reset), 0 when there is nothing to record
+def logged_change_count(changes):
+    if changes is None:
+        return 1
+    return len(changes)
+
+# Helper function to build the watch() arguments of a change stream, resumed after a token if there is one
+def watch_options(resume_token):
+    options = {'max_await_time_ms': int(POLL_INTERVAL * 1000)}
+    if resume_token:
+        options['resume_after'] = resume_token
+    return options
+
+# Helper function to build the query of the log entries after a number
+def log_query(after):
+    return {'_id': {'$gt': after}}
+
+# Helper function to tell whether the entries after a number have expired from the log, given its oldest entry
+def log_expired(oldest, after):
+    return oldest is not None and oldest['_id'] > after + 1
+
+# Helper function to build the batch that tells a client to read everything again
+def reset_batch(token):
+    return [('reset', None, token)], token
+
+# Helper function to turn a change stream event into (operation, document id, token)
+def stream_event(change):
+    op = change['operationType']
+    token = encode_stream_token(change['_id'])
+    if op in RESET_OPERATIONS:
+        return 'reset', None, token
+    return ('update' if op == 'replace' else op), change['documentKey']['_id'], token
+
+# Helper function to add a change stream event to a batch, returns whether the batch is complete
+def add_stream_event(events, change):
+    events.append(stream_event(change))
+    return stream_ended(events) or len(events) >= MAX_BATCH
+
+# Helper function to tell whether a batch ends with the end of the stream
+def stream_ended(events):
+    return bool(events) and events[-1][0] == 'reset'
+
+# Helper function to take the log entries that can be handed out, in order, as
+# (operation, document id, token). A gap means a writer has reserved a number and not
+# written its entry yet, so reading stops there unless the gap is older than GAP_GRACE.
+def read_log_entries(entries, after, now=None):
+    now = now or utc_now()
+    events = []
+    for entry in entries:
+        written = entry['at'] if entry['at'].tzinfo else entry['at'].replace(tzinfo=datetime.timezone.utc)
+        if entry['_id'] != after + 1 and now - written < GAP_GRACE:
+            break
+        after = entry['_id']
+        events.append((entry['op'], entry.get('doc_id'), encode_log_token(after)))
+    return events, after
+
+# Helper function to build the changes sent to the client from the raw changes and the
+# documents found for them. Inserted/updated documents that no longer exist or no longer
+# match the filter are sent as deletes, so a client can drop them from its view.
+def resolve_events(raw_events, docs):
+    events = []
+    for op, doc_id, token in raw_events:
+        if op == 'reset':
+            events.append({'op': 'reset', 'token': token})
+        elif op == 'delete' or doc_id not in docs:
+            events.append({'op': 'delete', 'id': doc_id, 'token': token})
+        else:
+            events.append({'op': op, 'id': doc_id, 'doc': docs[doc_id], 'token': token})
+    return events
+
+# Helper function to build the query that reads the changed documents of a batch
+def changed_documents_query(raw_events, query):
+    ids = list({doc_id for op, doc_id, _ in raw_events if op in ('insert', 'update')})
+    if not ids:
+        return None
+    selector = {'_id': {'$in': ids}}
+    return {'$and': [selector, query]} if query else selector
+
+# Helper function to format one change as a Server-Sent Event
+def format_sse(event):
+    return f'id: {event["token"]}\n'.encode('utf-8') + b'data: ' + dumps(event) + b'\n\n'
+
+# First bytes of an event stream: the reconnect delay and where a reconnect resumes
+def sse_preamble(token):
+    return f'retry: {RETRY_MS}\nid: {token}\n\n'.encode('utf-8')
+
+SSE_HEARTBEAT = b': keep-alive\n\n'
+
+# Turns the batches of an event stream into the bytes to send: the events, or a heartbeat
+# after HEARTBEAT_INTERVAL of silence
+class EventStreamWriter:
+    def __init__(self):
+        self.last_sent = time.monotonic()
+
+    # The bytes to send for a batch of changes, None when there is nothing to send yet
+    def write(self, events):
+        if events:
+            data = b''.join(format_sse(event) for event in events)
+        elif time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+            data = SSE_HEARTBEAT
+        else:
+            return None
+        self.last_sent = time.monotonic()
+        return data
+
+# Change feed of the Flask server (api_server.py)
+class ChangeFeed:
+    def __init__(self, collection, meta, log=None, max_time_ms=None):
+        self.collection = collection  # The properties collection
+        self.meta = meta  # Holds the change counter
+        self.log = log  # The change log, None to read a change stream instead
+        self.max_time_ms = max_time_ms
+
+    @property
+    def use_log(self):
+        return self.log is not None
+
+    def _change_count(self):
+        return change_count(self.meta.find_one(CHANGE_COUNTER_FILTER))
+
+    # Token of the current end of the feed, read it before reading the data it follows
+    def current_token(self):
+        if self.use_log:
+            return encode_log_token(self._change_count())
+        with self.collection.watch(CHANGE_STREAM_PIPELINE) as stream:
+            return encode_stream_token(stream.resume_token)
+
+    # Yield (raw changes, token) about every POLL_INTERVAL, an empty list while nothing changes
+    def batches(self, token):
+        position = decode_token(token, self.use_log)
+        if self.use_log:
+            return self._log_batches(position)
+        return self._stream_batches(position)
+
+    def _stream_batches(self, resume_token):
+        while True:
+            try:
+                with self.collection.watch(CHANGE_STREAM_PIPELINE, **watch_options(resume_token)) as stream:
+                    while True:
+                        events = []
+                        change = stream.try_next()
+                        while change is not None and not add_stream_event(events, change):
+                            change = stream.try_next()
+                        resume_token = stream.resume_token
+                        yield events, encode_stream_token(resume_token)
+                        if stream_ended(events):
+                            break
+                resume_token = None  # Follow the new collection from now
+            except OperationFailure:
+                if resume_token is None:
+                    raise
+                resume_token = None  # Can't resume (e.g. the oplog has moved on), start again from now
+                yield reset_batch(self.current_token())
+
+    def _log_batches(self, after):
+        if after is None:
+            after = self._change_count()
+        elif log_expired(self.log.find_one({}, sort=LOG_ORDER), after):
+            after = self._change_count()
+            yield reset_batch(encode_log_token(after))
+        while True:
+            entries = list(self.log.find(log_query(after)).sort(LOG_ORDER).limit(MAX_BATCH))
+            events, after = read_log_entries(entries, after)
+            yield events, encode_log_token(after)
+            if len(events) < MAX_BATCH:
+                time.sleep(POLL_INTERVAL)
+
+    # Read the documents of a batch of raw changes and build the changes sent to the client
+    def resolve(self, raw_events, query=None, projection=None):
+        selector = changed_documents_query(raw_events, query)
+        docs = {}
+        if selector is not None:
+            cursor = self.collection.find(selector, projection)
+            if self.max_time_ms:
+                cursor = cursor.max_time_ms(self.max_time_ms)
+            docs = {doc['_id']: doc for doc in cursor}
+        return resolve_events(raw_events, docs)
+
+    # Long-poll: wait up to timeout seconds for changes after a token
+    def poll(self, token, query=None, projection=None, timeout=DEFAULT_LONG_POLL_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        with closing(self.batches(token)) as batches:
+            for raw_events, token in batches:
+                events = self.resolve(raw_events, query, projection)
+                if events or time.monotonic() >= deadline:
+                    return events, token
+
+    # Server-Sent Events: follow the feed until the client goes away
+    def event_stream(self, token, query=None, projection=None):
+        token = token or self.current_token()
+        yield sse_preamble(token)
+        writer = EventStreamWriter()
+        with closing(self.batches(token)) as batches:
+            for raw_events, token in batches:
+                data = writer.write(self.resolve(raw_events, query, projection))
+                if data:
+                    yield data
+
+# Change feed of the async server (api_server_async.py): the same reads on PyMongo's asyncio
+# driver. slots limits the database operations in flight, a change stream doesn't hold one.
+class AsyncChangeFeed(ChangeFeed):
+    def __init__(self, collection, meta, log=None, max_time_ms=None, slots=None):
+        super().__init__(collection, meta, log, max_time_ms)
+        self.slots = slots or nullcontext()
+
+    async def _change_count(self):
+        async with self.slots:
+            return change_count(await self.meta.find_one(CHANGE_COUNTER_FILTER, max_time_ms=self.max_time_ms))
+
+    async def current_token(self):
+        if self.use_log:
+            return encode_log_token(await self._change_count())
+        async with await self.collection.watch(CHANGE_STREAM_PIPELINE) as stream:
+            return encode_stream_token(stream.resume_token)
+
+    async def _stream_batches(self, resume_token):
+        while True:
+            try:
+                async with await self.collection.watch(CHANGE_STREAM_PIPELINE,
+                                                       **watch_options(resume_token)) as stream:
+                    while True:
+                        events = []
+                        change = await stream.try_next()
+                        while change is not None and not add_stream_event(events, change):
+                            change = await stream.try_next()
+                        resume_token = stream.resume_token
+                        yield events, encode_stream_token(resume_token)
+                        if stream_ended(events):
+                            break
+                resume_token = None  # Follow the new collection from now
+            except OperationFailure:
+                if resume_token is None:
+                    raise
+                resume_token = None  # Can't resume (e.g. the oplog has moved on), start again from now
+                yield reset_batch(await self.current_token())
+
+    async def _log_batches(self, after):
+        if after is None:
+            after = await self._change_count()
+        else:
+            async with self.slots:
+                oldest = await self.log.find_one({}, sort=LOG_ORDER)
+            if log_expired(oldest, after):
+                after = await self._change_count()
+                yield reset_batch(encode_log_token(after))
+        while True:
+            async with self.slots:
+                entries = await self.log.find(log_query(after)).sort(LOG_ORDER).limit(MAX_BATCH).to_list()
+            events, after = read_log_entries(entries, after)
+            yield events, encode_log_token(after)
+            if len(events) < MAX_BATCH:
+                await asyncio.sleep(POLL_INTERVAL)
+
+    async def resolve(self, raw_events, query=None, projection=None):
+        selector = changed_documents_query(raw_events, query)
+        docs = {}
+        if selector is not None:
+            cursor = self.collection.find(selector, projection)
+            if self.max_time_ms:
+                cursor = cursor.max_time_ms(self.max_time_ms)
+            async with self.slots:
+                docs = {doc['_id']: doc for doc in await cursor.to_list()}
+        return resolve_events(raw_events, docs)
+
+    async def poll(self, token, query=None, projection=None, timeout=DEFAULT_LONG_POLL_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        async with aclosing(self.batches(token)) as batches:
+            async for raw_events, token in batches:
+                events = await self.resolve(raw_events, query, projection)
+                if events or time.monotonic() >= deadline:
+                    return events, token
+
+    async def event_stream(self, token, query=None, projection=None):
+        token = token or await self.current_token()
+        yield sse_preamble(token)
+        writer = EventStreamWriter()
+        async with aclosing(self.batches(token)) as batches:
+            async for raw_events, token in batches:
+                data = writer.write(await self.resolve(raw_events, query, projection))
+                if data:
+                    yield data
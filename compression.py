@@ -0,0 +1,361 @@
+import json
+import tempfile
+import zlib
+from werkzeug.http import parse_accept_header
+
+# HTTP compression for both servers (api_server.py, api_server_async.py), as WSGI and ASGI
+# middleware. Responses are compressed with the best encoding the client accepts: zstd and
+# brotli when their modules are installed (pip install zstandard brotli), gzip always.
+# Streamed responses (pages, NDJSON, aggregations) are compressed chunk by chunk and
+# flushed every FLUSH_BYTES of data, so the client still gets the first documents early
+# without every small chunk becoming its own compressed block.
+# Request bodies sent with "Content-Encoding: gzip" are unpacked before the app sees them,
+# up to MAX_DECOMPRESSED_BODY_BYTES, so a small upload can't expand into a huge one.
+# The ETag of a compressed response stays the one of the data, so If-None-Match and
+# If-Match work whatever the encoding; "Vary: Accept-Encoding" keeps shared caches apart.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+BROTLI_QUALITY = 5  # Higher qualities are too slow for responses built on every request
+SPOOL_BYTES = 1024 * 1024  # Unpacked request bodies larger than this go to a temporary file
+READ_SIZE = 64 * 1024
+FLUSH_BYTES = 32 * 1024  # Uncompressed bytes of a streamed response between two flushes
+
+# Content types worth compressing; images are compressed already, event streams must not wait
+COMPRESSIBLE_TYPES = {'application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/csv'}
+
+# Encodings the server can send, preferred first when the client accepts several equally
+RESPONSE_ENCODINGS = [name for name, available in (('zstd', zstandard), ('br', brotli), ('gzip', True)) if available]
+
+# Raised while unpacking a request body that is too large (413) or broken (400)
+class BodyTooLarge(Exception):
+    pass
+
+class BadBody(Exception):
+    pass
+
+# Helper function to pick the response encoding from an Accept-Encoding header, None = identity
+def choose_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(RESPONSE_ENCODINGS)
+
+# Streaming compressor with the same three calls for every encoding
+class Encoder:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif encoding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._unflushed = 0
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    # Everything compressed so far, without ending the stream
+    def flush(self):
+        if self.encoding == 'zstd':
+            return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == 'br':
+            return self._compressor.flush()
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    # Compress a chunk of a streamed body, flushing once FLUSH_BYTES came in since the last flush
+    def compress_chunk(self, data):
+        self._unflushed += len(data)
+        if self._unflushed < FLUSH_BYTES:
+            return self.compress(data)
+        self._unflushed = 0
+        return self.compress(data) + self.flush()
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+    # Compress a whole body at once
+    def compress_all(self, data):
+        return self.compress(data) + self.finish()
+
+# Helper function to decide whether a response should be compressed, given its status and
+# headers as (name, value) pairs. Returns (compress, vary): vary is True for content types
+# that are compressed for some clients, they need "Vary: Accept-Encoding" either way.
+def should_compress(method, status, headers, min_size):
+    headers = {name.lower(): value for name, value in headers}
+    content_type = headers.get('content-type', '').split(';', 1)[0].strip().lower()
+    if content_type not in COMPRESSIBLE_TYPES:
+        return False, False
+    if method == 'HEAD' or not 200 <= status < 300 or status in (204, 206) or 'content-encoding' in headers:
+        return False, True
+    length = headers.get('content-length')
+    return length is None or not length.isdigit() or int(length) >= min_size, True
+
+# Helper function to add the headers of a compressed response (or only Vary) to a header list
+def encoded_headers(headers, encoding=None):
+    result = []
+    vary = None
+    for name, value in headers:
+        lower = name.lower()
+        if lower == 'vary':
+            vary = value
+        elif not (encoding and lower == 'content-length'):  # The length changes, or isn't known yet
+            result.append((name, value))
+    if vary and 'accept-encoding' not in vary.lower():
+        vary = f'{vary}, Accept-Encoding'
+    result.append(('Vary', vary or 'Accept-Encoding'))
+    if encoding:
+        result.append(('Content-Encoding', encoding))
+    return result
+
+# Unpacks a gzip request body into a (spooled) temporary file, at most max_bytes of it
+class BodyDecoder:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def feed(self, data):
+        try:
+            while data and not self._decompressor.eof:
+                # Never unpack more than the limit allows, however well the input compresses
+                chunk = self._decompressor.decompress(data, self.max_bytes - self.size + 1)
+                self.size += len(chunk)
+                if self.size > self.max_bytes:
+                    raise BodyTooLarge(f'The unpacked request body is larger than {self.max_bytes} bytes')
+                self.file.write(chunk)
+                data = self._decompressor.unconsumed_tail
+        except zlib.error as e:
+            raise BadBody(f'Invalid gzip request body: {e}')
+
+    # Rewind the unpacked body for reading, raises BadBody if the gzip stream was cut off
+    def finish(self):
+        if not self._decompressor.eof:
+            raise BadBody('Invalid gzip request body: it ends early')
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+# Helper function to check the Content-Encoding of a request, returns the error message if
+# the body can't be unpacked
+def unsupported_encoding(content_encoding):
+    if content_encoding.strip().lower() != 'gzip':
+        return f'Unsupported Content-Encoding "{content_encoding}", send gzip or no encoding'
+    return None
+
+# Helper function to build a JSON error body like the routes return
+def error_body(message):
+    return json.dumps({'error': message}).encode('utf-8')
+
+# WSGI middleware for the Flask server
+class CompressionMiddleware:
+    def __init__(self, app, min_size, max_body_bytes):
+        self.app = app
+        self.min_size = min_size  # Responses smaller than this are sent as they are
+        self.max_body_bytes = max_body_bytes
+
+    def __call__(self, environ, start_response):
+        decoder = None
+        if environ.get('HTTP_CONTENT_ENCODING'):
+            decoder, error = self._unpack_body(environ)
+            if error:
+                status, message = error
+                body = error_body(message)
+                start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+                return [body]
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        encoders = []
+
+        def compress_start(status, headers, exc_info=None):
+            compress, vary = should_compress(environ.get('REQUEST_METHOD'), int(status.split(' ', 1)[0]), headers,
+                                             self.min_size)
+            if compress and encoding:
+                encoders.append(Encoder(encoding))
+                headers = encoded_headers(headers, encoding)
+            elif vary:
+                headers = encoded_headers(headers)
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.app(environ, compress_start)
+        except Exception:
+            if decoder:
+                decoder.close()
+            raise
+        if not encoders and not decoder:
+            return body  # Untouched, file responses keep their wsgi.file_wrapper
+        return self._stream(body, encoders, decoder)
+
+    # Replace a gzip request body by the unpacked one; returns (decoder, None) or (None, (status, message))
+    def _unpack_body(self, environ):
+        error = unsupported_encoding(environ['HTTP_CONTENT_ENCODING'])
+        if error:
+            return None, ('415 Unsupported Media Type', error)
+        decoder = BodyDecoder(self.max_body_bytes)
+        stream = environ['wsgi.input']
+        remaining = int(environ.get('CONTENT_LENGTH') or 0) or None  # None = read to the end (chunked)
+        try:
+            while remaining is None or remaining > 0:
+                data = stream.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                decoder.feed(data)
+            environ['wsgi.input'] = decoder.finish()
+        except BodyTooLarge as e:
+            decoder.close()
+            return None, ('413 Request Entity Too Large', str(e))
+        except BadBody as e:
+            decoder.close()
+            return None, ('400 Bad Request', str(e))
+        environ['CONTENT_LENGTH'] = str(decoder.size)
+        del environ['HTTP_CONTENT_ENCODING']
+        return decoder, None
+
+    def _stream(self, body, encoders, decoder):
+        encoder = encoders[0] if encoders else None
+        try:
+            for chunk in body:
+                if encoder is None:
+                    yield chunk
+                elif chunk:
+                    data = encoder.compress_chunk(chunk)
+                    if data:
+                        yield data
+            if encoder is not None:
+                yield encoder.finish()
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            if decoder:
+                decoder.close()
+
+# ASGI middleware for the async server
+class CompressionASGIMiddleware:
+    def __init__(self, app, min_size, max_body_bytes):
+        self.app = app
+        self.min_size = min_size  # Responses smaller than this are sent as they are
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = {name.lower(): value for name, value in scope.get('headers') or []}
+        decoder = None
+        if headers.get(b'content-encoding'):
+            decoder, error = await self._unpack_body(headers[b'content-encoding'].decode('latin-1'), receive)
+            if error:
+                status, message = error
+                body = error_body(message)
+                await send({'type': 'http.response.start', 'status': status, 'headers': [
+                    (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+                await send({'type': 'http.response.body', 'body': body})
+                return
+            scope = dict(scope, headers=[
+                (name, value) for name, value in scope['headers'] if name.lower() not in (
+                    b'content-encoding', b'content-length')] + [(b'content-length', str(decoder.size).encode())])
+            receive = self._replay(decoder, receive)
+        encoding = choose_encoding(headers.get(b'accept-encoding', b'').decode('latin-1'))
+        state = {'start': None, 'encoder': None}
+
+        async def compress_send(message):
+            if message['type'] == 'http.response.start':
+                state['start'] = message  # Sent with the first body chunk, when the size may be known
+                return
+            if message['type'] != 'http.response.body':
+                return await send(message)
+            if state['start'] is None:
+                return await self._send_body(message, state['encoder'], send)
+            start, state['start'] = state['start'], None
+            response_headers = [(name.decode('latin-1'), value.decode('latin-1')) for name, value in start['headers']]
+            if not message.get('more_body') and not any(name.lower() == 'content-length'
+                                                        for name, _ in response_headers):
+                response_headers.append(('Content-Length', str(len(message.get('body', b'')))))
+            compress, vary = should_compress(scope.get('method'), start['status'], response_headers, self.min_size)
+            if compress and encoding:
+                state['encoder'] = Encoder(encoding)
+                response_headers = encoded_headers(response_headers, encoding)
+                if not message.get('more_body'):  # The whole body is here, send it with its length
+                    body = state['encoder'].compress_all(message.get('body', b''))
+                    response_headers.append(('Content-Length', str(len(body))))
+                    await send(dict(start, headers=self._raw_headers(response_headers)))
+                    return await send(dict(message, body=body))
+            elif vary:
+                response_headers = encoded_headers(response_headers)
+            await send(dict(start, headers=self._raw_headers(response_headers)))
+            await self._send_body(message, state['encoder'], send)
+
+        try:
+            await self.app(scope, receive, compress_send)
+        finally:
+            if decoder:
+                decoder.close()
+
+    @staticmethod
+    def _raw_headers(headers):
+        return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    @staticmethod
+    async def _send_body(message, encoder, send):
+        if encoder is None:
+            return await send(message)
+        body = message.get('body', b'')
+        data = encoder.compress_chunk(body) if body else b''
+        if not message.get('more_body'):
+            data += encoder.finish()
+        elif not data:
+            return  # Nothing to send until the next flush
+        await send(dict(message, body=data))
+
+    # Read and unpack the whole request body; returns (decoder, None) or (None, (status, message))
+    async def _unpack_body(self, content_encoding, receive):
+        error = unsupported_encoding(content_encoding)
+        if error:
+            return None, (415, error)
+        decoder = BodyDecoder(self.max_body_bytes)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise BadBody('The client went away while sending the request body')
+                decoder.feed(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            decoder.finish()
+        except BodyTooLarge as e:
+            decoder.close()
+            return None, (413, str(e))
+        except BadBody as e:
+            decoder.close()
+            return None, (400, str(e))
+        return decoder, None
+
+    # Hand the unpacked body to the app in READ_SIZE pieces, then pass on what the client sends
+    @staticmethod
+    def _replay(decoder, receive):
+        done = []
+
+        async def replay():
+            if done:
+                return await receive()
+            data = decoder.file.read(READ_SIZE)
+            if len(data) < READ_SIZE:
+                done.append(True)
+            return {'type': 'http.request', 'body': data, 'more_body': not done}
+        return replay
@@ -0,0 +1,81 @@
+import os
+
+# Server settings. Every key can be overridden with an environment variable of the
+# same name, e.g. MONGO_URI=mongodb://db1:27017/ MONGO_MAX_POOL_SIZE=200 python api_server.py
+DEFAULTS = {
+    # Where the data lives
+    'MONGO_URI': 'mongodb://localhost:27017/',
+    'MONGO_DB': 'mydb',
+    'MONGO_COLLECTION': 'properties',
+    'MONGO_META_COLLECTION': 'properties_meta',  # Change counter behind the list ETags (see versioning.py)
+    'MONGO_CHANGES_COLLECTION': 'properties_changes',  # Change log, only used without change streams
+
+    # Connection pool, per worker process
+    'MONGO_MAX_POOL_SIZE': 100,
+    'MONGO_MIN_POOL_SIZE': 10,  # Opened by the warm-up so the first requests don't pay for it
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 5000,
+    'MONGO_CONNECT_TIMEOUT_MS': 5000,
+
+    # Per route class: "read" (GET endpoints), "write" (single item changes),
+    # "bulk" (bulk-update, bulk-delete, /properties/bulk)
+    'MONGO_READ_PREFERENCE': 'primary',  # primary, primaryPreferred, secondary, secondaryPreferred, nearest
+    'MONGO_MAX_TIME_MS': 10000,  # Server-side limit for each read
+    'MONGO_WRITE_CONCERN': '1',  # A number of nodes or "majority"
+    'MONGO_WRITE_TIMEOUT_MS': 10000,
+    'MONGO_BULK_WRITE_CONCERN': '1',
+    'MONGO_BULK_MAX_TIME_MS': 60000,
+
+    # Create the indexes and run the one-off migrations when the async server starts. serve.py
+    # turns this off in its workers and runs them once for all of them.
+    'RUN_STARTUP_TASKS': True,
+
+    # Response cache (see query_cache.py)
+    'QUERY_CACHE_MAX_ENTRIES': 1024,
+    'QUERY_CACHE_TTL': 30,
+    'QUERY_CACHE_SYNC_MS': 1000,  # How often a worker reads the change counter to notice writes of other workers
+
+    # Index suggestions (see query_shapes.py)
+    'AUTO_BUILD_INDEXES': False,  # Build suggested indexes by itself once a query shape is common
+    'INDEX_SUGGESTION_MIN_COUNT': 100,  # How often a shape must be seen before it is worth an index
+
+    # Change feed, /properties/changes (see change_feed.py)
+    'CHANGE_FEED_SOURCE': 'auto',  # change_stream, log, or auto = change streams when the server has them
+    'CHANGE_LOG_TTL': 86400,  # Seconds the change log keeps an entry, older resume tokens start over
+
+    # HTTP compression (see compression.py)
+    'COMPRESSION_MIN_SIZE': 1024,  # Responses smaller than this many bytes are sent uncompressed
+    'MAX_DECOMPRESSED_BODY_BYTES': 256 * 1024 * 1024,  # Largest gzip request body after unpacking
+    'REQUEST_BODY_TIMEOUT': 600,  # Seconds the async server waits for a whole request body, 0 = no limit
+
+    # Guardrails (see guardrails.py), 0 = no limit
+    'MAX_RESULT_DOCUMENTS': 10000,  # Most documents an unpaged list or an aggregation returns
+    'MAX_CONCURRENT_READ': 64,  # Requests of a route class running at once, per worker process
+    'MAX_CONCURRENT_WRITE': 32,
+    'MAX_CONCURRENT_BULK': 4,
+    'ADMISSION_QUEUE_SIZE': 64,  # Requests that may wait for a slot, per route class; more get 429
+    'ADMISSION_QUEUE_TIMEOUT_MS': 2000,  # Longest wait for a slot before 503
+    'ADMISSION_RETRY_AFTER': 1,  # Seconds, sent in Retry-After with 429 and 503
+
+    # Metrics (see metrics.py)
+    'SLOW_REQUEST_MS': 1000,  # Requests slower than this are logged with their query shape, 0 = off
+}
+
+# Helper function to convert an environment variable to the type of its default
+def _convert(value, default):
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    return value
+
+# Build the settings from the defaults, the environment and explicit overrides (highest wins).
+# Overrides may also set MONGO_CLIENT_FACTORY, a callable used instead of MongoClient
+# (e.g. mongomock.MongoClient for benchmarks without a database server), and
+# ASYNC_MONGO_CLIENT_FACTORY, used instead of AsyncMongoClient by the async server.
+def load_config(overrides=None):
+    config = {}
+    for key, default in DEFAULTS.items():
+        value = os.environ.get(key)
+        config[key] = default if value is None else _convert(value, default)
+    config.update(overrides or {})
+    return config
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import re
+import threading
+from query_shapes import classify_fields
+
+# Guardrails for client-supplied filters and admission control, shared by both servers
+# (api_server.py, api_server_async.py).
+# - Filters may only use the operators in ALLOWED_OPERATORS. Server-side JavaScript ($where,
+#   $function), $expr and unanchored regexes are refused, since nothing can stop them from
+#   scanning the whole collection.
+# - Unpaged lists and aggregations return at most MAX_RESULT_DOCUMENTS documents, and every
+#   read carries maxTimeMS (see mongo.max_time_ms).
+# - bulk-update and bulk-delete need a filter an index can serve, unless ?allow_scan=true.
+# - Each route class ("read", "write", "bulk") runs at most MAX_CONCURRENT_<CLASS> requests at
+#   once per worker process. A few more may wait for a slot; the rest are turned away with 429,
+#   or 503 once they have waited ADMISSION_QUEUE_TIMEOUT_MS, both with Retry-After.
+
+ALLOWED_OPERATORS = {
+    '$and', '$or', '$nor', '$not',
+    '$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin',
+    '$exists', '$type', '$all', '$elemMatch', '$size', '$regex', '$options',
+}
+MAX_FILTER_DEPTH = 10
+MAX_LIST_VALUES = 1000  # Longest $in/$nin/$all/$or list
+MAX_REGEX_LENGTH = 200
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+
+# An anchored regex starts with a literal character (or an escaped one), so an index narrows it down
+ANCHORED_REGEX = re.compile(r'\^(?:[^.\[\](){}*+?|\\^$]|\\.)')
+
+# Requests that are never queued: long-lived ones (long-poll, event streams) would hold a slot
+# for minutes, and the stats must answer while the server is overloaded
+UNLIMITED_PATHS = {'/properties/changes', '/metrics', '/cache/stats'}
+BULK_PATHS = {'/properties/bulk', '/properties/bulk-update', '/properties/bulk-delete'}
+READ_PATHS = {'/properties/batch-get'}  # POST, but only reads
+
+# Helper function to check one regex of a filter
+def check_regex(pattern):
+    if not isinstance(pattern, str):
+        raise ValueError('"$regex" must be a string')
+    if len(pattern) > MAX_REGEX_LENGTH:
+        raise ValueError(f'"$regex" may be at most {MAX_REGEX_LENGTH} characters long')
+    if not ANCHORED_REGEX.match(pattern):
+        raise ValueError('"$regex" must be a prefix match starting with "^" and a literal character, e.g. "^12 Ma"')
+
+# Helper function to walk a filter and check its operators
+def _check_value(value, depth):
+    if depth > MAX_FILTER_DEPTH:
+        raise ValueError(f'The filter may be nested at most {MAX_FILTER_DEPTH} levels deep')
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key.startswith('$'):
+                if key not in ALLOWED_OPERATORS:
+                    raise ValueError(f'Operator "{key}" is not allowed, use one of {", ".join(sorted(ALLOWED_OPERATORS))}')
+                if key == '$regex':
+                    check_regex(item)
+                elif key in LOGICAL_OPERATORS and (not isinstance(item, list) or not item
+                                                   or not all(isinstance(clause, dict) for clause in item)):
+                    raise ValueError(f'"{key}" must be a non-empty list of filters')
+            _check_value(item, depth + 1)
+    elif isinstance(value, list):
+        if len(value) > MAX_LIST_VALUES:
+            raise ValueError(f'Lists in a filter may have at most {MAX_LIST_VALUES} values')
+        for item in value:
+            _check_value(item, depth + 1)
+
+# Check a client supplied filter, raises ValueError when it is not allowed
+def validate_filter(query):
+    if not isinstance(query, dict):
+        raise ValueError('The filter must be a JSON object')
+    _check_value(query, 0)
+    return query
+
+# Helper function to tell whether an index can narrow down a filter: one of its equality or
+# range fields must lead an index (_id always has one)
+def is_index_backed(query, index_keys):
+    equality, ranges, indexable = classify_fields(query)
+    fields = equality | ranges
+    if not indexable or not fields:
+        return False
+    return '_id' in fields or any(keys and keys[0][0] in fields for keys in index_keys)
+
+# Check the filter of a bulk update/delete, raises ValueError unless an index serves it or the
+# client asked for a collection scan
+def require_index_backed(query, index_keys, allow_scan):
+    if allow_scan:
+        return
+    if not query:
+        raise ValueError('An empty filter matches every property, add ?allow_scan=true if that is intended')
+    if not is_index_backed(query, index_keys):
+        raise ValueError('No index serves this filter, so it would scan the whole collection. '
+                         'Filter on an indexed field or add ?allow_scan=true')
+
+# Helper function to build the check of bulk write filters, given the keys of the collection's indexes
+def filter_check(index_keys, allow_scan):
+    return lambda query: require_index_backed(query, index_keys, allow_scan)
+
+# Helper function to read ?allow_scan=
+def parse_allow_scan(value):
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+# Helper function to tell which limiter a request goes through, None = not limited
+def route_class(method, path):
+    path = path.rstrip('/') or '/'
+    if path in UNLIMITED_PATHS:
+        return None
+    if path in BULK_PATHS:
+        return 'bulk'
+    if method in ('GET', 'HEAD', 'OPTIONS') or path in READ_PATHS:
+        return 'read'
+    return 'write'
+
+# Helper function to build the limiters of every route class from the settings (0 = no limit)
+def build_limiters(config, limiter_class):
+    limiters = {}
+    for name in ('read', 'write', 'bulk'):
+        limit = config[f'MAX_CONCURRENT_{name.upper()}']
+        if limit:
+            limiters[name] = limiter_class(limit, config['ADMISSION_QUEUE_SIZE'],
+                                           config['ADMISSION_QUEUE_TIMEOUT_MS'] / 1000)
+    return limiters
+
+# Helper function to build the answer to a request that was turned away
+def shed_response(status, retry_after):
+    if status == 429:
+        message = 'Too many requests are waiting, try again later'
+    else:
+        message = 'The server is busy, try again later'
+    body = json.dumps({'error': message}).encode('utf-8')
+    headers = [('Content-Type', 'application/json'), ('Content-Length', str(len(body))),
+               ('Retry-After', str(retry_after))]
+    return body, headers
+
+# Admission control for threads (Flask server)
+class Limiter:
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    # Take a slot; returns None when admitted, or the status to turn the request away with
+    def acquire(self):
+        with self._condition:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return None
+            if self.waiting >= self.queue_size:
+                return 429
+            self.waiting += 1
+            try:
+                if not self._condition.wait_for(lambda: self.active < self.limit, self.timeout):
+                    return 503
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return None
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+# Admission control for the event loop (async server)
+class AsyncLimiter:
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = None  # Created on first use, inside the server's event loop
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                return None
+            if self.waiting >= self.queue_size:
+                return 429
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._condition.wait_for(lambda: self.active < self.limit), self.timeout)
+            except asyncio.TimeoutError:
+                return 503
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return None
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+# WSGI middleware for the Flask server
+class AdmissionMiddleware:
+    def __init__(self, app, limiters, retry_after):
+        self.app = app
+        self.limiters = limiters
+        self.retry_after = retry_after
+
+    def __call__(self, environ, start_response):
+        limiter = self.limiters.get(route_class(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO', '')))
+        if limiter is None:
+            return self.app(environ, start_response)
+        status = limiter.acquire()
+        if status:
+            body, headers = shed_response(status, self.retry_after)
+            start_response('429 Too Many Requests' if status == 429 else '503 Service Unavailable', headers)
+            return [body]
+        try:
+            body = self.app(environ, start_response)
+        except Exception:
+            limiter.release()
+            raise
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            limiter.release()  # Files are sent by the server without touching the database
+            return body
+        return self._release_after(body, limiter)
+
+    # Streamed bodies keep their slot until the last chunk is sent, they still read from Mongo
+    @staticmethod
+    def _release_after(body, limiter):
+        try:
+            yield from body
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            limiter.release()
+
+# ASGI middleware for the async server
+class AdmissionASGIMiddleware:
+    def __init__(self, app, limiters, retry_after):
+        self.app = app
+        self.limiters = limiters
+        self.retry_after = retry_after
+
+    async def __call__(self, scope, receive, send):
+        limiter = None
+        if scope['type'] == 'http':
+            limiter = self.limiters.get(route_class(scope.get('method'), scope.get('path', '')))
+        if limiter is None:
+            return await self.app(scope, receive, send)
+        status = await limiter.acquire()
+        if status:
+            body, headers = shed_response(status, self.retry_after)
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await limiter.release()
@@ -0,0 +1,110 @@
+import io
+from collections import OrderedDict
+from PIL import Image, ImageTk
+
+# Thumbnail pipeline for the Tk client (api_client.py). Images are downloaded and decoded
+# on the RequestExecutor's worker threads, and the finished Tk images are kept in an LRU
+# cache keyed by (property id, image hash), so clicking a property again shows it at once.
+# Selecting a row starts the download before the click is even finished.
+
+POPUP_SIZE = (250, 250)  # Size the popup shows, same as the server thumbnails
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+# Helper function to decode image bytes to the popup size, runs on a worker thread
+def decode_image(data, size=POPUP_SIZE):
+    img = Image.open(io.BytesIO(data))
+    if img.format == 'JPEG':
+        img.draft('RGB', size)  # Let the JPEG decoder scale down, the full bitmap is never built
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+    if img.size != size:
+        img = img.resize(size, Image.Resampling.LANCZOS)
+    img.load()
+    return img
+
+# A finished download + decode, handed to the Tk thread
+class DecodedImage:
+    def __init__(self, image=None, image_hash=None, error=None):
+        self.image = image
+        self.image_hash = image_hash
+        self.error = error
+
+class ImagePipeline:
+    def __init__(self, executor, api_url, max_bytes=DEFAULT_MAX_BYTES):
+        self.executor = executor
+        self.api_url = api_url
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()  # (property id, image hash) -> ImageTk.PhotoImage
+        self._sizes = {}
+        self._size = 0
+        self._waiting = {}  # property id -> callbacks waiting for its image
+        self._hashes = {}  # property id -> hash of its latest image, when known
+
+    # Start loading an image in the background, e.g. when its row is selected
+    def prefetch(self, property_id, image_hash=None):
+        self.get(property_id, image_hash, None)
+
+    # Call on_ready(photo, error) on the Tk thread with the image of a property
+    def get(self, property_id, image_hash=None, on_ready=None):
+        image_hash = image_hash or self._hashes.get(property_id)
+        photo = self._lookup(property_id, image_hash) if image_hash else None
+        if photo is not None:
+            if on_ready:
+                on_ready(photo, None)
+            return
+        callbacks = self._waiting.get(property_id)
+        if callbacks is not None:  # Already loading
+            if on_ready:
+                callbacks.append(on_ready)
+            return
+        self._waiting[property_id] = [on_ready] if on_ready else []
+        self.executor.run(f'image-{property_id}', lambda: self._download(property_id),
+                          lambda result: self._finish(property_id, result))
+
+    # Runs on a worker thread
+    def _download(self, property_id):
+        result = self.executor.request('GET', f'{self.api_url}/{property_id}/image', params={'size': 'thumbnail'})
+        if not result.ok:
+            return DecodedImage(error=result.error or f'{result.status_code} - {result.text}')
+        try:
+            etag = (result.headers.get('ETag') or '').removeprefix('W/').strip('"')
+            image_hash = etag.replace('-thumb', '') or None
+            return DecodedImage(decode_image(result.content), image_hash)
+        except Exception as e:
+            return DecodedImage(error=f'Error loading image: {str(e)}')
+
+    # Runs on the Tk thread, PhotoImage must be created there
+    def _finish(self, property_id, result):
+        callbacks = self._waiting.pop(property_id, [])
+        photo = None
+        if result.error is None:
+            photo = ImageTk.PhotoImage(result.image)
+            if result.image_hash:
+                self._hashes[property_id] = result.image_hash
+                self._store((property_id, result.image_hash), photo, result.image.width * result.image.height * 4)
+        for callback in callbacks:
+            callback(photo, result.error)
+
+    def _lookup(self, property_id, image_hash):
+        photo = self._cache.get((property_id, image_hash))
+        if photo is not None:
+            self._cache.move_to_end((property_id, image_hash))
+        return photo
+
+    def _store(self, key, photo, size):
+        if key in self._cache:
+            self._size -= self._sizes.pop(key)
+            del self._cache[key]
+        self._cache[key] = photo
+        self._sizes[key] = size
+        self._size += size
+        while self._size > self.max_bytes and len(self._cache) > 1:
+            oldest, _ = self._cache.popitem(last=False)
+            self._size -= self._sizes.pop(oldest)
+
+    # Forget a property's image, e.g. after a new one was uploaded
+    def forget(self, property_id):
+        self._hashes.pop(property_id, None)
+        for key in [key for key in self._cache if key[0] == property_id]:
+            self._size -= self._sizes.pop(key)
+            del self._cache[key]
@@ -0,0 +1,125 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+from PIL import Image
+from versioning import bump_version
+
+# Images are kept as plain files named by the SHA-256 of their bytes, so the same
+# picture uploaded for many properties is stored only once
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', './image_store')
+THUMBNAIL_SIZE = (250, 250)  # Same size the client UI shows in its popup
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+LEGACY_IMAGE_QUERY = {'image': {'$type': 'string'}}  # Documents from before the store, with a base64 image
+
+# Helper function to work out the content type of image bytes
+def sniff_image_type(data):
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+# Helper function to map a content hash to its file, refusing anything that is not a hash
+def image_path(digest, suffix=''):
+    if not DIGEST_PATTERN.match(digest):
+        raise ValueError('Invalid image hash')
+    return os.path.join(IMAGE_STORE_DIR, digest[:2], digest + suffix)
+
+# Helper function to build the reference of a stored image from its file, raises FileNotFoundError
+# when nothing is stored under the hash
+def stored_image_ref(digest):
+    with open(image_path(digest), 'rb') as f:
+        return {'hash': digest, 'content_type': sniff_image_type(f.read(16))}
+
+# Helper function to write a file atomically so readers never see half an image
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# Helper function to build the 250x250 JPEG thumbnail for an image, raises OSError when the
+# bytes are not an image PIL can read
+def _make_thumbnail(data):
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft('RGB', THUMBNAIL_SIZE)  # Lets JPEG decode at reduced size
+        img = img.convert('RGB').resize(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    except Image.DecompressionBombError as e:
+        raise OSError(str(e))
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=85)
+    return out.getvalue()
+
+# Store raw image bytes and return the reference kept in the property document.
+# Raises ValueError when the bytes are not an image, nothing is stored then.
+def store_image(data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = image_path(digest)
+    thumbnail = image_path(digest, THUMBNAIL_SUFFIX)
+    thumbnail_data = None
+    if not os.path.exists(thumbnail):  # Otherwise it was checked when first stored
+        try:
+            thumbnail_data = _make_thumbnail(data)
+        except OSError:
+            raise ValueError('The image data is not an image that can be read')
+    if not os.path.exists(path):
+        _write_file(path, data)
+    if thumbnail_data is not None:
+        _write_file(thumbnail, thumbnail_data)
+    return {'hash': digest, 'content_type': sniff_image_type(data), 'length': len(data)}
+
+# Return the thumbnail file for a stored image, building it if it is missing. Raises OSError
+# for an image missing from the store (FileNotFoundError) or stored before images were checked
+# and not readable.
+def thumbnail_path(digest):
+    path = image_path(digest, THUMBNAIL_SUFFIX)
+    if not os.path.exists(path):
+        with open(image_path(digest), 'rb') as f:
+            _write_file(path, _make_thumbnail(f.read()))
+    return path
+
+# Helper function to decode a base64 image, raises ValueError when it isn't valid base64
+# (line breaks are allowed, anything else outside the base64 alphabet is not)
+def decode_image(value):
+    try:
+        return base64.b64decode(''.join(value.split()), validate=True)
+    except binascii.Error:
+        raise ValueError('"image" must be a base64 encoded image')
+
+# Move an inline base64 "image" field of a document (or $set data) into the store
+def migrate_document_image(doc):
+    if isinstance(doc, dict) and isinstance(doc.get('image'), str) and doc['image']:
+        doc['image_ref'] = store_image(decode_image(doc.pop('image')))
+    return doc
+
+# Move every inline base64 image left in the collection into the store. Documents whose image
+# can't be decoded keep it and are logged.
+def migrate_legacy_images(collection, logger=None):
+    migrated = 0
+    for item in collection.find(LEGACY_IMAGE_QUERY, {'image': 1}):
+        try:
+            update = legacy_image_update(item)
+        except ValueError as e:
+            if logger:
+                logger.warning('Skipped the image of property %s: %s', item['_id'], e)
+            continue
+        collection.update_one({'_id': item['_id']}, update)
+        migrated += 1
+    return migrated
+
+# Helper function to build the update that moves the inline image of a document into the store,
+# raises ValueError when the image can't be decoded
+def legacy_image_update(item):
+    image_ref = store_image(decode_image(item['image']))
+    return bump_version({'$set': {'image_ref': image_ref}, '$unset': {'image': ''}})
@@ -0,0 +1,288 @@
+import contextvars
+import threading
+import time
+from pymongo import monitoring
+from query_shapes import normalize_query
+
+# Request and MongoDB metrics in the Prometheus text format, served on GET /metrics.
+# Every request is split into phases:
+#   db        - time spent in MongoDB commands (measured by the command listener)
+#   serialize - the rest of the time the server spends building the response
+#   send      - time spent handing the body to the client
+# Metrics live in each process, so with several workers every worker reports its own.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# The timing of the request being handled, set by the middleware for the whole request
+current_request = contextvars.ContextVar('current_request', default=None)
+
+# Helper function to escape a label value for the text format
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Helper function to render a label set, e.g. {route="/properties",method="GET"}
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.label_names, labels)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._values = {}  # labels -> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, [("le", bound)])} {count}')
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, [("le", "+Inf")])} {series[-1]}')
+                lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {series[-2]}')
+                lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {series[-1]}')
+        return lines
+
+# Everything measured about one request
+class RequestTiming:
+    def __init__(self, method, request_size):
+        self.method = method
+        self.route = 'unmatched'  # The URL rule, so /properties/<id> is one series and not one per id
+        self.status = '500'
+        self.request_size = request_size
+        self.response_size = 0
+        self.query_shape = None
+        self.waits = False  # Waits for something on purpose (long-poll, event stream), never slow
+        self.started = time.perf_counter()
+        self.compute = 0.0  # Time spent in the app, db included
+        self.db = 0.0
+        self.send = 0.0
+        self.commands = 0
+
+    def phases(self):
+        return {'db': self.db, 'serialize': max(self.compute - self.db, 0.0), 'send': self.send}
+
+# Helper function to label the current request with its URL rule
+def note_route(route):
+    timing = current_request.get()
+    if timing is not None and route:
+        timing.route = route
+
+# Helper function to remember the filter of the current request for the slow-request log
+def note_query(query):
+    timing = current_request.get()
+    if timing is not None:
+        timing.query_shape = normalize_query(query)
+
+# Helper function to keep a request that waits on purpose out of the slow-request log
+def note_waiting():
+    timing = current_request.get()
+    if timing is not None:
+        timing.waits = True
+
+# Helper function to read a Content-Length header (0 when missing, e.g. chunked uploads)
+def _content_length(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+# Helper function to count the documents a command reply carries
+def documents_returned(reply):
+    cursor = reply.get('cursor') if isinstance(reply, dict) else None
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or [])
+    return 0
+
+class Metrics:
+    def __init__(self, slow_request_ms=None, logger=None):
+        self.slow_request_ms = slow_request_ms
+        self.logger = logger
+        self.requests = Counter('http_requests_total', 'Requests handled', ('route', 'method', 'status'))
+        self.latency = Histogram('http_request_duration_seconds', 'Time from request to last byte sent',
+                                 ('route', 'method'))
+        self.phases = Histogram('http_request_phase_seconds', 'Time per request phase (db, serialize, send)',
+                                ('route', 'phase'))
+        self.request_size = Histogram('http_request_size_bytes', 'Request body size', ('route',), SIZE_BUCKETS)
+        self.response_size = Histogram('http_response_size_bytes', 'Response body size', ('route',), SIZE_BUCKETS)
+        self.command_latency = Histogram('mongo_command_duration_seconds', 'MongoDB command round trip time',
+                                         ('command',))
+        self.command_documents = Histogram('mongo_command_documents_returned', 'Documents returned per command',
+                                           ('command',), COUNT_BUCKETS)
+        self.command_failures = Counter('mongo_command_failures_total', 'MongoDB commands that failed',
+                                        ('command',))
+        self._all = [self.requests, self.latency, self.phases, self.request_size, self.response_size,
+                     self.command_latency, self.command_documents, self.command_failures]
+
+    # Record a finished request and log it if it was slow
+    def finish(self, timing):
+        total = time.perf_counter() - timing.started
+        self.requests.inc((timing.route, timing.method, timing.status))
+        self.latency.observe((timing.route, timing.method), total)
+        phases = timing.phases()
+        for phase, seconds in phases.items():
+            self.phases.observe((timing.route, phase), seconds)
+        self.request_size.observe((timing.route,), timing.request_size)
+        self.response_size.observe((timing.route,), timing.response_size)
+        if self.slow_request_ms and self.logger and not timing.waits and total * 1000 >= self.slow_request_ms:
+            self.logger.warning(
+                'Slow request %s %s -> %s in %.1f ms (db %.1f ms in %d commands, serialize %.1f ms, '
+                'send %.1f ms, %d bytes) query shape %s',
+                timing.method, timing.route, timing.status, total * 1000, phases['db'] * 1000, timing.commands,
+                phases['serialize'] * 1000, phases['send'] * 1000, timing.response_size, timing.query_shape,
+            )
+
+    def render(self):
+        lines = []
+        for metric in self._all:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+# Records every MongoDB command, register with MongoClient(event_listeners=[...])
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        self.metrics.command_latency.observe((event.command_name,), seconds)
+        self.metrics.command_documents.observe((event.command_name,), documents_returned(event.reply))
+        self._add_to_request(seconds)
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1e6
+        self.metrics.command_latency.observe((event.command_name,), seconds)
+        self.metrics.command_failures.inc((event.command_name,))
+        self._add_to_request(seconds)
+
+    def _add_to_request(self, seconds):
+        timing = current_request.get()
+        if timing is not None:
+            timing.db += seconds
+            timing.commands += 1
+
+# WSGI middleware for the Flask server, sees the whole request including a streamed body
+class MetricsMiddleware:
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        timing = RequestTiming(environ.get('REQUEST_METHOD'), _content_length(environ.get('CONTENT_LENGTH')))
+        current_request.set(timing)
+        response_headers = {}
+
+        def record_start(status, headers, exc_info=None):
+            timing.status = status.split(' ', 1)[0]
+            response_headers.update((name.lower(), value) for name, value in headers)
+            return start_response(status, headers, exc_info)
+
+        start = time.perf_counter()
+        try:
+            body = self.app(environ, record_start)
+        except Exception:
+            current_request.set(None)
+            self.metrics.finish(timing)
+            raise
+        finally:
+            timing.compute += time.perf_counter() - start
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Leave files to the server (it may use sendfile), their size is in the headers
+            timing.response_size = _content_length(response_headers.get('content-length'))
+            current_request.set(None)
+            self.metrics.finish(timing)
+            return body
+        return self._stream(body, timing)
+
+    def _stream(self, body, timing):
+        iterator = iter(body)
+        try:
+            while True:
+                current_request.set(timing)  # Streamed bodies run more commands (getMore)
+                start = time.perf_counter()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    timing.compute += time.perf_counter() - start
+                timing.response_size += len(chunk)
+                start = time.perf_counter()
+                yield chunk
+                timing.send += time.perf_counter() - start
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            current_request.set(None)
+            self.metrics.finish(timing)
+
+# ASGI middleware for the async server
+class MetricsASGIMiddleware:
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get('headers') or [])
+        timing = RequestTiming(scope.get('method'), _content_length(headers.get(b'content-length')))
+        current_request.set(timing)
+
+        async def record_send(message):
+            if message['type'] == 'http.response.start':
+                timing.status = str(message['status'])
+            elif message['type'] == 'http.response.body':
+                timing.response_size += len(message.get('body', b''))
+                start = time.perf_counter()
+                await send(message)
+                timing.send += time.perf_counter() - start
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, receive, record_send)
+        finally:
+            timing.compute = time.perf_counter() - timing.started - timing.send
+            current_request.set(None)
+            self.metrics.finish(timing)
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import AsyncMongoClient, MongoClient, ReadPreference
+from pymongo.write_concern import WriteConcern
+from change_feed import supports_change_streams
+
+# MongoDB connection of both servers, built from config.py settings. The Flask server
+# (api_server.py) creates the client on first use in each process, so a pre-fork server
+# (gunicorn, serve.py) never shares one client and its sockets between worker processes.
+# The async server (api_server_async.py) opens it on the event loop that serves its requests.
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+# Route classes and the settings they use, see config.py
+ROUTE_CLASSES = ('read', 'write', 'bulk')
+
+# Helper function to build the keyword arguments of MongoClient/AsyncMongoClient
+def client_options(config):
+    return {
+        'maxPoolSize': config['MONGO_MAX_POOL_SIZE'],
+        'minPoolSize': config['MONGO_MIN_POOL_SIZE'],
+        'serverSelectionTimeoutMS': config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+        'connectTimeoutMS': config['MONGO_CONNECT_TIMEOUT_MS'],
+    }
+
+# Helper function to read a write concern setting ("1", "2", "majority" ...)
+def parse_write_concern(value, timeout_ms):
+    w = int(value) if str(value).isdigit() else value
+    return WriteConcern(w=w, wtimeout=timeout_ms)
+
+# Helper function to build the with_options() arguments of a route class
+def collection_options(config, route_class):
+    if route_class not in ROUTE_CLASSES:
+        raise ValueError(f'Unknown route class "{route_class}"')
+    read_preference = config['MONGO_READ_PREFERENCE']
+    if read_preference not in READ_PREFERENCES:
+        raise ValueError(f'Unknown read preference "{read_preference}"')
+    if route_class == 'read':
+        return {'read_preference': READ_PREFERENCES[read_preference]}
+    # Writes always go to the primary, and the lookups they make must see their own writes
+    concern = config['MONGO_BULK_WRITE_CONCERN'] if route_class == 'bulk' else config['MONGO_WRITE_CONCERN']
+    return {'read_preference': ReadPreference.PRIMARY,
+            'write_concern': parse_write_concern(concern, config['MONGO_WRITE_TIMEOUT_MS'])}
+
+# Helper function to tell from a "hello" reply whether the server has multi-document transactions,
+# like change streams they need a replica set or a sharded cluster (and sessions)
+def supports_transactions(hello):
+    return supports_change_streams(hello) and 'logicalSessionTimeoutMinutes' in hello
+
+# Helper function to get the server-side time limit of a route class in milliseconds
+def max_time_ms(config, route_class):
+    if route_class == 'bulk':
+        return config['MONGO_BULK_MAX_TIME_MS']
+    return config['MONGO_MAX_TIME_MS']
+
+class Mongo:
+    def __init__(self, config, event_listeners=None):
+        self.config = config
+        self.event_listeners = event_listeners or []
+        self._client = None
+        self._pid = None
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    # The client of the current process, recreated after a fork
+    @property
+    def client(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Never close a client inherited from the parent, its sockets are shared with it
+                    factory = self.config.get('MONGO_CLIENT_FACTORY') or MongoClient
+                    self._client = factory(self.config['MONGO_URI'], event_listeners=self.event_listeners,
+                                           **client_options(self.config))
+                    self._collections = {}
+                    self._pid = os.getpid()
+        return self._client
+
+    # The properties collection with the read preference/write concern of a route class
+    def collection(self, route_class='read'):
+        return self._collection('MONGO_COLLECTION', route_class)
+
+    # The meta collection (change counter) with the same options
+    def meta_collection(self, route_class='read'):
+        return self._collection('MONGO_META_COLLECTION', route_class)
+
+    # The change log of /properties/changes, written when there are no change streams
+    def changes_collection(self, route_class='read'):
+        return self._collection('MONGO_CHANGES_COLLECTION', route_class)
+
+    def _collection(self, setting, route_class):
+        client = self.client
+        collection = self._collections.get((setting, route_class))
+        if collection is None:
+            base = client[self.config['MONGO_DB']][self.config[setting]]
+            collection = base.with_options(**collection_options(self.config, route_class))
+            self._collections[(setting, route_class)] = collection
+        return collection
+
+    # Whether the server has change streams (replica sets and sharded clusters)
+    def has_change_streams(self):
+        return supports_change_streams(self.client.admin.command('hello'))
+
+    # Whether the server has multi-document transactions
+    def has_transactions(self):
+        return supports_transactions(self.client.admin.command('hello'))
+
+    def max_time_ms(self, route_class='read'):
+        return max_time_ms(self.config, route_class)
+
+    # Open the minimum pool up front so the first requests don't wait for connection handshakes
+    def warm_up(self):
+        admin = self.client.admin
+        admin.command('ping')  # Fails fast if the server can't be reached
+        connections = max(self.config['MONGO_MIN_POOL_SIZE'], 1)
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            list(pool.map(lambda _: admin.command('ping'), range(connections)))
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+            self._collections = {}
+
+class AsyncMongo(Mongo):
+    def __init__(self, config, event_listeners=None):
+        super().__init__(config, event_listeners)
+        self.slots = None  # Database operations allowed in flight, the rest wait their turn
+
+    # The client opened by open()
+    @property
+    def client(self):
+        if self._client is None:
+            raise RuntimeError('The MongoDB client is not open')
+        return self._client
+
+    # Connect, on the event loop that will use the client
+    def open(self):
+        factory = self.config.get('ASYNC_MONGO_CLIENT_FACTORY') or AsyncMongoClient
+        self._client = factory(self.config['MONGO_URI'], event_listeners=self.event_listeners,
+                               **client_options(self.config))
+        self._collections = {}
+        self.slots = asyncio.Semaphore(self.config['MONGO_MAX_POOL_SIZE'])
+
+    async def has_change_streams(self):
+        return supports_change_streams(await self.client.admin.command('hello'))
+
+    async def has_transactions(self):
+        return supports_transactions(await self.client.admin.command('hello'))
+
+    async def warm_up(self):
+        connections = max(self.config['MONGO_MIN_POOL_SIZE'], 1)
+        await asyncio.gather(*(self.client.admin.command('ping') for _ in range(connections)))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = None
+        self._collections = {}
@@ -0,0 +1,272 @@
+import json
+from bisect import bisect_right
+import tkinter as tk
+from tkinter import ttk
+
+# Virtualized table for the Tk client (api_client.py). Instead of inserting every property
+# up front it fetches pages from the server with ?limit= and ?after= as the user scrolls,
+# and only the rows that fit in the window exist in the Treeview. Cells are formatted when
+# they are shown, and clicking a column heading asks the server for a sorted result (unless
+# the server ranks the rows itself, like /properties/search: sortable=False).
+# Given the URL of /properties/changes it also follows inserts, updates and deletes with
+# long-polls and applies them to the loaded rows, instead of reading the list again.
+
+PAGE_SIZE = 200  # Properties fetched per request
+VISIBLE_ROWS = 20  # Rows that exist in the Treeview at any time
+PREFETCH_ROWS = 100  # Fetch the next page when the window gets this close to the end
+MAX_CELL_LENGTH = 50
+CHANGES_TIMEOUT = 25  # Seconds a long-poll for changes waits on the server
+CHANGES_RETRY_MS = 5000  # Wait before asking for changes again after an error
+
+# Helper function to turn a field value into cell text
+def format_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        text = json.dumps(value, separators=(",", ":"))
+    else:
+        text = str(value)
+    return text if len(text) <= MAX_CELL_LENGTH else text[:MAX_CELL_LENGTH - 3] + "..."
+
+# Helper function to order values roughly like MongoDB does: null, numbers, strings, the rest
+def sort_value(value):
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (4, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, json.dumps(value, sort_keys=True))
+
+class PagedTable:
+    def __init__(self, parent, executor, url, query=None, on_row_click=None, on_row_select=None, on_error=None,
+                 changes_url=None, sortable=True):
+        self.executor = executor
+        self.url = url
+        self.query = query  # Sent as the JSON body for /properties/query
+        self.sortable = sortable
+        self.changes_url = changes_url  # /properties/changes, None to show the rows as loaded
+        self.on_row_click = on_row_click
+        self.on_row_select = on_row_select  # Called as soon as a row is selected, e.g. to prefetch its image
+        self.on_error = on_error
+        self.request_key = f"table-{id(self)}"  # A new sort supersedes the pages still loading
+        self.changes_key = f"{self.request_key}-changes"
+
+        self.frame = tk.Frame(parent, bg="#f0f0f0")
+        self.frame.pack(pady=10, padx=10, fill="both", expand=True)
+        self.tree = ttk.Treeview(self.frame, show="headings", height=VISIBLE_ROWS, selectmode="browse")
+        self.tree.pack(side=tk.LEFT, fill="both", expand=True)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="vertical", command=self.scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill="y")
+        self.status = tk.Label(parent, anchor="w", bg="#f0f0f0", font=("Arial", 9))
+        self.status.pack(fill="x", padx=10, pady=(0, 5))
+
+        self.tree.bind("<ButtonRelease-1>", self._handle_click)
+        self.tree.bind("<<TreeviewSelect>>", self._handle_select)
+        self.tree.bind("<MouseWheel>", lambda event: self.scroll("scroll", -1 if event.delta > 0 else 1, "units"))
+        self.tree.bind("<Button-4>", lambda event: self.scroll("scroll", -1, "units"))
+        self.tree.bind("<Button-5>", lambda event: self.scroll("scroll", 1, "units"))
+        self.tree.bind("<Configure>", lambda event: self._render())
+        self.frame.bind("<Destroy>", self._close)
+
+        self.columns = []
+        self.sort = None  # e.g. "price" or "-price", None = server default (_id)
+        self.reset()
+
+    # Forget the loaded rows and start again from the first page
+    def reset(self):
+        self.rows = []  # Summaries of the loaded properties, in server order
+        self.offset = 0  # Index of the first visible row
+        self.next_cursor = None
+        self.complete = False
+        self.loading = False
+        self.row_data = {}  # Treeview item -> property _id, the full document is fetched on click
+        self.change_token = None  # Where the next long-poll for changes resumes
+        self.executor.cancel(self.changes_key)
+        if self.changes_url:
+            self._start_following()
+        else:
+            self.load_next_page()
+
+    def _close(self, event):
+        self.changes_url = None  # Stops the retries
+        self.executor.cancel(self.request_key)
+        self.executor.cancel(self.changes_key)
+
+    # Ask for the current end of the change feed before the first page, so no change falls in between
+    def _start_following(self):
+        self.loading = True
+        self._show_status()
+        self.executor.submit(self.changes_key, "GET", self.changes_url, self._start_with_token, json=self.query)
+
+    def _start_with_token(self, result):
+        self.loading = False
+        if result.ok and isinstance(result.data, dict):
+            self.change_token = result.data.get("token")
+        self.load_next_page()  # Without a token (e.g. an older server) the rows are shown as loaded
+        self._poll_changes()
+
+    def _poll_changes(self):
+        if not self.changes_url or not self.change_token:
+            return
+        params = {"after": self.change_token, "timeout": CHANGES_TIMEOUT}
+        self.executor.submit_long_poll(self.changes_key, "GET", self.changes_url, self._apply_changes,
+                                       params=params, json=self.query)
+
+    def _apply_changes(self, result):
+        if result.status_code == 400:  # The token can't be resumed any more
+            self.reset()
+            return
+        if not result.ok or not isinstance(result.data, dict):
+            if self.changes_url and self.frame.winfo_exists():
+                self.frame.after(CHANGES_RETRY_MS, self._poll_changes)
+            return
+        for change in result.data.get("changes", []):
+            if change.get("op") == "reset":  # The collection was dropped or the feed lost its place
+                self.reset()
+                return
+            self._apply_change(change)
+        self.change_token = result.data.get("token") or self.change_token
+        self.offset = max(0, min(self.offset, len(self.rows) - VISIBLE_ROWS))
+        self._render()
+        self._poll_changes()
+
+    # Apply one insert, update or delete to the loaded rows
+    def _apply_change(self, change):
+        self.rows = [item for item in self.rows if item.get("_id") != change.get("id")]
+        doc = change.get("doc")
+        if change.get("op") == "delete" or doc is None:
+            return
+        keys = [self._row_key(item) for item in self.rows]
+        position = bisect_right(keys, self._row_key(doc))
+        if position < len(self.rows) or self.complete:
+            self.rows.insert(position, doc)  # Rows past the last loaded one come with the next page
+
+    # Helper function to get the position of a row in the server's order
+    def _row_key(self, item):
+        field = (self.sort or "_id").lstrip("-")
+        key = (sort_value(item.get(field)), item.get("_id") or "")
+        return key if not (self.sort or "").startswith("-") else _Descending(key)
+
+    def load_next_page(self):
+        if self.loading or self.complete:
+            return
+        params = {"limit": PAGE_SIZE}
+        if self.sort:
+            params["sort"] = self.sort
+        if self.next_cursor:
+            params["after"] = self.next_cursor
+        self.loading = True
+        self._show_status()
+        self.executor.submit(self.request_key, "GET", self.url, self._add_page, params=params, json=self.query)
+
+    def _add_page(self, result):
+        self.loading = False
+        if not result.ok or not isinstance(result.data, list):
+            self.complete = True
+            self._show_status()
+            if self.on_error:
+                self.on_error(result)
+            return
+        self.rows.extend(result.data)
+        self.next_cursor = result.headers.get("X-Next-Cursor")
+        self.complete = not self.next_cursor
+        if not self.columns and self.rows:
+            self._set_columns(self.rows[:PAGE_SIZE])
+        self._render()
+
+    def _set_columns(self, sample):
+        columns = ["_id"]
+        for item in sample:
+            columns += [key for key in item if key not in columns]
+        self.columns = columns
+        self.tree["columns"] = columns
+        for column in columns:
+            if self.sortable:
+                self.tree.heading(column, text=column.capitalize(), command=lambda column=column: self.sort_by(column))
+            else:
+                self.tree.heading(column, text=column.capitalize())
+            self.tree.column(column, width=200 if column == "_id" else 100, anchor="w")
+
+    # Ask the server for the rows sorted by a column, a second click reverses the order
+    def sort_by(self, column):
+        self.sort = f"-{column}" if self.sort == column else column
+        for name in self.columns:
+            arrow = (" ▲" if self.sort == name else " ▼" if self.sort == f"-{name}" else "")
+            self.tree.heading(name, text=name.capitalize() + arrow)
+        self.reset()
+        self._render()
+
+    # Scrollbar and mouse wheel handler: ("moveto", fraction) or ("scroll", count, "units"/"pages")
+    def scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            offset = int(float(amount) * len(self.rows))
+        elif unit == "pages":
+            offset = self.offset + int(amount) * VISIBLE_ROWS
+        else:
+            offset = self.offset + int(amount)
+        self.offset = max(0, min(offset, len(self.rows) - VISIBLE_ROWS))
+        self.tree.selection_remove(self.tree.selection())  # The rows are reused for other properties
+        self._render()
+
+    # Show the rows of the current window, formatting only those cells
+    def _render(self):
+        if not self.tree.winfo_exists():
+            return
+        window = self.rows[self.offset:self.offset + VISIBLE_ROWS]
+        items = self.tree.get_children()
+        for index, item in enumerate(window):
+            values = [format_cell(item.get(column)) for column in self.columns]
+            if index < len(items):
+                self.tree.item(items[index], values=values)
+                row_id = items[index]
+            else:
+                row_id = self.tree.insert("", "end", values=values)
+            self.row_data[row_id] = item.get("_id")
+        for row_id in items[len(window):]:
+            self.tree.delete(row_id)
+            self.row_data.pop(row_id, None)
+
+        if self.rows:
+            self.scrollbar.set(self.offset / len(self.rows), (self.offset + len(window)) / len(self.rows))
+        else:
+            self.scrollbar.set(0, 1)
+        if self.offset + VISIBLE_ROWS + PREFETCH_ROWS >= len(self.rows):
+            self.load_next_page()
+        self._show_status()
+
+    def _show_status(self):
+        if not self.status.winfo_exists():
+            return
+        shown = f"{self.offset + 1}-{min(self.offset + VISIBLE_ROWS, len(self.rows))}" if self.rows else "0"
+        more = "loading..." if self.loading else ("all loaded" if self.complete else "scroll for more")
+        live = ", following changes" if self.change_token else ""
+        self.status.configure(text=f"Rows {shown} of {len(self.rows)} loaded, {more}{live}")
+
+    # Summary of a loaded row, e.g. for the address of the clicked property
+    def summary(self, row_id):
+        property_id = self.row_data.get(row_id)
+        for item in self.rows[self.offset:self.offset + VISIBLE_ROWS]:
+            if item.get("_id") == property_id:
+                return item
+        return {}
+
+    def _handle_select(self, event):
+        selected = self.tree.selection()
+        if selected and self.on_row_select and self.row_data.get(selected[0]):
+            self.on_row_select(self.row_data[selected[0]], self.summary(selected[0]))
+
+    def _handle_click(self, event):
+        selected = self.tree.selection()
+        if selected and self.on_row_click and self.row_data.get(selected[0]):
+            self.on_row_click(self.row_data[selected[0]], self.summary(selected[0]))
+
+# Reverses the order of a sort key, for descending sorts
+class _Descending:
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
@@ -0,0 +1,439 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReturnDocument, UpdateMany
+from pymongo.errors import BulkWriteError
+import image_store
+from change_feed import log_entries
+from compression import GZIP_LEVEL
+from config import load_config
+from mongo import Mongo
+from property_queries import add_address_key
+from versioning import (
+    CHANGE_COUNTER_FILTER, CHANGE_COUNTER_UPDATE, VERSION_FIELD, bump_version, change_counter_update, stamp_new,
+)
+
+# Backup, seeding and migration of the properties collection, straight against MongoDB:
+#   python properties_cli.py export backup/ --workers 8 --format bson --gzip
+#   python properties_cli.py import backup/ --workers 8
+#   python properties_cli.py images demo_images/ --mapping images.csv
+# Connection settings come from config.py (MONGO_URI, MONGO_DB, MONGO_COLLECTION ...), the same
+# environment variables as the servers, or --mongo-uri.
+# - export splits the collection into _id ranges and writes one file per range from a pool of
+#   processes. Each range is streamed in _id order, so memory stays flat whatever the size.
+# - import reads NDJSON/BSON files (gzipped or not) in a pool of processes and inserts them in
+#   unordered batches. After each batch it records how far a file got, so an interrupted import
+#   started again carries on where it stopped; documents already there are skipped.
+# - images stores a directory of images in the image store (hashing and thumbnails run in
+#   parallel) and attaches each one to the properties with its address.
+# The servers are not involved: afterwards the change counter is bumped so list ETags change,
+# and response caches of running servers catch up within QUERY_CACHE_TTL.
+
+FORMATS = {'ndjson': '.ndjson', 'bson': '.bson'}
+NDJSON_SUFFIXES = ('.ndjson', '.jsonl')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+DEFAULT_BATCH_SIZE = 1000
+MANIFEST = 'manifest.json'
+STATE_DIR = '.import-state'  # Checkpoints of an import, next to its first input
+DUPLICATE_KEY = 11000
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)  # BSON is copied without decoding it
+
+# One connection per process, built on first use (the pool's processes start without one)
+_mongo = None
+
+def get_mongo(settings):
+    global _mongo
+    if _mongo is None:
+        _mongo = Mongo(settings)
+    return _mongo
+
+# Helper function to get the properties collection for bulk work (bulk write concern)
+def get_collection(settings):
+    return get_mongo(settings).collection('bulk')
+
+# Helper function to run tasks in a pool of processes, or in this process for one worker.
+# Yields the results as the tasks finish.
+def run_tasks(workers, function, tasks):
+    if workers <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+    # spawn, not fork: a forked MongoClient is not safe to use
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(function, *task) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+# Helper function to write a small JSON file atomically
+def write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+# Helper function to record a write made behind the servers' backs, like note_change() in the
+# servers: bump the change counter, and without change streams add the changes to the change log.
+# changes is a list of (operation, document id), None when they are too many to list.
+def note_change(settings, changes):
+    mongo = get_mongo(settings)
+    source = settings['CHANGE_FEED_SOURCE']
+    if source == 'auto':
+        try:
+            source = 'change_stream' if mongo.has_change_streams() else 'log'
+        except Exception:
+            source = 'log'
+    meta = mongo.meta_collection('write')
+    if source != 'log':
+        meta.update_one(CHANGE_COUNTER_FILTER, CHANGE_COUNTER_UPDATE, upsert=True)
+    elif changes is None or changes:
+        count = len(changes) if changes else 1
+        counter = meta.find_one_and_update(CHANGE_COUNTER_FILTER, change_counter_update(count), upsert=True,
+                                           return_document=ReturnDocument.AFTER)
+        mongo.changes_collection('write').insert_many(log_entries(changes, counter['count'] - count + 1))
+
+# Pick the _id values that split the collection into parts of about the same size, walking the
+# _id index once. Collections with other _id types than ObjectId are exported in one part, since
+# a range of one type never matches values of another.
+def split_points(collection, parts):
+    if parts < 2 or collection.find_one({'_id': {'$not': {'$type': 'objectId'}}}, {'_id': 1}):
+        return []
+    step = collection.estimated_document_count() // parts
+    if not step:
+        return []
+    points = []
+    for _ in range(parts - 1):
+        selector = {'_id': {'$gt': points[-1]}} if points else {}
+        doc = next(collection.find(selector, {'_id': 1}).sort('_id', 1).skip(step - 1 if points else step).limit(1),
+                   None)
+        if doc is None:
+            break
+        points.append(doc['_id'])
+    return points
+
+# Helper function to build the filter of one _id range, None = open end
+def range_filter(low, high):
+    bounds = {}
+    if low is not None:
+        bounds['$gte'] = low
+    if high is not None:
+        bounds['$lt'] = high
+    return {'_id': bounds} if bounds else {}
+
+# Helper function to open a data file, gzipped if its name says so (or compress is set)
+def open_file(path, mode, compress=None):
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL) if 'w' in mode else gzip.open(path, mode)
+    return open(path, mode)
+
+# Write one _id range to a file (runs in a pool process)
+def export_range(settings, path, low, high, output_format, batch_size):
+    collection = get_collection(settings)
+    if output_format == 'bson':
+        collection = collection.with_options(codec_options=RAW_OPTIONS)
+    cursor = collection.find(range_filter(low, high)).sort('_id', 1).batch_size(batch_size)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    count = 0
+    with open_file(tmp_path, 'wb', compress=path.endswith('.gz')) as f:
+        for doc in cursor:
+            if output_format == 'bson':
+                f.write(doc.raw)
+            else:
+                f.write(json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS).encode('utf-8') + b'\n')
+            count += 1
+    os.replace(tmp_path, path)
+    return {'file': os.path.basename(path), 'count': count}
+
+# Export the collection to one file per _id range plus a manifest
+def export_collection(settings, directory, output_format='ndjson', compress=False, workers=1, parts=None,
+                      batch_size=DEFAULT_BATCH_SIZE):
+    started = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+    points = split_points(get_collection(settings), parts or workers * 4)
+    bounds = [None] + points + [None]
+    suffix = FORMATS[output_format] + ('.gz' if compress else '')
+    tasks = [(settings, os.path.join(directory, f'part-{index:05d}{suffix}'), bounds[index], bounds[index + 1],
+              output_format, batch_size) for index in range(len(bounds) - 1)]
+    results = []
+    for result in run_tasks(workers, export_range, tasks):
+        results.append(result)
+        print(f'{result["file"]}: {result["count"]} documents', flush=True)
+    results.sort(key=lambda result: result['file'])
+    summary = {
+        'database': settings['MONGO_DB'],
+        'collection': settings['MONGO_COLLECTION'],
+        'format': output_format,
+        'count': sum(result['count'] for result in results),
+        'parts': results,
+        'elapsed_s': round(time.monotonic() - started, 3),
+    }
+    write_json(os.path.join(directory, MANIFEST), summary)
+    return summary
+
+# Helper function to tell the format of an input file from its name, None if it is not one
+def file_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(FORMATS['bson']):
+        return 'bson'
+    if name.endswith(NDJSON_SUFFIXES):
+        return 'ndjson'
+    return None
+
+# Helper function to list the data files of the import arguments (files, or directories of them)
+def input_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if file_format(name))
+        elif file_format(path):
+            files.append(path)
+        else:
+            raise ValueError(f'{path}: not an .ndjson, .jsonl or .bson file (optionally .gz)')
+    return files
+
+# Helper function to read the records of a file one at a time: raw BSON documents, or NDJSON lines
+def read_records(path):
+    with open_file(path, 'rb') as f:
+        if file_format(path) == 'bson':
+            yield from bson.decode_file_iter(f, codec_options=RAW_OPTIONS)
+        else:
+            for line in f:
+                if line.strip():
+                    yield line
+
+# Helper function to turn a record into the document to insert. NDJSON documents get the same
+# treatment as POST /properties: inline base64 images move to the image store, the address gets
+# its search key, and documents that are not versioned yet get their first version. BSON is an
+# export already, it goes as it is.
+def prepare_document(record):
+    if isinstance(record, RawBSONDocument):
+        return record
+    doc = add_address_key(image_store.migrate_document_image(json_util.loads(record)))
+    if VERSION_FIELD not in doc:
+        stamp_new(doc)
+    return doc
+
+# Helper function to insert a batch, documents whose _id exists already (e.g. from an interrupted
+# run) are counted as duplicates. Returns (inserted, duplicates).
+def insert_batch(collection, docs):
+    try:
+        return len(collection.insert_many(docs, ordered=False).inserted_ids), 0
+    except BulkWriteError as e:
+        errors = e.details['writeErrors']
+        if any(error['code'] != DUPLICATE_KEY for error in errors):
+            raise
+        return e.details['nInserted'], len(errors)
+
+# Helper function to identify the collection an import writes to. Hashed, so the checkpoints
+# don't keep a password of the URI.
+def import_target(settings):
+    target = '\0'.join([settings['MONGO_URI'], settings['MONGO_DB'], settings['MONGO_COLLECTION']])
+    return hashlib.sha1(target.encode('utf-8')).hexdigest()[:16]
+
+# Helper function to get the checkpoint file of an input file imported into a target
+def state_path(state_dir, path, target):
+    key = f'{os.path.abspath(path)}\0{target}'
+    return os.path.join(state_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.json')
+
+# Helper function to read the checkpoint of an input file; it only counts for the same file size
+# and the same target
+def read_state(state_file, path, target):
+    state = {'file': os.path.abspath(path), 'size': os.path.getsize(path), 'target': target, 'done': 0,
+             'complete': False}
+    try:
+        with open(state_file) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return state
+    return saved if saved.get('size') == state['size'] and saved.get('target') == target else state
+
+# Insert the documents of one file in batches (runs in a pool process)
+def import_file(settings, path, state_dir, batch_size):
+    target = import_target(settings)
+    state_file = state_path(state_dir, path, target)
+    state = read_state(state_file, path, target)
+    result = {'file': path, 'inserted': 0, 'duplicates': 0, 'resumed_at': state['done'], 'complete': state['complete']}
+    if state['complete']:
+        return result
+    collection = get_collection(settings)
+    batch = []
+    for index, record in enumerate(read_records(path)):
+        if index < state['done']:
+            continue  # Written by an earlier run
+        batch.append(prepare_document(record))
+        if len(batch) >= batch_size:
+            inserted, duplicates = insert_batch(collection, batch)
+            result['inserted'] += inserted
+            result['duplicates'] += duplicates
+            state['done'] = index + 1
+            write_json(state_file, state)
+            batch = []
+    if batch:
+        inserted, duplicates = insert_batch(collection, batch)
+        result['inserted'] += inserted
+        result['duplicates'] += duplicates
+        state['done'] += len(batch)
+    state['complete'] = True
+    write_json(state_file, state)
+    return result
+
+# Import files (or directories of them) into the collection, resuming from earlier checkpoints
+def import_files(settings, paths, workers=1, batch_size=DEFAULT_BATCH_SIZE, state_dir=None, restart=False):
+    started = time.monotonic()
+    files = input_files(paths)
+    if not files:
+        raise ValueError('No .ndjson, .jsonl or .bson files to import')
+    state_dir = state_dir or os.path.join(paths[0] if os.path.isdir(paths[0]) else os.path.dirname(paths[0]),
+                                          STATE_DIR)
+    os.makedirs(state_dir, exist_ok=True)
+    if restart:
+        target = import_target(settings)
+        for path in files:
+            if os.path.exists(state_path(state_dir, path, target)):
+                os.remove(state_path(state_dir, path, target))
+    results = []
+    try:
+        for result in run_tasks(workers, import_file, [(settings, path, state_dir, batch_size) for path in files]):
+            results.append(result)
+            name = os.path.basename(result['file'])
+            if result['complete']:
+                print(f'{name}: imported by an earlier run', flush=True)
+                continue
+            resumed = f' (resumed at document {result["resumed_at"]})' if result['resumed_at'] else ''
+            print(f'{name}: {result["inserted"]} inserted, {result["duplicates"]} already there{resumed}', flush=True)
+    finally:
+        if any(result['inserted'] for result in results):
+            note_change(settings, None)  # Too many to list, change log readers start over
+    return {
+        'files': len(files),
+        'inserted': sum(result['inserted'] for result in results),
+        'duplicates': sum(result['duplicates'] for result in results),
+        'elapsed_s': round(time.monotonic() - started, 3),
+    }
+
+# Helper function to read an address -> image mapping (CSV with "address" and "image" columns,
+# image paths relative to the CSV file)
+def read_mapping(path):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    if rows and not {'address', 'image'} <= set(rows[0]):
+        raise ValueError(f'{path} needs "address" and "image" columns')
+    base = os.path.dirname(os.path.abspath(path))
+    return [(row['address'], os.path.join(base, row['image'])) for row in rows]
+
+# Helper function to pair every image of a directory with the address in its file name,
+# e.g. "23_Good_will_ave.jpg" -> "23 Good will ave"
+def images_by_file_name(directory):
+    return [(os.path.splitext(name)[0].replace('_', ' '), os.path.join(directory, name))
+            for name in sorted(os.listdir(directory)) if name.lower().endswith(IMAGE_SUFFIXES)]
+
+# Store one image file, with its thumbnail (runs in a pool process). Returns (path, None) for a
+# file that is not an image.
+def store_image_file(path):
+    with open(path, 'rb') as f:
+        try:
+            return path, image_store.store_image(f.read())
+        except ValueError:
+            return path, None
+
+# Attach one batch of stored images to the properties with their addresses.
+# Returns (properties updated, addresses without a property).
+def attach_images(settings, batch):
+    collection = get_collection(settings)
+    addresses = [address for address, _ in batch]
+    matched = collection.find({'address': {'$in': addresses}}, {'address': 1})
+    ids = {}
+    for doc in matched:
+        ids.setdefault(doc['address'], []).append(doc['_id'])
+    updates = [UpdateMany({'address': address}, bump_version({'$set': {'image_ref': image_ref},
+                                                              '$unset': {'image': ''}}))
+               for address, image_ref in batch if address in ids]
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+        note_change(settings, [('update', id) for address, _ in batch for id in ids.get(address, [])])
+    return sum(len(found) for found in ids.values()), [address for address in addresses if address not in ids]
+
+# Store a directory of images and attach them to the properties matched by address
+def ingest_images(settings, directory, mapping=None, workers=1, batch_size=DEFAULT_BATCH_SIZE):
+    started = time.monotonic()
+    pairs = read_mapping(mapping) if mapping else images_by_file_name(directory)
+    addresses_of = {}  # One image may belong to several addresses, it is stored once
+    for address, path in pairs:
+        addresses_of.setdefault(path, []).append(address)
+    summary = {'images': len(addresses_of), 'updated': 0, 'unmatched': [], 'unreadable': []}
+    batch = []
+    for path, image_ref in run_tasks(workers, store_image_file, [(path,) for path in addresses_of]):
+        if image_ref is None:
+            summary['unreadable'].append(path)
+            continue
+        batch += [(address, image_ref) for address in addresses_of[path]]
+        if len(batch) >= batch_size:
+            updated, unmatched = attach_images(settings, batch)
+            summary['updated'] += updated
+            summary['unmatched'] += unmatched
+            batch = []
+    if batch:
+        updated, unmatched = attach_images(settings, batch)
+        summary['updated'] += updated
+        summary['unmatched'] += unmatched
+    summary['elapsed_s'] = round(time.monotonic() - started, 3)
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export, import and load images into the properties collection')
+    parser.add_argument('--mongo-uri', help='Where MongoDB runs, instead of MONGO_URI')
+    parser.add_argument('--db', help='Database, instead of MONGO_DB')
+    parser.add_argument('--collection', help='Collection, instead of MONGO_COLLECTION')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Processes working at once')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Documents per read/write batch')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='Write the collection to NDJSON or BSON files')
+    export_parser.add_argument('directory', help='Where the part files and manifest.json go')
+    export_parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson',
+                               help='ndjson is readable, bson keeps every type exactly and is faster')
+    export_parser.add_argument('--gzip', action='store_true', help='Compress the part files')
+    export_parser.add_argument('--parts', type=int, help='Number of _id ranges (default 4 per worker)')
+
+    import_parser = commands.add_parser('import', help='Insert NDJSON or BSON files, resuming an interrupted run')
+    import_parser.add_argument('paths', nargs='+', help='Files, or directories of .ndjson/.jsonl/.bson(.gz) files')
+    import_parser.add_argument('--state-dir', help=f'Where the checkpoints go (default {STATE_DIR} next to the input)')
+    import_parser.add_argument('--restart', action='store_true', help='Ignore checkpoints of an earlier run')
+
+    images_parser = commands.add_parser('images', help='Store images and attach them to properties by address')
+    images_parser.add_argument('directory', help='Images named after the address, e.g. 23_Good_will_ave.jpg')
+    images_parser.add_argument('--mapping', help='CSV file with "address" and "image" columns instead')
+    images_parser.add_argument('--image-store', help='Image store directory, instead of IMAGE_STORE_DIR')
+    args = parser.parse_args()
+
+    overrides = {key: value for key, value in (('MONGO_URI', args.mongo_uri), ('MONGO_DB', args.db),
+                                               ('MONGO_COLLECTION', args.collection)) if value}
+    settings = load_config(overrides)
+    if args.command == 'export':
+        summary = export_collection(settings, args.directory, args.format, args.gzip, args.workers, args.parts,
+                                    args.batch_size)
+        summary.pop('parts')  # Listed above and in the manifest
+    elif args.command == 'import':
+        summary = import_files(settings, args.paths, args.workers, args.batch_size, args.state_dir, args.restart)
+    else:
+        if args.image_store:
+            os.environ['IMAGE_STORE_DIR'] = args.image_store  # Pool processes read it when they start
+            image_store.IMAGE_STORE_DIR = args.image_store
+        summary = ingest_images(settings, args.directory, args.mapping, args.workers, args.batch_size)
+    print(json.dumps(summary, indent=2, default=str))
@@ -0,0 +1,267 @@
+import base64
+import re
+import unicodedata
+from datetime import datetime
+from bson import Binary, Decimal128, ObjectId, json_util
+import image_store
+from serialization import dumps
+from versioning import bump_version, stamp_new
+
+# Request parsing helpers shared by the Flask server (api_server.py) and the
+# async server (api_server_async.py). Nothing in here touches the database.
+
+# Paging / streaming settings
+MAX_PAGE_LIMIT = 1000  # Largest page a client may ask for with ?limit=
+STREAM_BATCH_SIZE = 500  # Documents fetched from Mongo per round trip while streaming
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Normalized copy of "address" kept by the server for prefix search (see address_search.py)
+ADDRESS_KEY_FIELD = 'address_key'
+
+# Server-maintained fields never returned to clients, whatever the view
+INTERNAL_FIELDS = (ADDRESS_KEY_FIELD,)
+
+# Heavy fields left out of list responses unless asked for with ?view=full or ?fields=
+SUMMARY_EXCLUDED_FIELDS = ('image', 'gardens', 'room_data') + INTERNAL_FIELDS
+
+# Indexes created on startup, one list of (field, direction) keys per index
+PROPERTY_INDEXES = [
+    [('address', 1)],
+    [('rooms', 1), ('price', 1)],
+    [('condition', 1), ('price', 1)],
+    [('price', 1)],
+    [(ADDRESS_KEY_FIELD, 1), ('_id', 1)],  # Prefix search, pages in address order
+]
+
+# BSON types in the order MongoDB sorts them, missing and null first (see build_page_query).
+# Timestamps and regexes sort after dates but are no property values, so they are left out.
+SORT_TYPE_ORDER = ['null', 'number', 'string', 'object', 'array', 'binData', 'objectId', 'bool', 'date']
+# Python types of the decoded cursor values per rank (None, bool and numbers are told apart first)
+SORT_TYPE_RANKS = [
+    (2, str),
+    (3, dict),
+    (4, list),
+    (5, (bytes, Binary)),
+    (6, ObjectId),
+    (8, datetime),
+]
+
+# Helper function to build an opaque "after" cursor from the last document of a page
+def encode_cursor(sort_value, last_id):
+    raw = json_util.dumps([sort_value, last_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+# Helper function to turn an "after" cursor back into (sort value, _id)
+def decode_cursor(token):
+    try:
+        sort_value, last_id = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid "after" cursor')
+    return sort_value, last_id
+
+# Helper function to read ?limit= (None means "no paging, stream everything")
+def parse_limit(value):
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('"limit" must be an integer')
+    if limit < 1 or limit > MAX_PAGE_LIMIT:
+        raise ValueError(f'"limit" must be between 1 and {MAX_PAGE_LIMIT}')
+    return limit
+
+# Helper function to read ?sort=field or ?sort=-field
+def parse_sort(value):
+    if not value or value in ('_id', '-_id'):
+        return '_id', -1 if value == '-_id' else 1
+    if value.startswith('-'):
+        return value[1:], -1
+    return value, 1
+
+# Helper function to read a (possibly dotted) field from a document
+def get_field(doc, field):
+    for part in field.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+# Helper function to split a comma separated list of field names
+def parse_field_list(value):
+    if not value:
+        return []
+    return [field.strip() for field in value.split(',') if field.strip()]
+
+# Helper function to build the Mongo projection from ?fields=, ?exclude= and ?view=
+def build_projection(args, default_view):
+    fields = parse_field_list(args.get('fields'))
+    exclude = [field for field in parse_field_list(args.get('exclude')) if field != '_id']
+    if fields and exclude:
+        raise ValueError('Use either "fields" or "exclude", not both')
+    if fields:
+        return {field: 1 for field in fields if field not in INTERNAL_FIELDS} or {'_id': 1}
+
+    view = args.get('view', default_view)
+    if view not in ('summary', 'full'):
+        raise ValueError('"view" must be "summary" or "full"')
+    hidden = SUMMARY_EXCLUDED_FIELDS if view == 'summary' else INTERNAL_FIELDS
+    exclude += [field for field in hidden if field not in exclude]
+    return {field: 0 for field in exclude}
+
+# Helper function to build the sort spec, _id breaks ties so paging is stable
+def build_sort_spec(sort_field, direction):
+    sort_spec = [(sort_field, direction)]
+    if sort_field != '_id':
+        sort_spec.append(('_id', direction))
+    return sort_spec
+
+# Helper function to tell where a value's BSON type sorts, as an index into SORT_TYPE_ORDER
+def sort_type_rank(value):
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 7
+    if isinstance(value, (int, float, Decimal128)):
+        return 1
+    for rank, types in SORT_TYPE_RANKS:
+        if isinstance(value, types):
+            return rank
+    raise ValueError('Invalid "after" cursor')
+
+# Helper function to add the keyset condition for the page after the cursor. $gt/$lt only compare
+# values of the same type, so the documents whose sort field has a type that sorts later (or is
+# missing/null) are added by type.
+def build_page_query(query, sort_field, direction, after):
+    if not after:
+        return query
+    sort_value, last_id = decode_cursor(after)
+    op = '$gt' if direction == 1 else '$lt'
+    if sort_field == '_id':
+        keyset = {'_id': {op: last_id}}
+    else:
+        rank = sort_type_rank(sort_value)
+        clauses = [{sort_field: sort_value, '_id': {op: last_id}}]
+        if rank:  # Nothing sorts within null
+            clauses.append({sort_field: {op: sort_value}})
+        later = SORT_TYPE_ORDER[rank + 1:] if direction == 1 else SORT_TYPE_ORDER[1:rank]
+        clauses += [{sort_field: {'$type': alias}} for alias in later]
+        if direction == -1 and rank:  # Missing and null come last in descending order
+            clauses.append({sort_field: None})
+        keyset = {'$or': clauses}
+    return {'$and': [query, keyset]} if query else keyset
+
+# Helper function to check whether the client asked for newline-delimited JSON
+def wants_ndjson(accept_mimetypes):
+    best = accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+# Everything a list endpoint needs from ?limit=, ?after=, ?sort=, ?fields= and friends
+class ListQuery:
+    def __init__(self, query, args):
+        self.query = query
+        self.sort_field, self.direction = parse_sort(args.get('sort'))
+        if self.sort_field in INTERNAL_FIELDS:  # Would have to come back with each document for the cursor
+            raise ValueError(f'"sort" can not use the internal field "{self.sort_field}"')
+        self.limit = parse_limit(args.get('limit'))
+        self.page_query = build_page_query(query, self.sort_field, self.direction, args.get('after'))
+        self.sort_spec = build_sort_spec(self.sort_field, self.direction)
+        self.projection = build_projection(args, 'summary')
+        if self.projection:
+            # The sort key must come back with each document to build the next cursor
+            if self.projection.get(self.sort_field) == 0:
+                del self.projection[self.sort_field]
+            elif 1 in self.projection.values():
+                self.projection[self.sort_field] = 1
+
+    # Trim the limit + 1 documents fetched for a page; returns (page, next cursor, id of the extra document)
+    def split_page(self, documents):
+        if len(documents) <= self.limit:
+            return documents, None, None
+        extra_id = str(documents[self.limit]['_id'])
+        page = documents[:self.limit]
+        return page, encode_cursor(get_field(page[-1], self.sort_field), page[-1]['_id']), extra_id
+
+# Helper function to serialize one document of a JSON array or NDJSON body
+def serialize_document(item, ndjson, first):
+    if ndjson:
+        return dumps(item) + b'\n'
+    return (b'' if first else b',') + dumps(item)
+
+# Helper function to serialize documents one at a time as a JSON array or NDJSON (UTF-8 bytes)
+def generate_documents(documents, ndjson, seen_ids=None):
+    try:
+        if not ndjson:
+            yield b'['
+        for index, item in enumerate(documents):
+            if seen_ids is not None:
+                seen_ids.append(str(item['_id']))
+            yield serialize_document(item, ndjson, index == 0)
+        if not ndjson:
+            yield b']'
+    finally:
+        if hasattr(documents, 'close'):
+            documents.close()
+
+# Helper function to normalize an address for prefix search: case, accents, punctuation and
+# repeated spaces don't count, e.g. "23  Good-Will Ave." -> "23 good will ave"
+def normalize_address(value):
+    text = unicodedata.normalize('NFKD', value.casefold())
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return re.sub(r'[\W_]+', ' ', text).strip()
+
+# Helper function to set the address key of a new document or $set data from its address;
+# a client supplied key is dropped
+def add_address_key(data):
+    if isinstance(data, dict):
+        data.pop(ADDRESS_KEY_FIELD, None)
+        if isinstance(data.get('address'), str):
+            data[ADDRESS_KEY_FIELD] = normalize_address(data['address'])
+    return data
+
+# Prepare a new document for insertion: inline base64 image into the image store, address key
+# and first version
+def prepare_new_document(doc):
+    return stamp_new(add_address_key(image_store.migrate_document_image(doc)))
+
+# Helper function to turn $set data into an update, moving inline base64 images into the
+# image store, keeping the address key current and bumping the document version
+def build_set_update(data):
+    image_store.migrate_document_image(data)
+    add_address_key(data)
+    update = {'$set': data}
+    if 'image_ref' in data:
+        update['$unset'] = {'image': ''}
+    if 'address' in data and ADDRESS_KEY_FIELD not in data:  # Not a string any more
+        update.setdefault('$unset', {})[ADDRESS_KEY_FIELD] = ''
+    return bump_version(update)
+
+# Helper function to list the fields changed by an update document
+def updated_fields(update):
+    return [field for operator in update.values() for field in operator]
+
+# Helper function to collect the index names used anywhere in an explain plan
+def plan_index_names(plan):
+    names = set()
+    if isinstance(plan, dict):
+        if 'indexName' in plan:
+            names.add(plan['indexName'])
+        for value in plan.values():
+            names |= plan_index_names(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            names |= plan_index_names(value)
+    return names
+
+# Helper function to pick the interesting parts out of an explain result
+def summarize_explain(plan):
+    winning_plan = plan.get('queryPlanner', {}).get('winningPlan', {})
+    stats = plan.get('executionStats', {})
+    return {
+        'winning_plan': winning_plan,
+        'indexes_used': sorted(plan_index_names(winning_plan)),
+        'n_returned': stats.get('nReturned'),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'keys_examined': stats.get('totalKeysExamined'),
+        'execution_time_ms': stats.get('executionTimeMillis'),
+    }
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import OrderedDict
+from bson import json_util
+
+# In-process cache of serialized read responses (LRU + TTL, bounded by entries and bytes).
+# Each entry remembers the filter it answered and the ids it returned, so a write only
+# drops the entries it can actually change. Writes handled by other worker processes are noticed
+# through the change counter (see versioning.py), read at most once per sync interval.
+
+# Helper function to collect the top-level fields a filter depends on (None = unknown)
+def filter_fields(query):
+    fields = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for clause in value:
+                sub_fields = filter_fields(clause)
+                if sub_fields is None:
+                    return None
+                fields |= sub_fields
+        elif key.startswith('$'):
+            return None  # $where, $expr, $text ... can depend on anything
+        else:
+            fields.add(key.split('.')[0])
+    return fields
+
+# Helper function to tell whether a new document could match a filter.
+# Only plain equality is checked, anything else is assumed to match.
+def could_match(query, doc):
+    for key, value in query.items():
+        if key.startswith('$') or '.' in key:
+            continue
+        if isinstance(value, dict) and any(op.startswith('$') for op in value):
+            continue
+        actual = doc.get(key)
+        if actual == value or (isinstance(actual, list) and value in actual):
+            continue
+        return False
+    return True
+
+class CacheEntry:
+    def __init__(self, body, mimetype, headers, query, ids, fields, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers
+        self.query = query  # None for single-item entries
+        self.ids = ids
+        self.fields = fields
+        self.expires = expires
+
+class QueryCache:
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=30, max_entry_bytes=1024 * 1024,
+                 sync_interval=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self.generation = 0  # Bumped on every invalidation so in-flight fills can be discarded
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.sync_interval = sync_interval
+        self._change_count = None  # Change counter at the last sync
+        self._own_changes = 0  # Counter bumps of this process since then
+        self._next_sync = 0.0
+
+    # Build a cache key from a route name and the normalized query/arguments
+    @staticmethod
+    def make_key(*parts):
+        return json_util.dumps(parts, sort_keys=True)
+
+    # Look up a response
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # Store a response; sort_field is counted as a dependency because it decides page membership
+    def put(self, key, body, mimetype, ids, query=None, sort_field=None, headers=None, generation=None):
+        if len(body) > self.max_entry_bytes:
+            return
+        fields = None
+        if query is not None:
+            fields = filter_fields(query)
+            if fields is not None and sort_field:
+                fields.add(sort_field.split('.')[0])
+        entry = CacheEntry(body, mimetype, headers or {}, query, {str(id) for id in ids}, fields,
+                           time.monotonic() + self.ttl)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return  # A write happened while this response was being built
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    # Drop entries that returned any of these documents, or that filter/sort on a changed field
+    def invalidate_ids(self, ids, changed_fields=None):
+        ids = {str(id) for id in ids}
+        changed = {field.split('.')[0] for field in changed_fields} if changed_fields else set()
+        self._invalidate(lambda entry: bool(entry.ids & ids) or (
+            entry.query is not None and bool(changed) and (entry.fields is None or bool(entry.fields & changed))
+        ))
+
+    # Drop list entries whose filter a newly inserted document could match
+    def invalidate_inserted(self, docs):
+        self._invalidate(lambda entry: entry.query is not None and any(could_match(entry.query, doc) for doc in docs))
+
+    # Record that this process bumped the change counter, after the bump
+    def note_own_change(self, count=1):
+        with self._lock:
+            self._own_changes += count
+
+    # Time to look at the change counter again?
+    def needs_sync(self):
+        return time.monotonic() >= self._next_sync
+
+    # Compare the change counter with the last sync: when it moved by more than this process's own
+    # writes, another worker wrote something and everything cached may be stale
+    def sync(self, change_count):
+        with self._lock:
+            foreign = self._change_count is not None and change_count != self._change_count + self._own_changes
+            self._change_count, self._own_changes = change_count, 0
+            self._next_sync = time.monotonic() + self.sync_interval
+        if foreign:
+            self.clear()
+
+    def clear(self):
+        self._invalidate(lambda entry: True)
+
+    def _invalidate(self, predicate):
+        with self._lock:
+            self.generation += 1
+            for key in [key for key, entry in self._entries.items() if predicate(entry)]:
+                self._remove(key)
+                self.invalidations += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= len(entry.body)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
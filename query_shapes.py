@@ -0,0 +1,130 @@
+import threading
+from bson import json_util
+
+# Records which filter/sort field combinations reach the query endpoints and turns the
+# frequent ones into index suggestions, ordered equality -> sort -> range fields.
+
+RANGE_OPERATORS = {'$gt', '$gte', '$lt', '$lte', '$ne', '$nin', '$regex', '$exists', '$not'}
+
+# Helper function to replace every value in a filter with "?" so similar queries look the same
+def normalize_query(query):
+    if isinstance(query, dict):
+        return {key: normalize_query(value) if key in ('$and', '$or', '$nor') or isinstance(value, dict) else '?'
+                for key, value in sorted(query.items())}
+    if isinstance(query, list):
+        return [normalize_query(item) for item in query]
+    return '?'
+
+# Helper function to split a filter into equality fields, range fields and "can't index" flag
+def classify_fields(query):
+    equality, ranges, indexable = set(), set(), True
+    for key, value in query.items():
+        if key == '$and':
+            for clause in value:
+                sub_equality, sub_ranges, sub_indexable = classify_fields(clause)
+                equality |= sub_equality
+                ranges |= sub_ranges
+                indexable = indexable and sub_indexable
+        elif key.startswith('$'):
+            indexable = False  # $or, $where, $expr, $text ... are left to the planner
+        elif isinstance(value, dict) and any(op.startswith('$') for op in value):
+            if set(value) & RANGE_OPERATORS:
+                ranges.add(key)
+            else:
+                equality.add(key)  # $eq, $in and $all behave like equality for index order
+        else:
+            equality.add(key)
+    return equality, ranges - equality, indexable
+
+class QueryShape:
+    def __init__(self, route, equality, ranges, sort_field, indexable):
+        self.route = route
+        self.equality = tuple(sorted(equality))
+        self.ranges = tuple(sorted(ranges))
+        self.sort_field = sort_field
+        self.indexable = indexable
+        self.count = 0
+
+    @property
+    def key(self):
+        return (self.route, self.equality, self.ranges, self.sort_field, self.indexable)
+
+    # Suggested index keys following the equality, sort, range rule
+    def index_keys(self):
+        keys = [(field, 1) for field in self.equality]
+        if self.sort_field and self.sort_field[0] != '_id':
+            keys.append(self.sort_field)
+        keys += [(field, 1) for field in self.ranges if not self.sort_field or field != self.sort_field[0]]
+        return keys
+
+    def to_dict(self):
+        return {
+            'route': self.route,
+            'equality': list(self.equality),
+            'range': list(self.ranges),
+            'sort': list(self.sort_field) if self.sort_field else None,
+            'indexable': self.indexable,
+            'count': self.count,
+        }
+
+# Helper function to check whether an existing index can serve the suggested keys
+def is_covered(keys, index_keys, equality_count):
+    fields = [field for field, _ in keys]
+    existing = [field for field, _ in index_keys][:len(fields)]
+    if len(existing) < len(fields):
+        return False
+    # Equality fields may appear in any order, the rest must follow in sequence
+    return (set(existing[:equality_count]) == set(fields[:equality_count])
+            and existing[equality_count:] == fields[equality_count:])
+
+# Helper function to list the keys of every index from Collection.index_information()
+def index_key_lists(index_information):
+    return [list(info['key']) for info in index_information.values()]
+
+class QueryShapeRecorder:
+    def __init__(self, max_shapes=1000):
+        self.max_shapes = max_shapes
+        self._shapes = {}
+        self._lock = threading.Lock()
+
+    # Count one query and log its shape the first time it is seen, returns the shape
+    def observe(self, route, query, sort_field=None, logger=None):
+        shape, is_new = self.record(route, query, sort_field)
+        if is_new and logger:
+            logger.info('New query shape on %s: %s', route, shape.to_dict())
+        return shape
+
+    # Count one query; returns (shape, is_new) so the caller can log first sightings
+    def record(self, route, query, sort_field=None):
+        equality, ranges, indexable = classify_fields(query or {})
+        shape = QueryShape(route, equality, ranges, sort_field, indexable)
+        with self._lock:
+            existing = self._shapes.get(shape.key)
+            if existing is None:
+                if len(self._shapes) >= self.max_shapes:
+                    return shape, False
+                self._shapes[shape.key] = existing = shape
+            existing.count += 1
+            return existing, existing.count == 1
+
+    def shapes(self):
+        with self._lock:
+            return sorted((shape.to_dict() for shape in self._shapes.values()), key=lambda s: -s['count'])
+
+    # Index keys for shapes seen at least min_count times that no existing index serves
+    def suggest(self, existing_indexes, min_count=1):
+        suggestions = {}
+        with self._lock:
+            shapes = list(self._shapes.values())
+        for shape in shapes:
+            keys = shape.index_keys()
+            if not shape.indexable or not keys or shape.count < min_count:
+                continue
+            if any(is_covered(keys, index_keys, len(shape.equality)) for index_keys in existing_indexes):
+                continue
+            name = json_util.dumps(keys)
+            if name in suggestions:
+                suggestions[name]['count'] += shape.count
+            else:
+                suggestions[name] = {'keys': keys, 'count': shape.count}
+        return sorted(suggestions.values(), key=lambda s: -s['count'])
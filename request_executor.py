@@ -0,0 +1,207 @@
+import gzip
+import json
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Runs HTTP requests for the Tk client (api_client.py) off the UI thread.
+# All requests share one keep-alive requests.Session, work happens on a small thread pool,
+# and finished results are handed back to the Tk main loop through a queue polled with
+# root.after(), because Tk widgets must only be touched from the main thread.
+# Requests are submitted under a key ("main", "image-<id>" ...); a newer request with the
+# same key supersedes the older one, whose result is then dropped. A key is forgotten once its
+# latest request is delivered or cancelled, so one key per property doesn't grow for ever.
+# Long-polls (the change feed of paged_table.py) wait on the server for up to half a minute, so
+# they run on a thread of their own with their own session instead of holding a pool worker.
+# JSON responses to GET requests are kept with their ETag, and asking again sends
+# If-None-Match, so an unchanged list comes back as an empty 304 instead of the whole body.
+# Large JSON bodies (bulk creates with base64 images) are sent gzipped. Compressed responses
+# need nothing here: requests asks for gzip (and br/zstd when brotli/zstandard are installed)
+# and unpacks them by itself.
+
+POLL_INTERVAL_MS = 30
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = (5, 60)  # Seconds to connect, seconds between bytes received
+DEFAULT_MAX_VALIDATED_BYTES = 16 * 1024 * 1024  # Bodies kept for If-None-Match
+COMPRESS_MIN_BYTES = 1024  # JSON bodies from this size up are sent gzipped
+GZIP_LEVEL = 6
+
+# A finished request, the body is parsed once on the worker thread
+class ApiResult:
+    def __init__(self, response=None, error=None):
+        self.error = error  # Network error message, None when the server answered
+        self.status_code = response.status_code if response is not None else None
+        self.headers = response.headers if response is not None else {}
+        self.content = response.content if response is not None else b''
+        self.data = None
+        if response is not None and 'json' in response.headers.get('Content-Type', ''):
+            try:
+                self.data = response.json()
+            except ValueError:
+                pass
+
+    @property
+    def ok(self):
+        return self.error is None and self.status_code is not None and self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+class RequestExecutor:
+    def __init__(self, root, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT,
+                 max_validated_bytes=DEFAULT_MAX_VALIDATED_BYTES):
+        self.root = root
+        self.timeout = timeout
+        self.max_validated_bytes = max_validated_bytes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api-request')
+        self.long_poll_session = requests.Session()
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._generation = 0  # Numbers every request, never reused
+        self._generations = {}  # key -> number of the latest request submitted with it, while unfinished
+        self._futures = {}  # key -> future of the latest request
+        self._validated = OrderedDict()  # (url, params, body) -> last ApiResult with an ETag, LRU
+        self._validated_size = 0
+        self.root.after(POLL_INTERVAL_MS, self._deliver)
+
+    # Run a request in the background and call on_done(ApiResult) on the Tk thread when it finishes
+    def submit(self, key, method, url, on_done, **kwargs):
+        self.run(key, lambda: self.request(method, url, **kwargs), on_done)
+
+    # Like submit, but on a thread of its own, for long-polls. A superseded one is not stopped, its
+    # thread ends when the server answers and the result is dropped.
+    def submit_long_poll(self, key, method, url, on_done, **kwargs):
+        with self._lock:
+            generation = self._next_generation(key)
+        function = lambda: self.request(method, url, session=self.long_poll_session, **kwargs)
+        threading.Thread(target=self._run, args=(key, generation, function, on_done), name='api-long-poll',
+                         daemon=True).start()
+
+    # Send a request on the calling thread, for work that already runs in the pool
+    def request(self, method, url, session=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        key = self._validation_key(method, url, kwargs)
+        previous = self._validated_result(key)
+        if previous is not None:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'If-None-Match': previous.headers['ETag']})
+        self._compress_body(kwargs)
+        try:
+            result = ApiResult((session or self.session).request(method, url, **kwargs))
+        except requests.RequestException as e:
+            return ApiResult(error=str(e))
+        if result.status_code == 304 and previous is not None:
+            return previous  # Unchanged, nothing was downloaded
+        if key is not None and result.ok and result.data is not None and result.headers.get('ETag'):
+            self._store_validated(key, result)
+        return result
+
+    # Helper function to send a large JSON body gzipped (Content-Encoding: gzip), the server unpacks it
+    @staticmethod
+    def _compress_body(kwargs):
+        if kwargs.get('json') is None:
+            return
+        body = json.dumps(kwargs['json'], allow_nan=False).encode('utf-8')
+        if len(body) < COMPRESS_MIN_BYTES:
+            return
+        del kwargs['json']
+        kwargs['data'] = gzip.compress(body, GZIP_LEVEL)
+        kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                 **{'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+
+    # Helper function to build the key a GET response is kept under, None for other requests
+    @staticmethod
+    def _validation_key(method, url, kwargs):
+        if method.upper() != 'GET':
+            return None
+        params = json.dumps(kwargs.get('params'), sort_keys=True, default=str)
+        body = json.dumps(kwargs.get('json'), sort_keys=True, default=str)
+        return url, params, body
+
+    def _validated_result(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            result = self._validated.get(key)
+            if result is not None:
+                self._validated.move_to_end(key)
+            return result
+
+    def _store_validated(self, key, result):
+        with self._lock:
+            previous = self._validated.pop(key, None)
+            if previous is not None:
+                self._validated_size -= len(previous.content)
+            if len(result.content) > self.max_validated_bytes:
+                return
+            self._validated[key] = result
+            self._validated_size += len(result.content)
+            while self._validated_size > self.max_validated_bytes:
+                _, oldest = self._validated.popitem(last=False)
+                self._validated_size -= len(oldest.content)
+
+    # Run any function in the background and call on_done(its return value) on the Tk thread
+    def run(self, key, function, on_done):
+        with self._lock:
+            generation = self._next_generation(key)
+            self._futures[key] = self._pool.submit(self._run, key, generation, function, on_done)
+
+    # Helper function to supersede the request running under a key, call with the lock held
+    def _next_generation(self, key):
+        self._generation += 1
+        generation = self._generations[key] = self._generation
+        previous = self._futures.pop(key, None)
+        if previous is not None:
+            previous.cancel()  # Only stops it if it has not started yet
+        return generation
+
+    # Drop the result of the request running under this key
+    def cancel(self, key):
+        with self._lock:
+            self._generations.pop(key, None)
+            future = self._futures.pop(key, None)
+        if future is not None:
+            future.cancel()
+
+    # Number of the latest request submitted under a key, 0 once it finished
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def is_current(self, key, generation):
+        with self._lock:
+            return self._generations.get(key) == generation
+
+    def _run(self, key, generation, function, on_done):
+        if not self.is_current(key, generation):
+            return  # Superseded while waiting for a worker
+        self._results.put((key, generation, on_done, function()))
+
+    # Hand finished results to their callbacks, runs on the Tk thread
+    def _deliver(self):
+        try:
+            while True:
+                key, generation, on_done, result = self._results.get_nowait()
+                with self._lock:
+                    current = self._generations.get(key) == generation
+                    if current:  # Before on_done, which may submit under the same key again
+                        del self._generations[key]
+                        self._futures.pop(key, None)
+                if current:
+                    on_done(result)
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(POLL_INTERVAL_MS, self._deliver)  # Keep polling even if a callback failed
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+        self.long_poll_session.close()
@@ -0,0 +1,75 @@
+import base64
+import datetime
+import decimal
+import json
+import uuid
+from bson import Binary, Code, DBRef, Decimal128, Int64, MaxKey, MinKey, ObjectId, Regex, Timestamp
+from flask.json.provider import JSONProvider
+
+# One JSON encoder for every API response. BSON values (ObjectId, datetime, Decimal128 ...)
+# are encoded directly, so handlers no longer rewrite documents before returning them.
+# orjson is used when it is installed, otherwise the standard library json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Helper function to turn values JSON has no type for into plain JSON values
+def default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=datetime.timezone.utc)  # Mongo datetimes are UTC
+        return obj.isoformat()
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal128):
+        return str(obj.to_decimal())  # Keep every digit, a float would round
+    if isinstance(obj, (decimal.Decimal, uuid.UUID, Code)):
+        return str(obj)
+    if isinstance(obj, Int64):
+        return int(obj)
+    if isinstance(obj, (bytes, Binary)):
+        return base64.b64encode(obj).decode('ascii')
+    if isinstance(obj, Timestamp):
+        return {'t': obj.time, 'i': obj.inc}
+    if isinstance(obj, Regex):
+        return obj.pattern
+    if isinstance(obj, DBRef):
+        return {'$ref': obj.collection, '$id': default(obj.id) if isinstance(obj.id, ObjectId) else obj.id}
+    if isinstance(obj, (MinKey, MaxKey)):
+        return None
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+# Serialize straight to UTF-8 bytes, ready to be written to the response
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(obj):
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
+
+# Flask/Quart JSON provider so jsonify() goes through the same encoder
+class BSONJSONProvider(JSONProvider):
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
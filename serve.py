@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import os
+import threading
+
+# Production launcher: runs the API in several worker processes, one per core by default.
+#   python serve.py --workers 8 --bind 0.0.0.0:5000                  (Flask server under gunicorn)
+#   python serve.py --server async --workers 8 --bind 0.0.0.0:5001   (async server under hypercorn)
+# Indexes are created once before the workers start. Each worker opens its own MongoDB
+# client after the fork and fills the connection pool before it takes requests.
+
+# Helper function to pick the default number of worker processes
+def default_workers():
+    return os.cpu_count() or 1
+
+# Run api_server.py under gunicorn (pip install gunicorn)
+def serve_flask(bind, workers, threads):
+    from gunicorn.app.base import BaseApplication
+    from api_server import create_app, get_state, prepare_database, start_background_tasks
+
+    app = create_app()
+    prepare_database(app)
+    get_state(app).mongo.close()  # Workers must not inherit the client opened for the startup work
+
+    # Called in each worker after the fork, before it accepts connections
+    def post_worker_init(worker):
+        get_state(app).mongo.warm_up()
+        if worker.age == 1:  # Only the first worker runs the image store migration
+            start_background_tasks(app)
+        worker.log.info('Worker %s warmed up', os.getpid())
+
+    class FlaskApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', bind)
+            self.cfg.set('workers', workers)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', threads)
+            self.cfg.set('post_worker_init', post_worker_init)
+
+        def load(self):
+            return app
+
+    FlaskApplication().run()
+
+# Run api_server_async.py under hypercorn (pip install quart hypercorn)
+def serve_async(bind, workers):
+    from hypercorn.config import Config
+    from hypercorn.run import run
+    from api_server_async import background_tasks, create_app, prepare_database, run_once
+
+    # The startup work runs here once: indexes before the workers start, the migrations in the
+    # background of this process. The workers inherit the environment and skip it.
+    app = create_app()
+    asyncio.run(run_once(app, prepare_database))
+    threading.Thread(target=asyncio.run, args=(run_once(app, background_tasks),), daemon=True).start()
+    os.environ['RUN_STARTUP_TASKS'] = 'false'
+
+    # Each worker builds its own app and connects (and warms up) in its before_serving hook
+    config = Config()
+    config.application_path = 'api_server_async:create_app()'
+    config.bind = [bind]
+    config.workers = workers
+    run(config)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the properties API in several worker processes')
+    parser.add_argument('--server', choices=['flask', 'async'], default='flask')
+    parser.add_argument('--bind', default='localhost:5000')
+    parser.add_argument('--workers', type=int, default=default_workers())
+    parser.add_argument('--threads', type=int, default=8, help='Threads per worker (flask only)')
+    args = parser.parse_args()
+    if args.server == 'async':
+        serve_async(args.bind, args.workers)
+    else:
+        serve_flask(args.bind, args.workers, args.threads)
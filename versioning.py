@@ -0,0 +1,111 @@
+import datetime
+import hashlib
+from werkzeug.http import http_date, parse_date, quote_etag, unquote_etag
+
+# Document versions and change counters behind the ETags of both servers (api_server.py,
+# api_server_async.py). Every write stamps the documents it touches with a new "_version"
+# and "updated_at", and bumps one counter document in the meta collection, so a list
+# request can tell whether anything changed without reading the list again.
+# Nothing in here touches the database.
+
+VERSION_FIELD = '_version'
+UPDATED_FIELD = 'updated_at'
+SERVER_FIELDS = (VERSION_FIELD, UPDATED_FIELD)  # Maintained by the server, ignored in client data
+VERSION_PROJECTION = {VERSION_FIELD: 1, UPDATED_FIELD: 1}  # What an update returns to build the new ETag
+
+# The counter document in the meta collection (config MONGO_META_COLLECTION)
+CHANGE_COUNTER_FILTER = {'_id': 'changes'}
+CHANGE_COUNTER_UPDATE = {'$inc': {'count': 1}}
+
+# Helper function to build the update that reserves several numbers of the change counter
+def change_counter_update(count):
+    return {'$inc': {'count': count}}
+
+# Helper function to get the current time as Mongo stores it (UTC, millisecond precision)
+def utc_now():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+# Stamp a new document with its first version
+def stamp_new(doc, now=None):
+    if isinstance(doc, dict):
+        doc[VERSION_FIELD] = 1
+        doc[UPDATED_FIELD] = now or utc_now()
+    return doc
+
+# Add a version bump to an update document ({'$set': ...} etc.), client values for the
+# server fields are dropped
+def bump_version(update, now=None):
+    fields = update.setdefault('$set', {})
+    for field in SERVER_FIELDS:
+        fields.pop(field, None)
+    fields[UPDATED_FIELD] = now or utc_now()
+    update.setdefault('$inc', {})[VERSION_FIELD] = 1
+    return update
+
+# Helper function to make sure a projection returns the fields the ETag is built from.
+# Returns the projection to use and the fields to drop again before responding.
+def with_version_fields(projection):
+    if not projection or not any(projection.values()):
+        return projection, []  # No projection, or an exclusion one; the fields are there
+    added = [field for field in SERVER_FIELDS if field not in projection]
+    return dict(projection, **{field: 1 for field in added}), added
+
+# Helper function to build the (unquoted) ETag of a document, documents older than
+# versioning count as version 0
+def item_etag(doc):
+    return f'{doc["_id"]}-{doc.get(VERSION_FIELD) or 0}'
+
+# Helper function to read the version out of an If-Match tag of a document, None if it
+# belongs to another document or is not one of ours
+def parse_item_etag(tag, id):
+    prefix = f'{id}-'
+    if not tag.startswith(prefix) or not tag[len(prefix):].isdigit():
+        return None
+    return int(tag[len(prefix):])
+
+# Helper function to build the filter that only matches a document at one of these versions
+def version_filter(versions):
+    return {VERSION_FIELD: {'$in': [version or None for version in versions]}}  # 0 = no _version yet
+
+# Helper function to build the filter of a conditional update from its If-Match header,
+# None when the update is unconditional
+def if_match_filter(if_match, id):
+    if not if_match or if_match.star_tag:
+        return None
+    versions = [parse_item_etag(tag, id) for tag in if_match.as_set()]
+    return version_filter([version for version in versions if version is not None])
+
+# Helper function to drop the fields with_version_fields added from a found document,
+# returns the validator headers they make
+def pop_version_fields(item, added_fields):
+    headers = version_headers(item_etag(item), item.get(UPDATED_FIELD))
+    for field in added_fields:
+        item.pop(field, None)
+    return headers
+
+# Helper function to build the (unquoted) ETag of a list response: the change counter plus
+# a digest of everything that shapes the response (route, filter, arguments, format)
+def list_etag(count, key):
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return f'{count}-{digest}'
+
+# Helper function to read the value of the change counter document
+def change_count(doc):
+    return doc['count'] if doc else 0
+
+# Helper function to build the validator headers of a versioned response
+def version_headers(etag, last_modified=None):
+    headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}  # Caches must revalidate, not guess
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+# Helper function to decide whether a GET can be answered with 304 Not Modified, given the
+# headers the full response would have. If-None-Match wins over If-Modified-Since.
+def is_not_modified(request, headers):
+    etag, _ = unquote_etag(headers['ETag'])
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    last_modified = parse_date(headers.get('Last-Modified'))
+    return bool(request.if_modified_since and last_modified and last_modified <= request.if_modified_since)